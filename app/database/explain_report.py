@@ -0,0 +1,145 @@
+# app/database/explain_report.py
+#
+# Отчет с планами запросов для функций чтения из app/database/requests/requests.py.
+# Запуск:
+#   python -m app.database.explain_report            # EXPLAIN
+#   python -m app.database.explain_report --analyze  # EXPLAIN (ANALYZE, BUFFERS)
+#
+# Каждая функция вызывается с примерами аргументов из текущей БД, все SQL-запросы,
+# которые она реально отправляет, перехватываются и для каждого печатается план.
+# Так отчет не расходится с кодом запросов и сразу показывает потерю индекса.
+
+import argparse
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, select
+
+from app.database.models import async_session, engine, User, Artist, City, EventType, Event, Country
+from app.database.requests import requests as rq
+
+_captured: list[tuple[str, object]] | None = None
+
+
+def _capture_statement(conn, cursor, statement, parameters, context, executemany):
+    if _captured is not None and statement.lstrip().upper().startswith(("SELECT", "WITH", "UPDATE", "DELETE")):
+        _captured.append((statement, parameters))
+
+
+async def _load_samples() -> dict:
+    """Берет из БД реальные значения, чтобы планы строились на живой статистике."""
+    async with async_session() as session:
+        user_id = (await session.execute(select(User.user_id).limit(1))).scalar()
+        artists = (await session.execute(select(Artist.artist_id, Artist.name).limit(3))).all()
+        city_name = (await session.execute(select(City.name).limit(1))).scalar()
+        country_name = (await session.execute(select(Country.name).limit(1))).scalar()
+        category = (await session.execute(select(EventType.name).limit(1))).scalar()
+        signatures = (await session.execute(
+            select(Event.title, Event.date_start).where(Event.date_start.is_not(None)).limit(50)
+        )).all()
+
+    return {
+        "user_id": user_id or 0,
+        "artist_ids": [a.artist_id for a in artists],
+        "artist_names": [a.name for a in artists],
+        "artist_id": artists[0].artist_id if artists else 0,
+        "city_name": city_name or "Минск",
+        "country_name": country_name or "Беларусь",
+        "category": category or "Концерт",
+        "signatures": [tuple(s) for s in signatures],
+        "query": artists[0].name[:6] if artists else "test",
+    }
+
+
+async def _find_events_by_signatures(signatures):
+    async with async_session() as session:
+        return await rq.find_events_by_signatures_bulk(session, signatures)
+
+
+def _report_targets(s: dict) -> list[tuple[str, callable]]:
+    today = datetime.now()
+    regions = [s["city_name"], s["country_name"]]
+    return [
+        ("get_user_lang", lambda: rq.get_user_lang(s["user_id"])),
+        ("get_user_preferences", lambda: rq.get_user_preferences(s["user_id"])),
+        ("get_user_favorites", lambda: rq.get_user_favorites(s["user_id"])),
+        ("check_main_geo_status", lambda: rq.check_main_geo_status(s["user_id"])),
+        ("check_general_geo_onboarding_status", lambda: rq.check_general_geo_onboarding_status(s["user_id"])),
+        ("get_general_mobility", lambda: rq.get_general_mobility(s["user_id"])),
+        ("get_user_subscriptions", lambda: rq.get_user_subscriptions(s["user_id"])),
+        ("get_user_subscription_items", lambda: rq.get_user_subscription_items(s["user_id"])),
+        ("count_user_favorites", lambda: rq.count_user_favorites(s["user_id"])),
+        ("count_user_subscriptions", lambda: rq.count_user_subscriptions(s["user_id"])),
+        ("get_favorite_details", lambda: rq.get_favorite_details(s["user_id"], s["artist_id"])),
+        ("get_subscription_details", lambda: rq.get_subscription_details(s["user_id"], 0)),
+        ("find_artists_fuzzy", lambda: rq.find_artists_fuzzy(s["query"])),
+        ("find_countries_fuzzy", lambda: rq.find_countries_fuzzy(s["country_name"])),
+        ("find_cities_fuzzy", lambda: rq.find_cities_fuzzy(s["country_name"], s["city_name"])),
+        ("get_countries", lambda: rq.get_countries()),
+        ("get_top_cities_for_country", lambda: rq.get_top_cities_for_country(s["country_name"])),
+        ("get_country_by_city_name", lambda: rq.get_country_by_city_name(s["city_name"])),
+        ("find_events_fuzzy", lambda: rq.find_events_fuzzy(s["query"], regions, today, today + timedelta(days=30))),
+        ("get_events_for_artists", lambda: rq.get_events_for_artists(s["artist_names"], regions)),
+        ("get_future_events_for_artists", lambda: rq.get_future_events_for_artists(s["artist_ids"])),
+        ("get_future_event_cards_for_artists", lambda: rq.get_future_event_cards_for_artists(s["artist_ids"])),
+        ("get_cities_for_category", lambda: rq.get_cities_for_category(s["category"], regions)),
+        ("get_grouped_events_by_city_and_category",
+         lambda: rq.get_grouped_events_by_city_and_category(s["city_name"], s["category"], today, today + timedelta(days=30))),
+        ("get_grouped_events_by_city_and_categories",
+         lambda: rq.get_grouped_events_by_city_and_categories(s["city_name"], [s["category"]], today, today + timedelta(days=30))),
+        ("find_events_by_signatures_bulk", lambda: _find_events_by_signatures(s["signatures"])),
+    ]
+
+
+async def _explain(statement: str, parameters, analyze: bool) -> list[str]:
+    prefix = "EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN "
+    async with engine.connect() as conn:
+        # Даже ANALYZE для UPDATE/DELETE выполняется внутри транзакции и откатывается
+        transaction = await conn.begin()
+        try:
+            result = await conn.exec_driver_sql(prefix + statement, parameters)
+            return [row[0] for row in result]
+        finally:
+            await transaction.rollback()
+
+
+async def run_report(analyze: bool = False, only: list[str] | None = None):
+    global _captured
+    samples = await _load_samples()
+    event.listen(engine.sync_engine, "before_cursor_execute", _capture_statement)
+    try:
+        for name, call in _report_targets(samples):
+            if only and name not in only:
+                continue
+            print("=" * 100)
+            print(f"== {name}")
+            print("=" * 100)
+
+            _captured = []
+            try:
+                await call()
+            except Exception as e:
+                print(f"!! Ошибка при вызове функции: {e}\n")
+            statements, _captured = _captured, None
+
+            if not statements:
+                print("(запросов к БД нет)\n")
+            for i, (statement, parameters) in enumerate(statements, 1):
+                print(f"-- Запрос {i}:\n{statement.strip()}\n")
+                try:
+                    for line in await _explain(statement, parameters, analyze):
+                        print(f"   {line}")
+                except Exception as e:
+                    print(f"   !! EXPLAIN не выполнен: {e}")
+                print()
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", _capture_statement)
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Планы запросов для функций app/database/requests/requests.py")
+    parser.add_argument("--analyze", action="store_true", help="EXPLAIN (ANALYZE, BUFFERS) вместо EXPLAIN")
+    parser.add_argument("functions", nargs="*", help="Только эти функции (по умолчанию — все)")
+    args = parser.parse_args()
+    asyncio.run(run_report(analyze=args.analyze, only=args.functions))
@@ -1,14 +1,20 @@
 # app/database/models.py
 
 import os
+import re
+import time
 from dotenv import load_dotenv
 
 from sqlalchemy.orm import DeclarativeBase, relationship
 from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
 from sqlalchemy import (
     Column, Integer, NullPool, String, Text, ForeignKey, TIMESTAMP, DECIMAL, BigInteger,
-    JSON, Boolean, text, Enum, inspect
+    JSON, Boolean, text, Enum, inspect, Index, func, Table, MetaData
 )
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.dialects.postgresql import TSVECTOR, ARRAY
+
+from .query_stats import instrument_engine
 
 # --- Настройка подключения (без изменений) ---
 load_dotenv()
@@ -22,9 +28,153 @@ if not all([DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASS]):
     raise KeyError("Не все переменные окружения для базы данных определены в .env файле")
 
 SQL_ALCHEMY = f"postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-engine = create_async_engine(url=SQL_ALCHEMY)
+
+# --- Реплика для чтения (необязательно) ---
+# Если DB_REPLICA_HOST не задан, все запросы идут в основную базу.
+# Остальные параметры по умолчанию берутся от основной базы.
+DB_REPLICA_HOST = os.getenv("DB_REPLICA_HOST")
+DB_REPLICA_PORT = os.getenv("DB_REPLICA_PORT", DB_PORT)
+DB_REPLICA_NAME = os.getenv("DB_REPLICA_NAME", DB_NAME)
+DB_REPLICA_USER = os.getenv("DB_REPLICA_USER", DB_USER)
+DB_REPLICA_PASS = os.getenv("DB_REPLICA_PASS", DB_PASS)
+
+SQL_ALCHEMY_REPLICA = (
+    f"postgresql+asyncpg://{DB_REPLICA_USER}:{DB_REPLICA_PASS}@{DB_REPLICA_HOST}:{DB_REPLICA_PORT}/{DB_REPLICA_NAME}"
+    if DB_REPLICA_HOST else None
+)
+
+# Сколько секунд после записи пользователя его чтения идут в основную базу,
+# чтобы он увидел свои изменения, даже если реплика отстает (0 — не переключать)
+REPLICA_STALENESS_SECONDS = float(os.getenv("REPLICA_STALENESS_SECONDS", 5))
+
+# Бэкенд нечеткого поиска артистов/стран/городов: 'python' (по умолчанию) или 'pg_trgm'
+FUZZY_SEARCH_BACKEND = os.getenv("FUZZY_SEARCH_BACKEND", "python").lower()
+
+# --- Профили подключений ---
+# bot      — много коротких запросов из хендлеров: пул с запасом под всплески,
+#            короткий statement_timeout, чтобы медленный запрос не держал соединение.
+# parser   — длинные транзакции импорта и DDL при старте: маленький пул без лимита на запрос.
+# listener — одно долгоживущее соединение под LISTEN, без пула.
+# Любой параметр переопределяется переменной окружения DB_<ПРОФИЛЬ>_<ПАРАМЕТР>,
+# например DB_BOT_POOL_SIZE=20 или DB_PARSER_STATEMENT_TIMEOUT_MS=600000.
+# command_timeout (сек, клиентский таймаут asyncpg) = 0 и statement_timeout_ms = 0 означают "без лимита".
+ENGINE_PROFILES = {
+    "bot": {
+        "pool_size": 5,
+        "max_overflow": 15,
+        "pool_timeout": 10,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+        "statement_cache_size": 100,
+        "command_timeout": 30,
+        "statement_timeout_ms": 15000,
+    },
+    "parser": {
+        "pool_size": 2,
+        "max_overflow": 3,
+        "pool_timeout": 60,
+        "pool_recycle": 3600,
+        "pool_pre_ping": True,
+        "statement_cache_size": 100,
+        "command_timeout": 0,
+        "statement_timeout_ms": 0,
+    },
+    "listener": {
+        "use_pool": False,
+        "statement_cache_size": 0,
+        "command_timeout": 0,
+        "statement_timeout_ms": 0,
+    },
+}
+
+
+def _profile_setting(profile: str, name: str, default):
+    raw = os.getenv(f"DB_{profile.upper()}_{name.upper()}")
+    if raw is None:
+        return default
+    if isinstance(default, bool):
+        return raw.strip().lower() in ("1", "true", "yes", "on")
+    return int(raw)
+
+
+def create_profile_engine(profile: str, url: str = SQL_ALCHEMY, application_name: str = None):
+    """Создает AsyncEngine с настройками пула и соединений из ENGINE_PROFILES[profile]."""
+    settings = {
+        name: _profile_setting(profile, name, default)
+        for name, default in ENGINE_PROFILES[profile].items()
+    }
+
+    connect_args = {
+        "statement_cache_size": settings["statement_cache_size"],
+        "command_timeout": settings["command_timeout"] or None,
+        "server_settings": {
+            "application_name": application_name or f"afisha-{profile}",
+            "statement_timeout": str(settings["statement_timeout_ms"]),
+        },
+    }
+
+    if not settings.get("use_pool", True):
+        async_engine = create_async_engine(url=url, poolclass=NullPool, connect_args=connect_args)
+    else:
+        async_engine = create_async_engine(
+            url=url,
+            pool_size=settings["pool_size"],
+            max_overflow=settings["max_overflow"],
+            pool_timeout=settings["pool_timeout"],
+            pool_recycle=settings["pool_recycle"],
+            pool_pre_ping=settings["pool_pre_ping"],
+            connect_args=connect_args,
+        )
+    # Замер каждого запроса для статистики SQL (app/database/query_stats.py)
+    instrument_engine(async_engine, connect_args["server_settings"]["application_name"])
+    return async_engine
+
+
+# Движок бота: им пользуются хендлеры и сервисы через async_session
+engine = create_profile_engine("bot")
 async_session = async_sessionmaker(engine)
 
+# Движок парсеров и служебных операций (создание таблиц, индексов, бэкфилл)
+parser_engine = create_profile_engine("parser")
+parser_session = async_sessionmaker(parser_engine)
+
+# Движок реплики: те же настройки, что у бота, только другой хост
+replica_engine = (
+    create_profile_engine("bot", url=SQL_ALCHEMY_REPLICA, application_name="afisha-bot-replica")
+    if SQL_ALCHEMY_REPLICA else None
+)
+replica_session = async_sessionmaker(replica_engine) if replica_engine else None
+
+# user_id -> время последней записи (time.monotonic()), только в памяти процесса бота
+_last_user_write: dict[int, float] = {}
+
+
+def mark_user_write(user_id: int):
+    """Запоминает, что пользователь только что что-то изменил в основной базе."""
+    now = time.monotonic()
+    _last_user_write[user_id] = now
+    # Не даем словарю расти бесконечно: устаревшие отметки больше ни на что не влияют
+    if len(_last_user_write) > 10000:
+        for uid, written_at in list(_last_user_write.items()):
+            if now - written_at >= REPLICA_STALENESS_SECONDS:
+                del _last_user_write[uid]
+
+
+def read_session(user_id: int = None):
+    """
+    Сессия для запросов только на чтение.
+    Идет в реплику, если она настроена. Если user_id недавно что-то записал
+    (меньше REPLICA_STALENESS_SECONDS назад), возвращает сессию основной базы,
+    чтобы пользователь не увидел данные до своего же изменения.
+    """
+    if replica_session is None:
+        return async_session()
+    if user_id is not None:
+        written_at = _last_user_write.get(user_id)
+        if written_at is not None and time.monotonic() - written_at < REPLICA_STALENESS_SECONDS:
+            return async_session()
+    return replica_session()
+
 
 class Base(AsyncAttrs, DeclarativeBase):
     pass
@@ -45,6 +195,13 @@ class City(Base):
     country = relationship("Country", back_populates="cities")
     venues = relationship("Venue", back_populates="city")
 
+    __table_args__ = (
+        # Натуральный ключ города для ReferenceResolver (INSERT ... ON CONFLICT);
+        # по ведущему name — поиск города по имени (афиша, get_country_by_city_name)
+        Index("ux_cities_name_country_id", "name", "country_id", unique=True),
+        Index("ix_cities_country_id", "country_id"),
+    )
+
 class EventType(Base):
     __tablename__ = "event_types"
     type_id = Column(Integer, primary_key=True)
@@ -62,6 +219,11 @@ class Artist(Base):
     events = relationship("EventArtist", back_populates="artist")
     # НОВАЯ СВЯЗЬ: Пользователи, добавившие этого "артиста" в "Избранное"
     user_associations = relationship("UserFavorite", back_populates="artist", cascade="all, delete-orphan")
+
+    __table_args__ = (
+        # populate_artists_if_needed и сравнения без учета регистра
+        Index("ix_artists_name_lower", func.lower(name)),
+    )
     # --- ДОБАВЬТЕ ЭТОТ МЕТОД ---
     def to_dict(self):
         return {
@@ -80,6 +242,12 @@ class Venue(Base):
     city = relationship("City", back_populates="venues")
     events = relationship("Event", back_populates="venue")
 
+    __table_args__ = (
+        Index("ix_venues_city_id", "city_id"),
+        # Натуральный ключ площадки для ReferenceResolver (INSERT ... ON CONFLICT)
+        Index("ux_venues_name_city_id_country_id", "name", "city_id", "country_id", unique=True),
+    )
+
 class Event(Base):
     __tablename__ = "events"
     # ... (добавляем поле для обновлений от парсера)
@@ -94,6 +262,13 @@ class Event(Base):
     price_max = Column(DECIMAL(10, 2))
     # НОВОЕ ПОЛЕ: для хранения информации о билетах (например, "Осталось мало", "Sold Out")
     tickets_info = Column(String(255), nullable=True)
+    # Стабильный идентификатор события на сайте-источнике: парсер ('yandex_afisha',
+    # 'kvitki_by', ...) и ID/слаг события там. У старых событий может быть NULL.
+    source = Column(String(50), nullable=True)
+    external_id = Column(String(255), nullable=True)
+    # Хэш изменяемых полей из последних данных парсера (цены, билеты, дата окончания):
+    # неизменившиеся события не обновляются (см. requests.event_content_hash)
+    content_hash = Column(String(16), nullable=True)
     # Связи
     event_type = relationship("EventType", back_populates="events")
     venue = relationship("Venue", back_populates="events")
@@ -102,6 +277,18 @@ class Event(Base):
 
     subscriptions = relationship("Subscription", back_populates="event", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # Идентичность события: одно название в одно время на одной площадке.
+        # Префикс (title, date_start) обслуживает сверку сигнатур при импорте.
+        Index("ux_events_identity", "title", "date_start", "venue_id", unique=True),
+        # Сопоставление при импорте по ID источника: правка названия на сайте не плодит дубли.
+        # NULL-ы не конфликтуют, поэтому старые события без ID индексу не мешают.
+        Index("ux_events_source_external_id", "source", "external_id", unique=True),
+        # Афиша: события площадки/категории, начиная с даты
+        Index("ix_events_venue_id_date_start", "venue_id", "date_start"),
+        Index("ix_events_type_id_date_start", "type_id", "date_start"),
+    )
+
 class EventArtist(Base):
     __tablename__ = "event_artists"
     # ... (без изменений)
@@ -110,6 +297,11 @@ class EventArtist(Base):
     event = relationship("Event", back_populates="artists")
     artist = relationship("Artist", back_populates="events")
 
+    __table_args__ = (
+        # PK (event_id, artist_id) не помогает при поиске событий артиста
+        Index("ix_event_artists_artist_id", "artist_id"),
+    )
+
 class EventLink(Base):
     __tablename__ = "event_links"
     # ... (без изменений)
@@ -119,6 +311,23 @@ class EventLink(Base):
     type = Column(String(50))
     event = relationship("Event", back_populates="links")
 
+    __table_args__ = (
+        # Одна ссылка на событие один раз; цель для ON CONFLICT (event_id, url)
+        Index("ux_event_links_event_id_url", "event_id", "url", unique=True),
+    )
+
+# Поисковый документ события: нормализованные название + имена артистов.
+# Заполняется триггерами (см. SQL_CREATE_EVENT_SEARCH_*), руками не пишется.
+class EventSearch(Base):
+    __tablename__ = "event_search"
+    event_id = Column(Integer, ForeignKey("events.event_id", ondelete="CASCADE"), primary_key=True)
+    document = Column(Text, nullable=False)
+    document_tsv = Column(TSVECTOR)
+
+    __table_args__ = (
+        Index("ix_event_search_document_tsv", "document_tsv", postgresql_using="gin"),
+    )
+
 class User(Base):
     __tablename__ = 'users'
     # ... (добавляем связь с "Избранным")
@@ -131,6 +340,9 @@ class User(Base):
     main_geo_completed = Column(Boolean, default=False, nullable=False)
     general_geo_completed = Column(Boolean, default=False, nullable=False)
     general_mobility_regions = Column(JSON, nullable=True)
+    # Счетчики для проверки лимитов; ведутся триггерами (см. SQL_CREATE_USER_COUNTERS)
+    favorites_count = Column(Integer, default=0, server_default="0", nullable=False)
+    subscriptions_count = Column(Integer, default=0, server_default="0", nullable=False)
     # НОВАЯ СВЯЗЬ: "Избранные" артисты/объекты интереса
     favorites = relationship("UserFavorite", back_populates="user", cascade="all, delete-orphan")
 
@@ -152,6 +364,12 @@ class Subscription(Base):
     event = relationship("Event", back_populates="subscriptions")
     user = relationship("User")
 
+    __table_args__ = (
+        # Список подписок пользователя и активные подписки для напоминаний
+        Index("ix_subscriptions_user_id_status", "user_id", "status"),
+        Index("ix_subscriptions_event_id", "event_id"),
+    )
+
 # --- ИЗМЕНЕНИЕ 3: НОВАЯ таблица для "Избранного" (многие-ко-многим) ---
 # Эта таблица связывает Пользователей и их "Объекты интереса" (Артистов)
 class UserFavorite(Base):
@@ -164,6 +382,49 @@ class UserFavorite(Base):
     user = relationship("User", back_populates="favorites")
     artist = relationship("Artist", back_populates="user_associations")
 
+    __table_args__ = (
+        # Рассылка уведомлений всем, у кого артист в избранном (listener)
+        Index("ix_user_favorites_artist_id", "artist_id"),
+    )
+
+
+# --- Состояние обхода страниц парсерами ---
+# Что парсер видел на странице в прошлые запуски: хэш содержимого и валидаторы HTTP.
+# По ним парсеры пропускают неизменившиеся страницы и останавливают пагинацию на уже
+# известных страницах (см. requests_crawl.CrawlTracker).
+class CrawlState(Base):
+    __tablename__ = "crawl_state"
+    source = Column(String(50), primary_key=True)
+    url = Column(String(1024), primary_key=True)
+    content_hash = Column(String(64), nullable=True)
+    etag = Column(String(255), nullable=True)
+    last_modified = Column(String(64), nullable=True)
+    first_seen_at = Column(TIMESTAMP, server_default=func.now(), nullable=False)
+    last_checked_at = Column(TIMESTAMP, server_default=func.now(), nullable=False)
+    last_changed_at = Column(TIMESTAMP, server_default=func.now(), nullable=False)
+
+
+# --- Архив прошедших событий ---
+# Прошедшие события вместе со ссылками и связями с артистами переносятся сюда
+# (см. requests_archive.archive_past_events), чтобы events и его индексы
+# содержали только актуальные данные. Структура повторяет исходные таблицы,
+# но без внешних ключей: архив не мешает удалять артистов, площадки и т.п.
+def _archive_table(source: Table) -> Table:
+    columns = [
+        Column(c.name, c.type, primary_key=c.primary_key, autoincrement=False, nullable=c.nullable)
+        for c in source.columns
+    ]
+    return Table(
+        f"{source.name}_archive", Base.metadata,
+        *columns,
+        Column("archived_at", TIMESTAMP, server_default=func.now(), nullable=False),
+    )
+
+
+events_archive = _archive_table(Event.__table__)
+event_links_archive = _archive_table(EventLink.__table__)
+event_artists_archive = _archive_table(EventArtist.__table__)
+
 
 SQL_CREATE_TRIGGER_FUNCTION = """
 CREATE OR REPLACE FUNCTION notify_new_event()
@@ -217,7 +478,481 @@ FOR EACH ROW
 EXECUTE FUNCTION notify_new_event();
 """
 
-listener_engine = create_async_engine(url=SQL_ALCHEMY, poolclass=NullPool)
+# --- Триграммный поиск (pg_trgm) ---
+# Расширение и GIN-индексы создаются всегда: они дешевые и нужны,
+# чтобы можно было переключить FUZZY_SEARCH_BACKEND без миграции.
+SQL_CREATE_TRGM_EXTENSION = "CREATE EXTENSION IF NOT EXISTS pg_trgm;"
+
+SQL_CREATE_TRGM_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_artists_name_trgm ON artists USING gin (name gin_trgm_ops);",
+    "CREATE INDEX IF NOT EXISTS ix_countries_name_trgm ON countries USING gin (name gin_trgm_ops);",
+    "CREATE INDEX IF NOT EXISTS ix_cities_name_trgm ON cities USING gin (name gin_trgm_ops);",
+    "CREATE INDEX IF NOT EXISTS ix_event_search_document_trgm ON event_search USING gin (document gin_trgm_ops);",
+]
+
+# --- Поисковые документы событий (event_search) ---
+SQL_CREATE_EVENT_SEARCH_FUNCTIONS = [
+    """
+    CREATE OR REPLACE FUNCTION event_search_normalize(value TEXT)
+    RETURNS TEXT AS $$
+        SELECT btrim(regexp_replace(lower(coalesce(value, '')), '[^[:alnum:]]+', ' ', 'g'));
+    $$ LANGUAGE sql IMMUTABLE;
+    """,
+    """
+    CREATE OR REPLACE FUNCTION refresh_event_search(p_event_id INTEGER)
+    RETURNS VOID AS $$
+    BEGIN
+        INSERT INTO event_search (event_id, document, document_tsv)
+        SELECT e.event_id, doc.document, to_tsvector('simple', doc.document)
+        FROM events e
+        CROSS JOIN LATERAL (
+            SELECT event_search_normalize(e.title || ' ' || coalesce(string_agg(a.name, ' '), '')) AS document
+            FROM event_artists ea
+            JOIN artists a ON a.artist_id = ea.artist_id
+            WHERE ea.event_id = e.event_id
+        ) doc
+        WHERE e.event_id = p_event_id
+        ON CONFLICT (event_id) DO UPDATE
+            SET document = EXCLUDED.document,
+                document_tsv = EXCLUDED.document_tsv;
+    END;
+    $$ LANGUAGE plpgsql;
+    """,
+    """
+    CREATE OR REPLACE FUNCTION event_search_on_event()
+    RETURNS TRIGGER AS $$
+    BEGIN
+        PERFORM refresh_event_search(NEW.event_id);
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+    """,
+    """
+    CREATE OR REPLACE FUNCTION event_search_on_event_artist()
+    RETURNS TRIGGER AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM refresh_event_search(OLD.event_id);
+            RETURN OLD;
+        END IF;
+        PERFORM refresh_event_search(NEW.event_id);
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+    """,
+]
+
+SQL_CREATE_EVENT_SEARCH_TRIGGERS = [
+    "DROP TRIGGER IF EXISTS event_search_event_trigger ON events;",
+    """
+    CREATE TRIGGER event_search_event_trigger
+    AFTER INSERT OR UPDATE OF title ON events
+    FOR EACH ROW
+    EXECUTE FUNCTION event_search_on_event();
+    """,
+    "DROP TRIGGER IF EXISTS event_search_event_artist_trigger ON event_artists;",
+    """
+    CREATE TRIGGER event_search_event_artist_trigger
+    AFTER INSERT OR DELETE ON event_artists
+    FOR EACH ROW
+    EXECUTE FUNCTION event_search_on_event_artist();
+    """,
+]
+
+# Документы для событий, созданных до появления триггеров
+SQL_BACKFILL_EVENT_SEARCH = """
+SELECT refresh_event_search(e.event_id)
+FROM events e
+WHERE NOT EXISTS (SELECT 1 FROM event_search s WHERE s.event_id = e.event_id);
+"""
+
+# Новые колонки events (и архива, который копирует все колонки events) для таблиц,
+# созданных до их появления (выполняется до ensure_indexes, которому нужны эти колонки)
+SQL_ADD_EVENT_COLUMNS = [
+    "ALTER TABLE events ADD COLUMN IF NOT EXISTS source VARCHAR(50);",
+    "ALTER TABLE events ADD COLUMN IF NOT EXISTS external_id VARCHAR(255);",
+    "ALTER TABLE events ADD COLUMN IF NOT EXISTS content_hash VARCHAR(16);",
+    "ALTER TABLE events_archive ADD COLUMN IF NOT EXISTS source VARCHAR(50);",
+    "ALTER TABLE events_archive ADD COLUMN IF NOT EXISTS external_id VARCHAR(255);",
+    "ALTER TABLE events_archive ADD COLUMN IF NOT EXISTS content_hash VARCHAR(16);",
+]
+
+# --- Счетчики избранного и подписок в users ---
+# Лимиты FAVORITES_LIMIT / SUBSCRIPTIONS_LIMIT проверяются чтением одной строки users
+# вместо COUNT(*). Триггеры ловят любые вставки и удаления, в том числе каскадные
+# при удалении событий и артистов, поэтому писать счетчики руками не нужно.
+SQL_CREATE_USER_COUNTERS = [
+    # Колонки для таблицы users, созданной до появления счетчиков
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS favorites_count INTEGER NOT NULL DEFAULT 0;",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS subscriptions_count INTEGER NOT NULL DEFAULT 0;",
+    """
+    CREATE OR REPLACE FUNCTION user_favorites_count_trigger()
+    RETURNS TRIGGER AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE users SET favorites_count = favorites_count + 1 WHERE user_id = NEW.user_id;
+        ELSE
+            UPDATE users SET favorites_count = favorites_count - 1 WHERE user_id = OLD.user_id;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """,
+    """
+    CREATE OR REPLACE FUNCTION user_subscriptions_count_trigger()
+    RETURNS TRIGGER AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE users SET subscriptions_count = subscriptions_count + 1 WHERE user_id = NEW.user_id;
+        ELSE
+            UPDATE users SET subscriptions_count = subscriptions_count - 1 WHERE user_id = OLD.user_id;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """,
+    "DROP TRIGGER IF EXISTS user_favorites_count ON user_favorites;",
+    """
+    CREATE TRIGGER user_favorites_count
+    AFTER INSERT OR DELETE ON user_favorites
+    FOR EACH ROW
+    EXECUTE FUNCTION user_favorites_count_trigger();
+    """,
+    "DROP TRIGGER IF EXISTS user_subscriptions_count ON subscriptions;",
+    """
+    CREATE TRIGGER user_subscriptions_count
+    AFTER INSERT OR DELETE ON subscriptions
+    FOR EACH ROW
+    EXECUTE FUNCTION user_subscriptions_count_trigger();
+    """,
+]
+
+# Пересчет счетчиков: для строк, созданных до триггеров, и на случай ручных правок в БД
+SQL_BACKFILL_USER_COUNTERS = """
+UPDATE users u
+SET favorites_count = c.favorites_count,
+    subscriptions_count = c.subscriptions_count
+FROM (
+    SELECT
+        u2.user_id,
+        (SELECT count(*) FROM user_favorites f WHERE f.user_id = u2.user_id) AS favorites_count,
+        (SELECT count(*) FROM subscriptions s WHERE s.user_id = u2.user_id) AS subscriptions_count
+    FROM users u2
+) c
+WHERE u.user_id = c.user_id
+  AND (u.favorites_count <> c.favorites_count OR u.subscriptions_count <> c.subscriptions_count);
+"""
+
+# --- Витрина афиши (afisha_event_groups) ---
+# Предстоящие события, заранее сгруппированные так, как их показывает афиша:
+# одна строка на (город, категория, название, площадка). Массивы event_ids/dates/
+# links/prices_* выровнены по индексу и отсортированы по дате (без даты — в конце),
+# поэтому запрос афиши только вырезает нужный диапазон дат из готовых строк.
+# Обновляется REFRESH ... CONCURRENTLY в конце каждого запуска парсеров и после
+# архивации (requests_archive.archive_past_events). Между обновлениями в витрине
+# могут быть уже прошедшие даты, поэтому запрос афиши дополнительно фильтрует
+# date_start >= сегодня по каждой дате.
+SQL_CREATE_AFISHA_EVENT_GROUPS = [
+    """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS afisha_event_groups AS
+    SELECT
+        c.city_id,
+        c.name AS city_name,
+        co.name AS country_name,
+        et.name AS category_name,
+        e.title,
+        v.name AS venue_name,
+        min(e.date_start) AS first_date,
+        max(e.date_start) AS last_date,
+        array_agg(e.event_id ORDER BY e.date_start, e.event_id) AS event_ids,
+        array_agg(e.date_start ORDER BY e.date_start, e.event_id) AS dates,
+        array_agg(l.url ORDER BY e.date_start, e.event_id) AS links,
+        array_agg(e.price_min ORDER BY e.date_start, e.event_id) AS prices_min,
+        array_agg(e.price_max ORDER BY e.date_start, e.event_id) AS prices_max
+    FROM events e
+    JOIN venues v ON v.venue_id = e.venue_id
+    JOIN cities c ON c.city_id = v.city_id
+    JOIN countries co ON co.country_id = c.country_id
+    JOIN event_types et ON et.type_id = e.type_id
+    LEFT JOIN LATERAL (
+        SELECT url FROM event_links WHERE event_id = e.event_id ORDER BY link_id LIMIT 1
+    ) l ON true
+    WHERE e.date_start >= CURRENT_DATE OR e.date_start IS NULL
+    GROUP BY c.city_id, c.name, co.name, et.name, e.title, v.name
+    WITH DATA;
+    """,
+    # Уникальный индекс обязателен для REFRESH ... CONCURRENTLY
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS ux_afisha_event_groups
+    ON afisha_event_groups (city_id, category_name, title, venue_name);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_afisha_event_groups_listing
+    ON afisha_event_groups (city_name, category_name, first_date);
+    """,
+]
+
+SQL_REFRESH_AFISHA_EVENT_GROUPS = "REFRESH MATERIALIZED VIEW CONCURRENTLY afisha_event_groups;"
+
+# Описание витрины для запросов через SQLAlchemy. Отдельная MetaData,
+# чтобы create_all не пытался создать ее как обычную таблицу.
+afisha_event_groups = Table(
+    "afisha_event_groups", MetaData(),
+    Column("city_id", Integer),
+    Column("city_name", String(255)),
+    Column("country_name", String(255)),
+    Column("category_name", String(255)),
+    Column("title", String(500)),
+    Column("venue_name", String(500)),
+    Column("first_date", TIMESTAMP),
+    Column("last_date", TIMESTAMP),
+    Column("event_ids", ARRAY(Integer)),
+    Column("dates", ARRAY(TIMESTAMP)),
+    Column("links", ARRAY(String(1024))),
+    Column("prices_min", ARRAY(DECIMAL(10, 2))),
+    Column("prices_max", ARRAY(DECIMAL(10, 2))),
+)
+
+listener_engine = create_profile_engine("listener")
+
+
+# Индексы, которые заменены другими: {старый: новый}
+SUPERSEDED_INDEXES = {
+    "ix_events_title_date_start": "ux_events_identity",
+    "ix_event_links_event_id": "ux_event_links_event_id_url",
+    "ix_cities_name": "ux_cities_name_country_id",
+}
+
+
+# Слияние дублей событий: перед этими шагами заполняется временная таблица
+# event_identity_dups (dup_id, survivor_id, source, external_id). Ссылки, артисты и
+# подписки дублей переносятся на выжившее событие (повторы удаляются), ID источника
+# дубля переходит выжившему, если у того своего нет. Поисковые документы выживших
+# удаляются и пересобираются SQL_BACKFILL_EVENT_SEARCH при старте.
+# Избранное ссылается на артистов, а не на события, его переносить не нужно.
+SQL_MERGE_EVENT_IDENTITY_DUPS = [
+    """
+    DELETE FROM event_links l
+    USING (
+        SELECT el.link_id,
+               row_number() OVER (
+                   PARTITION BY COALESCE(d.survivor_id, el.event_id), el.url ORDER BY el.link_id
+               ) AS rn
+        FROM event_links el
+        LEFT JOIN event_identity_dups d ON d.dup_id = el.event_id
+        WHERE el.event_id IN (SELECT dup_id FROM event_identity_dups
+                              UNION SELECT survivor_id FROM event_identity_dups)
+    ) r
+    WHERE l.link_id = r.link_id AND r.rn > 1;
+    """,
+    """
+    UPDATE event_links l SET event_id = d.survivor_id
+    FROM event_identity_dups d
+    WHERE l.event_id = d.dup_id;
+    """,
+    """
+    DELETE FROM event_artists a
+    USING event_identity_dups d
+    WHERE a.event_id = d.dup_id
+      AND EXISTS (
+          SELECT 1 FROM event_artists o
+          LEFT JOIN event_identity_dups od ON od.dup_id = o.event_id
+          WHERE COALESCE(od.survivor_id, o.event_id) = d.survivor_id
+            AND o.artist_id = a.artist_id
+            AND (od.dup_id IS NULL OR od.dup_id < d.dup_id)
+      );
+    """,
+    """
+    UPDATE event_artists a SET event_id = d.survivor_id
+    FROM event_identity_dups d
+    WHERE a.event_id = d.dup_id;
+    """,
+    # Подписка пользователя на выжившее событие важнее подписки на дубль
+    """
+    DELETE FROM subscriptions sub
+    USING (
+        SELECT s.id,
+               row_number() OVER (
+                   PARTITION BY s.user_id, COALESCE(d.survivor_id, s.event_id)
+                   ORDER BY (d.dup_id IS NOT NULL), s.id
+               ) AS rn
+        FROM subscriptions s
+        LEFT JOIN event_identity_dups d ON d.dup_id = s.event_id
+        WHERE s.event_id IN (SELECT dup_id FROM event_identity_dups
+                             UNION SELECT survivor_id FROM event_identity_dups)
+    ) r
+    WHERE sub.id = r.id AND r.rn > 1;
+    """,
+    """
+    UPDATE subscriptions s SET event_id = d.survivor_id
+    FROM event_identity_dups d
+    WHERE s.event_id = d.dup_id;
+    """,
+    "DELETE FROM event_search WHERE event_id IN (SELECT survivor_id FROM event_identity_dups);",
+    "DELETE FROM events e USING event_identity_dups d WHERE e.event_id = d.dup_id;",
+    """
+    UPDATE events e
+    SET source = k.source, external_id = k.external_id
+    FROM (
+        SELECT DISTINCT ON (survivor_id) survivor_id, source, external_id
+        FROM event_identity_dups
+        WHERE source IS NOT NULL AND external_id IS NOT NULL
+        ORDER BY survivor_id, dup_id
+    ) k
+    WHERE e.event_id = k.survivor_id AND e.source IS NULL;
+    """,
+]
+
+
+# Подготовка данных перед созданием уникального индекса: {индекс: [SQL]}.
+# Выполняется только если индекса еще нет (или он INVALID после неудачной сборки).
+INDEX_DATA_MIGRATIONS = {
+    # Дубли городов (name, country_id) от параллельных запусков парсеров:
+    # остается город с наименьшим city_id, площадки переносятся на него
+    "ux_cities_name_country_id": [
+        """
+        CREATE TEMP TABLE city_dups ON COMMIT DROP AS
+        SELECT c.city_id AS dup_id, s.survivor_id
+        FROM cities c
+        JOIN (
+            SELECT name, country_id, min(city_id) AS survivor_id
+            FROM cities
+            GROUP BY name, country_id
+            HAVING count(*) > 1
+        ) s USING (name, country_id)
+        WHERE c.city_id <> s.survivor_id;
+        """,
+        "UPDATE venues v SET city_id = d.survivor_id FROM city_dups d WHERE v.city_id = d.dup_id;",
+        "DELETE FROM cities c USING city_dups d WHERE c.city_id = d.dup_id;",
+    ],
+    # Дубли площадок (name, city_id, country_id): остается площадка с наименьшим
+    # venue_id. События дублей, совпавшие с событием выжившей площадки по
+    # (title, date_start), сливаются как в ux_events_identity, остальные переносятся.
+    "ux_venues_name_city_id_country_id": [
+        """
+        CREATE TEMP TABLE venue_dups ON COMMIT DROP AS
+        SELECT v.venue_id AS dup_id, s.survivor_id
+        FROM venues v
+        JOIN (
+            SELECT name, city_id, country_id, min(venue_id) AS survivor_id
+            FROM venues
+            GROUP BY name, city_id, country_id
+            HAVING count(*) > 1
+        ) s USING (name, city_id, country_id)
+        WHERE v.venue_id <> s.survivor_id;
+        """,
+        """
+        CREATE TEMP TABLE event_identity_dups ON COMMIT DROP AS
+        WITH remapped AS (
+            SELECT e.event_id, e.title, e.date_start, e.source, e.external_id,
+                   COALESCE(vd.survivor_id, e.venue_id) AS target_venue_id
+            FROM events e
+            LEFT JOIN venue_dups vd ON vd.dup_id = e.venue_id
+            WHERE e.date_start IS NOT NULL
+        )
+        SELECT r.event_id AS dup_id, s.survivor_id, r.source, r.external_id
+        FROM remapped r
+        JOIN (
+            SELECT title, date_start, target_venue_id, min(event_id) AS survivor_id
+            FROM remapped
+            GROUP BY title, date_start, target_venue_id
+            HAVING count(*) > 1
+        ) s USING (title, date_start, target_venue_id)
+        WHERE r.event_id <> s.survivor_id;
+        """,
+        *SQL_MERGE_EVENT_IDENTITY_DUPS,
+        "UPDATE events e SET venue_id = d.survivor_id FROM venue_dups d WHERE e.venue_id = d.dup_id;",
+        # В архиве внешних ключей нет, но ID площадок в нем должны остаться живыми
+        "UPDATE events_archive e SET venue_id = d.survivor_id FROM venue_dups d WHERE e.venue_id = d.dup_id;",
+        "DELETE FROM venues v USING venue_dups d WHERE v.venue_id = d.dup_id;",
+    ],
+    # Дубли ссылок, накопившиеся до уникального индекса: остается самая ранняя
+    "ux_event_links_event_id_url": [
+        """
+        DELETE FROM event_links l
+        USING event_links d
+        WHERE l.event_id = d.event_id
+          AND l.url = d.url
+          AND l.link_id > d.link_id;
+        """,
+    ],
+    # Дубли событий (title, date_start, venue_id), которые мог создать старый
+    # поштучный импорт. Остается событие с наименьшим event_id.
+    "ux_events_identity": [
+        """
+        CREATE TEMP TABLE event_identity_dups ON COMMIT DROP AS
+        SELECT e.event_id AS dup_id, s.survivor_id, e.source, e.external_id
+        FROM events e
+        JOIN (
+            SELECT title, date_start, venue_id, min(event_id) AS survivor_id
+            FROM events
+            WHERE date_start IS NOT NULL
+            GROUP BY title, date_start, venue_id
+            HAVING count(*) > 1
+        ) s USING (title, date_start, venue_id)
+        WHERE e.event_id <> s.survivor_id;
+        """,
+        *SQL_MERGE_EVENT_IDENTITY_DUPS,
+    ],
+}
+
+
+async def ensure_indexes():
+    """
+    Создает объявленные в моделях индексы на уже существующей БД.
+    create_all() добавляет индексы только вместе с новыми таблицами, поэтому
+    здесь каждый индекс создается через CREATE INDEX CONCURRENTLY IF NOT EXISTS,
+    не блокируя запись в таблицу. Недостроенные (INVALID) индексы пересоздаются.
+    """
+    async with parser_engine.connect() as conn:
+        # CONCURRENTLY нельзя выполнять внутри транзакции
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        for table in Base.metadata.sorted_tables:
+            for index in sorted(table.indexes, key=lambda i: i.name):
+                try:
+                    is_valid = (await conn.execute(
+                        text(
+                            "SELECT i.indisvalid FROM pg_index i "
+                            "JOIN pg_class c ON c.oid = i.indexrelid "
+                            "WHERE c.relname = :name"
+                        ),
+                        {"name": index.name}
+                    )).scalar_one_or_none()
+                    if is_valid:
+                        continue
+                    if is_valid is False:
+                        print(f"-> Индекс {index.name} поврежден (INVALID), пересоздаю...")
+                        await conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"'))
+
+                    # Шаги подготовки данных — одной транзакцией: либо все, либо ничего
+                    if index.name in INDEX_DATA_MIGRATIONS:
+                        async with parser_engine.begin() as tx_conn:
+                            for statement in INDEX_DATA_MIGRATIONS[index.name]:
+                                result = await tx_conn.execute(text(statement))
+                                print(f"-> Подготовка данных для {index.name}: затронуто строк {result.rowcount}")
+
+                    ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=conn.dialect))
+                    ddl = re.sub(r'^CREATE (UNIQUE )?INDEX', r'CREATE \1INDEX CONCURRENTLY', ddl)
+                    await conn.execute(text(ddl))
+                    print(f"-> Создан индекс {index.name}")
+                except Exception as e:
+                    print(f"❌ Не удалось создать индекс {index.name}: {e}")
+
+        # Старые индексы удаляются только после того, как замена построена
+        for old_name, new_name in SUPERSEDED_INDEXES.items():
+            try:
+                replacement_valid = (await conn.execute(
+                    text(
+                        "SELECT i.indisvalid FROM pg_index i "
+                        "JOIN pg_class c ON c.oid = i.indexrelid "
+                        "WHERE c.relname = :name"
+                    ),
+                    {"name": new_name}
+                )).scalar_one_or_none()
+                if replacement_valid:
+                    await conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{old_name}"'))
+            except Exception as e:
+                print(f"❌ Не удалось удалить устаревший индекс {old_name}: {e}")
 
 
 
@@ -228,15 +963,36 @@ listener_engine = create_async_engine(url=SQL_ALCHEMY, poolclass=NullPool)
 async def async_main():
     print("Инициализация базы данных: проверка и создание таблиц...")
     # Шаг 1: Создание/проверка таблиц. Этот блок у вас был правильным.
-    async with engine.begin() as conn:
+    async with parser_engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
     print("Таблицы успешно созданы или уже существуют.")
 
+    # Шаг 1.01: Новые колонки в уже существующих таблицах
+    async with parser_engine.begin() as conn:
+        for statement in SQL_ADD_EVENT_COLUMNS:
+            await conn.execute(text(statement))
+
+    # Шаг 1.05: Индексы из моделей для таблиц, созданных раньше, чем индексы
+    print("\nПроверка индексов...")
+    await ensure_indexes()
+    print("Индексы проверены.")
+
+    # Шаг 1.1: Расширение pg_trgm и триграммные индексы для нечеткого поиска
+    print("\nПроверка расширения pg_trgm и триграммных индексов...")
+    try:
+        async with parser_engine.begin() as conn:
+            await conn.execute(text(SQL_CREATE_TRGM_EXTENSION))
+            for statement in SQL_CREATE_TRGM_INDEXES:
+                await conn.execute(text(statement))
+        print("-> pg_trgm и триграммные индексы готовы.")
+    except Exception as e:
+        print(f"❌ Не удалось подготовить pg_trgm (бэкенд поиска: {FUZZY_SEARCH_BACKEND}): {e}")
+
     # Шаг 2: Создание/обновление функций и триггеров в одной атомарной транзакции.
     print("\nПроверка и создание функций и триггеров...")
     try:
         # ## Правильный способ: используем engine.begin() для управления транзакцией ##
-        async with engine.connect() as conn:
+        async with parser_engine.begin() as conn:
             print(" -> Транзакция для создания триггеров начата.")
             await conn.execute(text("DROP TRIGGER IF EXISTS new_event_trigger ON event_artists;"))
             # --- Триггер для событий ---
@@ -244,6 +1000,20 @@ async def async_main():
             await conn.execute(text(SQL_CREATE_TRIGGER_FUNCTION))
             await conn.execute(text(SQL_CREATE_TRIGGER))
             print("-> Триггер для 'events' успешно обновлен.")
+            # --- Триггеры поисковых документов ---
+            print("-> Обновление триггеров для 'event_search'...")
+            for statement in SQL_CREATE_EVENT_SEARCH_FUNCTIONS:
+                await conn.execute(text(statement))
+            for statement in SQL_CREATE_EVENT_SEARCH_TRIGGERS:
+                await conn.execute(text(statement))
+            await conn.execute(text(SQL_BACKFILL_EVENT_SEARCH))
+            print("-> Триггеры для 'event_search' успешно обновлены.")
+            # --- Счетчики избранного и подписок ---
+            print("-> Обновление счетчиков в 'users'...")
+            for statement in SQL_CREATE_USER_COUNTERS:
+                await conn.execute(text(statement))
+            await conn.execute(text(SQL_BACKFILL_USER_COUNTERS))
+            print("-> Счетчики в 'users' успешно обновлены.")
 
         
         # COMMIT будет вызван здесь автоматически при выходе из блока "with"
@@ -251,4 +1021,17 @@ async def async_main():
 
     except Exception as e:
         # ROLLBACK будет вызван здесь автоматически, если в блоке "with" произойдет ошибка
-        print(f"❌ Произошла ошибка во время транзакции, все изменения отменены: {e}")
\ No newline at end of file
+        print(f"❌ Произошла ошибка во время транзакции, все изменения отменены: {e}")
+
+    # Шаг 3: Витрина афиши
+    print("\nПроверка витрины афиши...")
+    try:
+        async with parser_engine.begin() as conn:
+            for statement in SQL_CREATE_AFISHA_EVENT_GROUPS:
+                await conn.execute(text(statement))
+        print("-> Витрина afisha_event_groups готова.")
+    except Exception as e:
+        print(f"❌ Не удалось создать витрину афиши: {e}")
+
+    # Служебные соединения больше не нужны: бот дальше работает через свой пул
+    await parser_engine.dispose()
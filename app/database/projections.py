@@ -0,0 +1,33 @@
+# app/database/projections.py
+#
+# Легкие объекты для отрисовки списков событий в хендлерах.
+# Запросы выбирают только нужные колонки и сразу собирают из них эти объекты:
+# без ORM-графа (venue -> city -> country, links, artists), без лишней гидрации
+# и без риска ленивой загрузки после закрытия сессии.
+
+from dataclasses import dataclass
+from datetime import datetime
+
+
+@dataclass(slots=True, frozen=True)
+class EventCard:
+    """Карточка события для форматеров из app/utils/utils.py."""
+    event_id: int
+    title: str
+    date_start: datetime | None
+    venue_name: str | None
+    city_name: str | None
+    country_name: str | None
+    tickets_info: str | None
+    # Первая ссылка на билеты (по link_id)
+    url: str | None
+    artist_names: tuple[str, ...] = ()
+
+
+@dataclass(slots=True, frozen=True)
+class SubscriptionItem:
+    """Строка списка подписок пользователя: событие и статус именно его подписки."""
+    event_id: int
+    title: str
+    date_start: datetime | None
+    status: str
@@ -0,0 +1,257 @@
+# app/database/query_stats.py
+#
+# Инструментирование SQL-запросов.
+# Хуки движков (before/after_cursor_execute) замеряют каждый запрос и складывают
+# статистику по паре (тег, отпечаток запроса): количество, время, строки, гистограмма.
+# Тег — хендлер aiogram или этап парсера, задается через contextvar query_tag
+# (см. tag_queries и app/middlewares.py). Запросы дольше SQL_SLOW_QUERY_MS
+# пишутся в лог и в кольцевой буфер медленных запросов.
+#
+# Статистика живет в памяти процесса. Бот и парсер периодически публикуют снимок
+# в Redis, а посмотреть его можно командой:
+#   python -m app.database.query_stats [--top N] [--reset]
+
+import argparse
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from sqlalchemy import event
+
+from app.services.profile_cache import REDIS_URL
+
+SQL_STATS_ENABLED = os.getenv("SQL_STATS_ENABLED", "1").strip().lower() in ("1", "true", "yes", "on")
+# Порог медленного запроса, мс
+SQL_SLOW_QUERY_MS = float(os.getenv("SQL_SLOW_QUERY_MS", 500))
+# Сколько последних медленных запросов хранить
+SQL_SLOW_LOG_SIZE = int(os.getenv("SQL_SLOW_LOG_SIZE", 200))
+# Снимки в Redis живут сутки: статистика остановленного процесса не висит вечно
+SNAPSHOT_TTL = 24 * 3600
+SNAPSHOT_KEY_PREFIX = "sql_stats:"
+
+# Верхние границы корзин гистограммы, мс; последняя корзина — все, что дольше
+HISTOGRAM_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+query_tag: contextvars.ContextVar[str] = contextvars.ContextVar("query_tag", default="untagged")
+
+
+@contextmanager
+def tag_queries(tag: str):
+    """Помечает все запросы внутри блока тегом (этап парсера, фоновая задача и т.п.)."""
+    token = query_tag.set(tag)
+    try:
+        yield
+    finally:
+        query_tag.reset(token)
+
+
+class QueryStat:
+    __slots__ = ("count", "total_ms", "max_ms", "rows", "buckets", "statement")
+
+    def __init__(self, statement: str):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+        self.statement = statement
+
+    def add(self, elapsed_ms: float, rows: int):
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.rows += max(rows, 0)
+        self.buckets[bisect_left(HISTOGRAM_BUCKETS_MS, elapsed_ms)] += 1
+
+
+# (тег, отпечаток) -> QueryStat
+_stats: dict[tuple[str, str], QueryStat] = {}
+_slow_log: deque = deque(maxlen=SQL_SLOW_LOG_SIZE)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![\w$])-?\d+(?:\.\d+)?\b")
+_PARAMETER = re.compile(r"\$\d+|%\(\w+\)s|(?<![:\w]):\w+")
+_PARAMETER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint(statement: str) -> str:
+    """
+    Нормализует запрос: литералы и параметры -> ?, списки (?, ?, ...) и
+    многострочные VALUES -> (...), пробелы схлопываются. Запросы, отличающиеся
+    только значениями или размером батча, получают один отпечаток.
+    """
+    normalized = _STRING_LITERAL.sub("?", statement)
+    normalized = _PARAMETER.sub("?", normalized)
+    normalized = _NUMBER_LITERAL.sub("?", normalized)
+    normalized = _PARAMETER_LIST.sub("(...)", normalized)
+    return _WHITESPACE.sub(" ", normalized).strip()
+
+
+def record(tag: str, statement: str, elapsed_ms: float, rows: int, engine_name: str = None):
+    normalized = fingerprint(statement)
+    key = (tag, hashlib.md5(normalized.encode()).hexdigest()[:12])
+    stat = _stats.get(key)
+    if stat is None:
+        stat = _stats[key] = QueryStat(normalized)
+    stat.add(elapsed_ms, rows)
+
+    if elapsed_ms >= SQL_SLOW_QUERY_MS:
+        _slow_log.append({
+            "at": datetime.now().isoformat(timespec="seconds"),
+            "tag": tag,
+            "engine": engine_name,
+            "elapsed_ms": round(elapsed_ms, 1),
+            "rows": rows,
+            "statement": normalized[:1000],
+        })
+        logging.warning(f"Медленный запрос {elapsed_ms:.0f} мс [{tag}, {engine_name}]: {normalized[:300]}")
+
+
+def instrument_engine(async_engine, name: str):
+    """Вешает хуки замера на AsyncEngine (события слушаются на его sync_engine)."""
+    if not SQL_STATS_ENABLED:
+        return
+
+    sync_engine = async_engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # Время старта храним в контексте выполнения: при ошибке запроса он просто
+        # выбрасывается вместе с контекстом, ничего не копится
+        if context is not None:
+            context._query_stats_started = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_query_stats_started", None)
+        if started is None:
+            return
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        rows = getattr(cursor, "rowcount", -1)
+        record(query_tag.get(), statement, elapsed_ms, rows if isinstance(rows, int) else -1, name)
+
+
+def _estimate_percentile(buckets: list[int], count: int, percentile: float) -> str:
+    """Верхняя граница корзины, в которую попадает перцентиль (гистограмма не хранит точных значений)."""
+    threshold = count * percentile
+    seen = 0
+    for index, bucket_count in enumerate(buckets):
+        seen += bucket_count
+        if seen >= threshold:
+            if index < len(HISTOGRAM_BUCKETS_MS):
+                return f"≤{HISTOGRAM_BUCKETS_MS[index]}"
+            return f">{HISTOGRAM_BUCKETS_MS[-1]}"
+    return "-"
+
+
+def snapshot(process_name: str) -> dict:
+    return {
+        "process": process_name,
+        "generated_at": datetime.now().isoformat(timespec="seconds"),
+        "slow_query_ms": SQL_SLOW_QUERY_MS,
+        "buckets_ms": list(HISTOGRAM_BUCKETS_MS),
+        "stats": [
+            {
+                "tag": tag,
+                "fingerprint": key,
+                "count": stat.count,
+                "total_ms": round(stat.total_ms, 1),
+                "max_ms": round(stat.max_ms, 1),
+                "rows": stat.rows,
+                "buckets": stat.buckets,
+                "statement": stat.statement,
+            }
+            for (tag, key), stat in _stats.items()
+        ],
+        "slow": list(_slow_log),
+    }
+
+
+def format_report(data: dict, top: int = 30) -> str:
+    """Текстовый отчет по снимку: запросы по суммарному времени, сводка по тегам, медленные запросы."""
+    lines = [f"=== {data['process']} (снимок {data['generated_at']}) ==="]
+    stats = sorted(data["stats"], key=lambda s: s["total_ms"], reverse=True)
+
+    by_tag = {}
+    for stat in stats:
+        tag_total = by_tag.setdefault(stat["tag"], [0, 0.0])
+        tag_total[0] += stat["count"]
+        tag_total[1] += stat["total_ms"]
+    lines.append("\n--- По тегам (хендлер / этап) ---")
+    for tag, (count, total_ms) in sorted(by_tag.items(), key=lambda item: item[1][1], reverse=True):
+        lines.append(f"{total_ms:>10.1f} мс  {count:>7} запр.  {tag}")
+
+    bucket_names = [f"≤{b}" for b in data["buckets_ms"]] + [f">{data['buckets_ms'][-1]}"]
+    lines.append(f"\n--- Топ-{top} запросов по суммарному времени ---")
+    for stat in stats[:top]:
+        count = stat["count"]
+        histogram = " ".join(
+            f"{name}:{bucket_count}" for name, bucket_count in zip(bucket_names, stat["buckets"]) if bucket_count
+        )
+        lines.append(
+            f"[{stat['tag']}] {stat['fingerprint']} count={count} total={stat['total_ms']:.1f}мс "
+            f"avg={stat['total_ms'] / count:.1f}мс p50{_estimate_percentile(stat['buckets'], count, 0.5)} "
+            f"p95{_estimate_percentile(stat['buckets'], count, 0.95)} max={stat['max_ms']:.1f}мс rows={stat['rows']}"
+        )
+        lines.append(f"    гистограмма (мс): {histogram}")
+        lines.append(f"    {stat['statement'][:300]}")
+
+    lines.append(f"\n--- Медленные запросы (≥{data['slow_query_ms']:.0f} мс), последние {len(data['slow'])} ---")
+    for slow in data["slow"]:
+        lines.append(f"{slow['at']} {slow['elapsed_ms']:>8.1f} мс [{slow['tag']}, {slow['engine']}] {slow['statement'][:300]}")
+    return "\n".join(lines)
+
+
+async def publish(process_name: str):
+    """Кладет снимок статистики процесса в Redis, откуда его читает команда дампа."""
+    if not SQL_STATS_ENABLED:
+        return
+    redis = Redis.from_url(REDIS_URL, socket_timeout=2, socket_connect_timeout=2)
+    try:
+        await redis.set(
+            f"{SNAPSHOT_KEY_PREFIX}{process_name}",
+            json.dumps(snapshot(process_name), ensure_ascii=False),
+            ex=SNAPSHOT_TTL,
+        )
+    except RedisError as e:
+        logging.warning(f"Не удалось опубликовать статистику SQL: {e}")
+    finally:
+        await redis.aclose()
+
+
+async def _dump(top: int, reset_snapshots: bool):
+    redis = Redis.from_url(REDIS_URL, decode_responses=True)
+    try:
+        keys = sorted([key async for key in redis.scan_iter(f"{SNAPSHOT_KEY_PREFIX}*")])
+        if not keys:
+            print("Снимков статистики SQL нет: бот или парсер еще не публиковали их.")
+        for key in keys:
+            raw = await redis.get(key)
+            if raw:
+                print(format_report(json.loads(raw), top))
+                print()
+        if reset_snapshots and keys:
+            await redis.delete(*keys)
+            print("Снимки удалены.")
+    finally:
+        await redis.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Дамп статистики SQL-запросов бота и парсеров")
+    parser.add_argument("--top", type=int, default=30, help="сколько запросов показать в топе")
+    parser.add_argument("--reset", action="store_true", help="удалить снимки после вывода")
+    args = parser.parse_args()
+    asyncio.run(_dump(args.top, args.reset))
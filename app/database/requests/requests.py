@@ -1,18 +1,39 @@
 # app/database/requests.py
 
+import hashlib
+import json
 import logging
-from sqlalchemy import select, delete, and_, or_, func, distinct, union, update
+import re
+from sqlalchemy import (
+    select, delete, and_, or_, func, distinct, union, update, literal, column, true, tuple_,
+    Integer, Numeric, String, TIMESTAMP
+)
 from sqlalchemy.orm import selectinload, joinedload,undefer
-from sqlalchemy.dialects.postgresql import aggregate_order_by, array_agg
-from thefuzz import process as fuzzy_process, fuzz
+from sqlalchemy.dialects.postgresql import aggregate_order_by, array_agg, ARRAY, insert as pg_insert
+from thefuzz import process as fuzzy_process
 from datetime import datetime
+from decimal import Decimal
 
 from ..models import (
     UserFavorite, async_session, User, Subscription, Event, Artist, Venue, EventLink,
-    EventType, EventArtist, Country, City
+    EventType, EventArtist, Country, City, EventSearch, FUZZY_SEARCH_BACKEND, afisha_event_groups,
+    read_session, mark_user_write
 )
+from ..projections import EventCard, SubscriptionItem
+from . import requests_trgm
+from app.services.artist_index import artist_index
+from app.services import profile_cache
 
 SIMILARITY_THRESHOLD = 85
+# Сколько сигнатур (title, date_start) сверяется с БД одним запросом
+SIGNATURES_CHUNK_SIZE = 5000
+# Сколько групп событий одной категории показывается на странице афиши
+AFISHA_PAGE_SIZE = 20
+
+
+def _normalize_search_text(value: str) -> str:
+    """Та же нормализация, что и event_search_normalize() в БД."""
+    return re.sub(r'[\W_]+', ' ', (value or '').lower()).strip()
 
 
 async def get_or_create(session, model, **kwargs):
@@ -34,21 +55,52 @@ async def get_or_create_user(session, user_id: int, username: str = None, lang_c
         session.add(user)
         await session.commit()
         await session.refresh(user)
+        await _user_changed(user_id)
     elif not user.language_code or user.language_code != lang_code:
         user.language_code = lang_code
         await session.commit()
+        await _user_changed(user_id)
     return user
 
-async def get_user_lang(user_id):
-    async with async_session() as session:
+async def _user_changed(user_id: int):
+    """
+    Вызывается после любой записи пользователя: сбрасывает кэш профиля и на время
+    REPLICA_STALENESS_SECONDS переводит его чтения на основную базу.
+    """
+    mark_user_write(user_id)
+    await profile_cache.invalidate(user_id)
+
+
+async def _get_user_profile(user_id: int) -> dict | None:
+    """
+    Профиль пользователя для частых проверок в хендлерах (язык, гео, счетчики для лимитов).
+    Сначала читается из Redis; при промахе — чтение одной строки users, результат кладется в кэш.
+    Кэш сбрасывается функциями, которые меняют пользователя, его избранное или подписки.
+    """
+    profile = await profile_cache.get_profile(user_id)
+    if profile is not None:
+        return profile
+
+    async with read_session(user_id) as session:
         result = await session.execute(
-            select(User.language_code)
+            select(
+                User.language_code, User.home_country, User.home_city, User.preferred_event_types,
+                User.main_geo_completed, User.general_geo_completed, User.general_mobility_regions,
+                User.favorites_count, User.subscriptions_count
+            )
             .where(User.user_id == user_id)
         )
-        prefs = result.first()
-        if prefs:
-            return prefs.language_code
+        row = result.first()
+
+    if not row:
         return None
+    profile = dict(row._mapping)
+    await profile_cache.set_profile(user_id, profile)
+    return profile
+
+async def get_user_lang(user_id):
+    profile = await _get_user_profile(user_id)
+    return profile["language_code"] if profile else None
 
 async def update_user_preferences(user_id: int, home_country: str, home_city: str, event_types: list, main_geo_completed: bool):
     # ... (код без изменений)
@@ -66,25 +118,21 @@ async def update_user_preferences(user_id: int, home_country: str, home_city: st
         )
         await session.execute(stmt)
         await session.commit()
+    await _user_changed(user_id)
 
 async def get_user_preferences(user_id: int) -> dict | None:
-    async with async_session() as session:
-        result = await session.execute(
-            select(User.home_city, User.preferred_event_types, User.home_country)
-            .where(User.user_id == user_id)
-        )
-        prefs = result.first()
-        if prefs:
-            return {
-                "home_country": prefs.home_country,
-                "home_city": prefs.home_city,
-                "preferred_event_types": prefs.preferred_event_types
-            }
-        return None
+    profile = await _get_user_profile(user_id)
+    if profile:
+        return {
+            "home_country": profile["home_country"],
+            "home_city": profile["home_city"],
+            "preferred_event_types": profile["preferred_event_types"]
+        }
+    return None
 
 async def get_user_favorites(user_id: int) -> list[Artist]:
     """Получает список всех "Объектов интереса" (Артистов) из избранного пользователя."""
-    async with async_session() as session:
+    async with read_session(user_id) as session:
         # ИЗМЕНЕНИЕ: Используем явное условие для JOIN
         stmt = (
             select(Artist)
@@ -111,6 +159,12 @@ async def add_artist_to_favorites(session,user_id: int, artist_id: int, regions:
     else:
         # Если уже есть - просто обновляем регионы
         existing.regions = regions  
+    # Коммитит вызывающий; после commit он должен вызвать user_changed(user_id),
+    # иначе кэш профиля может заново заполниться старым счетчиком избранного
+
+async def user_changed(user_id: int):
+    """_user_changed для хендлеров, которые сами коммитят сессию: вызывать после commit."""
+    await _user_changed(user_id)
 
 async def remove_artist_from_favorites(user_id: int, artist_id: int):
     """
@@ -139,18 +193,17 @@ async def remove_artist_from_favorites(user_id: int, artist_id: int):
         )
         await session.execute(delete_fav_stmt)
         await session.commit()
+    await _user_changed(user_id)
 
 async def check_main_geo_status(user_id: int) -> bool:
     """Проверяет, проходил ли пользователь ОСНОВНОЙ онбординг (для Афиши)."""
-    async with async_session() as session:
-        result = await session.execute(select(User.main_geo_completed).where(User.user_id == user_id))
-        return result.scalar_one_or_none() or False
+    profile = await _get_user_profile(user_id)
+    return bool(profile and profile["main_geo_completed"])
 
 async def check_general_geo_onboarding_status(user_id: int) -> bool:
     """Проверяет, проходил ли пользователь онбординг ОБЩЕЙ мобильности (для Подписок)."""
-    async with async_session() as session:
-        result = await session.execute(select(User.general_geo_completed).where(User.user_id == user_id))
-        return result.scalar_one_or_none() or False
+    profile = await _get_user_profile(user_id)
+    return bool(profile and profile["general_geo_completed"])
 
 async def set_general_geo_onboarding_completed(user_id: int):
     """Отмечает, что пользователь прошел онбординг ОБЩЕЙ мобильности."""
@@ -159,14 +212,13 @@ async def set_general_geo_onboarding_completed(user_id: int):
         if user:
             user.general_geo_completed = True
             await session.commit()
+    await _user_changed(user_id)
 
 async def get_general_mobility(user_id: int) -> list | None:
     """Получает список регионов из общей мобильности пользователя (из поля User.general_mobility_regions)."""
-    async with async_session() as session:
-        stmt = select(User.general_mobility_regions).where(User.user_id == user_id)
-        result = await session.execute(stmt)
-        regions_data = result.scalar_one_or_none()
-        return regions_data if regions_data else None
+    profile = await _get_user_profile(user_id)
+    regions_data = profile["general_mobility_regions"] if profile else None
+    return regions_data if regions_data else None
 
 async def set_general_mobility(user_id: int, regions: list):
     """Устанавливает или обновляет список регионов общей мобильности для пользователя."""
@@ -175,10 +227,11 @@ async def set_general_mobility(user_id: int, regions: list):
         if user:
             user.general_mobility_regions = regions
             await session.commit()
+    await _user_changed(user_id)
 
 async def get_user_subscriptions(user_id: int) -> list[Event]:
     """ИЗМЕНЕНИЕ: Получает список всех СОБЫТИЙ, на которые подписан пользователь."""
-    async with async_session() as session:
+    async with read_session(user_id) as session:
         stmt = (
             select(Event)
             .join(Subscription)
@@ -192,6 +245,21 @@ async def get_user_subscriptions(user_id: int) -> list[Event]:
         result = await session.execute(stmt)
         return result.scalars().unique().all()
 
+async def get_user_subscription_items(user_id: int) -> list[SubscriptionItem]:
+    """
+    Список подписок пользователя для клавиатуры: только название, дата и статус его подписки.
+    Легкая замена get_user_subscriptions без загрузки событий с площадками и чужими подписками.
+    """
+    async with read_session(user_id) as session:
+        stmt = (
+            select(Event.event_id, Event.title, Event.date_start, Subscription.status)
+            .join(Subscription, Subscription.event_id == Event.event_id)
+            .where(Subscription.user_id == user_id)
+            .order_by(Event.date_start)
+        )
+        result = await session.execute(stmt)
+        return [SubscriptionItem(*row) for row in result.all()]
+
 async def add_events_to_subscriptions_bulk(user_id: int, event_ids: list[int]):
     """ИЗМЕНЕНИЕ: Массово добавляет подписки на СОБЫТИЯ по их ID."""
     if not event_ids:
@@ -211,6 +279,7 @@ async def add_events_to_subscriptions_bulk(user_id: int, event_ids: list[int]):
         if new_subs_to_add:
             session.add_all(new_subs_to_add)
             await session.commit()
+            await _user_changed(user_id)
 
 async def remove_subscription(user_id: int, event_id: int, reason: str = None):
     """ИЗМЕНЕНИЕ: Удаляет подписку на конкретное СОБЫТИЕ по event_id."""
@@ -221,6 +290,7 @@ async def remove_subscription(user_id: int, event_id: int, reason: str = None):
         )
         await session.execute(stmt)
         await session.commit()
+        await _user_changed(user_id)
 
 async def set_subscription_status(user_id: int, event_id: int, status: str):
     """НОВАЯ ФУНКЦИЯ: Устанавливает статус подписки (active/paused)."""
@@ -232,45 +302,54 @@ async def set_subscription_status(user_id: int, event_id: int, status: str):
         )
         await session.execute(stmt)
         await session.commit()
+        mark_user_write(user_id)
 
 async def find_artists_fuzzy(query: str, limit: int = 5) -> tuple[list[Artist], bool]:
     """
-    Ищет артистов по имени.
+    Ищет артистов по имени: через pg_trgm (FUZZY_SEARCH_BACKEND='pg_trgm')
+    или через процессный индекс (app/services/artist_index.py).
 
     Возвращает:
         Кортеж: (список объектов Artist, флаг точного совпадения).
     """
-    async with async_session() as session:
-        result = await session.execute(select(Artist))
-        all_artists = result.scalars().all()
-        artist_map = {artist.name: artist for artist in all_artists}
-        
-        # Находим лучшие совпадения
-        found_tuples = fuzzy_process.extract(query, artist_map.keys(), limit=limit)
-        
-        # Фильтруем по порогу схожести
-        matches_with_scores = [
-            (artist_map[artist_name], score) 
-            for artist_name, score in found_tuples 
-            if score >= SIMILARITY_THRESHOLD
-        ]
-        
-        if not matches_with_scores:
-            return [], False
+    if FUZZY_SEARCH_BACKEND == 'pg_trgm':
+        found = await requests_trgm.find_artists_trgm(query, limit, SIMILARITY_THRESHOLD)
+        matches_with_scores = [(artist.artist_id, score) for artist, score in found]
+        artists_by_id = {artist.artist_id: artist for artist, _ in found}
+    else:
+        if not artist_index.is_loaded:
+            await artist_index.load()
+        # Индекс сразу отсекает всё, что ниже порога, и возвращает только ID
+        matches_with_scores = artist_index.search(query, limit=limit, score_cutoff=SIMILARITY_THRESHOLD)
+        artists_by_id = None
 
-        # --- ИСПРАВЛЕНИЕ: Более надежная проверка на точное совпадение ---
-        # Мы считаем совпадение точным, если оценка 99 или 100.
-        # Это защищает от мелких причуд библиотеки.
-        is_exact_match = any(score >= 99 for _, score in matches_with_scores)
-        
-        # Отделяем только объекты артистов для возврата
-        final_matches = [artist for artist, score in matches_with_scores]
-        
-        return final_matches, is_exact_match
+    if not matches_with_scores:
+        return [], False
+
+    # --- ИСПРАВЛЕНИЕ: Более надежная проверка на точное совпадение ---
+    # Мы считаем совпадение точным, если оценка 99 или 100.
+    # Это защищает от мелких причуд библиотеки.
+    is_exact_match = any(score >= 99 for _, score in matches_with_scores)
+
+    matched_ids = [artist_id for artist_id, _ in matches_with_scores]
+    if artists_by_id is None:
+        # Догружаем из БД только найденных артистов, сохраняя порядок по схожести
+        async with read_session() as session:
+            result = await session.execute(select(Artist).where(Artist.artist_id.in_(matched_ids)))
+            artists_by_id = {artist.artist_id: artist for artist in result.scalars().all()}
+
+    final_matches = [artists_by_id[artist_id] for artist_id in matched_ids if artist_id in artists_by_id]
+    if not final_matches:
+        return [], False
+
+    return final_matches, is_exact_match
 
 async def find_countries_fuzzy(query: str, limit: int = 5) -> list[str]:
     """Нечеткий поиск стран по названию."""
-    async with async_session() as session:
+    if FUZZY_SEARCH_BACKEND == 'pg_trgm':
+        return await requests_trgm.find_countries_trgm(query, limit, SIMILARITY_THRESHOLD)
+
+    async with read_session() as session:
         result = await session.execute(select(Country.name))
         all_countries = result.scalars().all()
         if not all_countries:
@@ -284,7 +363,7 @@ async def get_countries(home_country_selection: bool = False):
     if home_country_selection:
         return ["Беларусь", "Россия"]
 
-    async with async_session() as session:
+    async with read_session() as session:
         result = await session.execute(select(Country.name).order_by(Country.name))
         return result.scalars().all()
 
@@ -294,7 +373,7 @@ async def get_top_cities_for_country(country_name: str, limit: int = 6):
         return ["Минск", "Брест", "Витебск", "Гомель", "Гродно", "Могилев"]
 
     # --- СТАРАЯ ЛОГИКА ДЛЯ ВСЕХ ОСТАЛЬНЫХ СТРАН ---
-    async with async_session() as session:
+    async with read_session() as session:
         result = await session.execute(
             select(City.name)
             .join(Country)
@@ -305,7 +384,10 @@ async def get_top_cities_for_country(country_name: str, limit: int = 6):
         return result.scalars().all()
 
 async def find_cities_fuzzy(country_name: str, query: str, limit: int = 3):
-    async with async_session() as session:
+    if FUZZY_SEARCH_BACKEND == 'pg_trgm':
+        return await requests_trgm.find_cities_trgm(country_name, query, limit, SIMILARITY_THRESHOLD)
+
+    async with read_session() as session:
         result = await session.execute(
             select(City.name).join(Country).where(Country.name == country_name)
         )
@@ -325,7 +407,7 @@ async def find_events_fuzzy(
     """
     Нечеткий поиск событий с фильтрацией по региону и дате.
     """
-    async with async_session() as session:
+    async with read_session() as session:
         # --- Собираем условия для фильтрации ---
         date_conditions = []
         if date_from:
@@ -373,36 +455,49 @@ async def find_events_fuzzy(
         if events:
             return events
 
-        # --- Этап 2: Медленный, но полный нечеткий поиск (если быстрый не сработал) ---
-        all_events_stmt = (
+        # --- Этап 2: Нечеткий поиск по поисковым документам (event_search) ---
+        # Один индексированный запрос: триграммы (%>) + полнотекстовый индекс,
+        # в ответ приходят только ранжированные event_id.
+        normalized_query = _normalize_search_text(query)
+        if not normalized_query:
+            return []
+
+        # Порог для оператора %> совпадает по смыслу с partial_ratio >= SIMILARITY_THRESHOLD
+        await session.execute(
+            select(func.set_config('pg_trgm.word_similarity_threshold', str(SIMILARITY_THRESHOLD / 100), True))
+        )
+        score = func.word_similarity(normalized_query, EventSearch.document).label("score")
+        ranked_stmt = (
+            select(EventSearch.event_id, score)
+            .join(Event, Event.event_id == EventSearch.event_id)
+            .where(or_(
+                EventSearch.document.op('%>')(normalized_query),
+                EventSearch.document_tsv.op('@@')(func.plainto_tsquery('simple', normalized_query))
+            ))
+        )
+
+        # Применяем фильтры к ранжированному списку
+        if region_conditions:
+            ranked_stmt = ranked_stmt.join(Event.venue).join(Venue.city).join(City.country).where(*region_conditions)
+        if date_conditions:
+            ranked_stmt = ranked_stmt.where(*date_conditions)
+        ranked_stmt = ranked_stmt.order_by(score.desc())
+
+        ranked_ids = (await session.execute(ranked_stmt)).scalars().all()
+        if not ranked_ids:
+            return []
+
+        events_stmt = (
             select(Event)
             .options(
                 selectinload(Event.venue).selectinload(Venue.city).selectinload(City.country),
                 selectinload(Event.links),
                 selectinload(Event.artists).selectinload(EventArtist.artist)
             )
+            .where(Event.event_id.in_(ranked_ids))
         )
-        
-        # Применяем фильтры к полному списку событий
-        if region_conditions:
-            all_events_stmt = all_events_stmt.join(Event.venue).join(Venue.city).join(City.country).where(*region_conditions)
-        if date_conditions:
-            all_events_stmt = all_events_stmt.where(*date_conditions)
-            
-        all_events_result = await session.execute(all_events_stmt)
-        all_events = all_events_result.scalars().unique().all()
-
-        matches = []
-        search_query_lower = query.lower()
-        for event in all_events:
-            title_score = fuzz.partial_ratio(search_query_lower, event.title.lower())
-            artist_scores = [fuzz.partial_ratio(search_query_lower, ea.artist.name.lower()) for ea in event.artists]
-            max_score = max([title_score] + artist_scores) if artist_scores else title_score
-            if max_score >= SIMILARITY_THRESHOLD:
-                matches.append((event, max_score))
-        
-        matches.sort(key=lambda x: x[1], reverse=True)
-        return [match[0] for match in matches]
+        events_by_id = {event.event_id: event for event in (await session.execute(events_stmt)).scalars().all()}
+        return [events_by_id[event_id] for event_id in ranked_ids if event_id in events_by_id]
 
 async def get_events_for_artists(artist_names: list[str], regions: list[str]) -> list[Event]:
     """
@@ -411,7 +506,7 @@ async def get_events_for_artists(artist_names: list[str], regions: list[str]) ->
     if not artist_names or not regions:
         return []
 
-    async with async_session() as session:
+    async with read_session() as session:
         today = datetime.now()
         stmt = (
             select(Event)
@@ -443,7 +538,7 @@ async def get_events_for_artists(artist_names: list[str], regions: list[str]) ->
         return result.scalars().all()
 
 async def get_cities_for_category(category_name: str, user_regions: list):
-    async with async_session() as session:
+    async with read_session() as session:
         stmt = (
             select(distinct(City.name))
             .join(Venue, City.city_id == Venue.city_id)
@@ -470,57 +565,139 @@ async def get_grouped_events_by_city_and_category(
     Получает сгруппированные события с фильтрацией по дате.
     Возвращает event_id и category_name.
     """
-    async with async_session() as session:
-        # Основа запроса
-        stmt = (
-            select(
-                (func.array_agg(aggregate_order_by(Event.event_id, Event.date_start.asc())))[1].label("event_id"),
-                Event.title,
-                EventType.name.label("category_name"),
-                Venue.name.label("venue_name"),
-                array_agg(aggregate_order_by(Event.date_start, Event.date_start.asc())).label("dates"),
-                array_agg(aggregate_order_by(EventLink.url, Event.date_start.asc())).label("links"),
-                func.min(Event.price_min).label("min_price"),
-                func.max(Event.price_max).label("max_price")
-            )
-            .join(Venue, Event.venue_id == Venue.venue_id)
-            .join(City, Venue.city_id == City.city_id)
-            .join(EventType, Event.type_id == EventType.type_id)
-            .outerjoin(EventLink, Event.event_id == EventLink.event_id)
-        )
+    events_by_category, _ = await get_grouped_events_by_city_and_categories(city_name, [category], date_from, date_to)
+    return events_by_category.get(category, [])
 
-        # Формируем условия фильтрации (WHERE)
-        today = datetime.now()
 
-        # Формируем условия фильтрации (WHERE)
-        conditions = [
-            City.name == city_name,
-            EventType.name == category,
-            # НОВОЕ УСЛОВИЕ: дата начала должна быть больше или равна СЕГОДНЯШНЕМУ ДНЮ
-            # или не указана вовсе (для анонсов).
-            or_(Event.date_start >= today, Event.date_start.is_(None))
-        ]
-        
-        if date_from:
-            # Условие "больше или равно" для даты начала
-            conditions.append(Event.date_start >= date_from)
-        if date_to:
-            # Чтобы включить весь конечный день, ищем до начала следующего дня
-            end_of_day = date_to.replace(hour=23, minute=59, second=59)
-            conditions.append(Event.date_start <= end_of_day)
+def _afisha_cursor(row) -> list:
+    """Курсор keyset-пагинации: ключ сортировки последней показанной группы (JSON-совместимый)."""
+    return [row.sort_date.isoformat(), row.title, row.venue_name]
 
-        # Применяем все условия
-        stmt = stmt.where(and_(*conditions))
 
-        # Группировка и сортировка
-        stmt = (
-            stmt.group_by(Event.title, Venue.name, EventType.name)
-            .order_by(func.min(Event.date_start).asc().nulls_last())
-            .limit(20)
+async def get_grouped_events_by_city_and_categories(
+    city_name: str,
+    categories: list[str],
+    date_from: datetime = None,
+    date_to: datetime = None,
+    limit_per_category: int = AFISHA_PAGE_SIZE,
+    cursors: dict[str, list] | None = None
+) -> tuple[dict[str, list], dict[str, list]]:
+    """
+    Афиша сразу по нескольким категориям одним запросом.
+    Возвращает ({категория: [группы]}, {категория: курсор следующей страницы}).
+    Группы идут в порядке переданных категорий, по каждой — не больше
+    limit_per_category ближайших (row_number() по категории). В каждой строке,
+    кроме полей группы, есть country_name города.
+    Пагинация keyset по (ближайшая дата, название, площадка): курсор из
+    предыдущего ответа передается в cursors, курсор есть только у категорий,
+    где остались группы.
+    Читает готовые группы из витрины afisha_event_groups и вырезает из их
+    массивов только даты из нужного диапазона.
+    """
+    if not categories:
+        return {}, {}
+    cursors = cursors or {}
+
+    groups = afisha_event_groups.c
+    item = func.unnest(
+        groups.event_ids, groups.dates, groups.links, groups.prices_min, groups.prices_max
+    ).table_valued(
+        column('event_id', Integer), column('date_start', TIMESTAMP), column('url', String),
+        column('price_min', Numeric), column('price_max', Numeric)
+    ).render_derived(name='item')
+
+    # Формируем условия фильтрации (WHERE)
+    today = datetime.now()
+    conditions = [
+        groups.city_name == city_name,
+        groups.category_name.in_(categories),
+        # Дата начала должна быть больше или равна СЕГОДНЯШНЕМУ ДНЮ
+        # или не указана вовсе (для анонсов).
+        or_(item.c.date_start >= today, item.c.date_start.is_(None))
+    ]
+    if date_from:
+        # Группы целиком раньше диапазона отсекаются по индексу еще до unnest
+        conditions.append(groups.last_date >= date_from)
+        conditions.append(item.c.date_start >= date_from)
+    if date_to:
+        # Чтобы включить весь конечный день, ищем до начала следующего дня
+        end_of_day = date_to.replace(hour=23, minute=59, second=59)
+        conditions.append(groups.first_date <= end_of_day)
+        conditions.append(item.c.date_start <= end_of_day)
+
+    # Группы без даты идут в конце: datetime.max asyncpg передает как 'infinity'
+    sort_date = func.coalesce(func.min(item.c.date_start), datetime.max)
+
+    # Для категорий с курсором берем только группы после него.
+    # Группы, у которых все даты раньше курсора, отсекаются еще до unnest.
+    page_conditions, after_cursor = [], []
+    for category in categories:
+        cursor = cursors.get(category)
+        if not cursor:
+            page_conditions.append(groups.category_name == category)
+            continue
+        cursor_date, cursor_title, cursor_venue = datetime.fromisoformat(cursor[0]), cursor[1], cursor[2]
+        page_conditions.append(and_(
+            groups.category_name == category,
+            or_(groups.last_date >= cursor_date, groups.last_date.is_(None), groups.first_date.is_(None))
+        ))
+        after_cursor.append(and_(
+            groups.category_name == category,
+            tuple_(sort_date, groups.title, groups.venue_name) > tuple_(cursor_date, cursor_title, cursor_venue)
+        ))
+    conditions.append(or_(*page_conditions))
+
+    ranked = (
+        select(
+            func.array_agg(aggregate_order_by(item.c.event_id, item.c.date_start.asc().nulls_last()))[1].label("event_id"),
+            groups.title,
+            groups.category_name,
+            groups.venue_name,
+            groups.country_name,
+            array_agg(aggregate_order_by(item.c.date_start, item.c.date_start.asc().nulls_last())).label("dates"),
+            array_agg(aggregate_order_by(item.c.url, item.c.date_start.asc().nulls_last())).label("links"),
+            func.min(item.c.price_min).label("min_price"),
+            func.max(item.c.price_max).label("max_price"),
+            sort_date.label("sort_date"),
+            func.row_number().over(
+                partition_by=groups.category_name,
+                order_by=(sort_date, groups.title, groups.venue_name)
+            ).label("position")
         )
-        
+        .select_from(afisha_event_groups)
+        .join(item, true())
+        .where(and_(*conditions))
+        .group_by(groups.city_id, groups.country_name, groups.category_name, groups.title, groups.venue_name)
+    )
+    if after_cursor:
+        # Категории без курсора проходят целиком
+        ranked = ranked.having(or_(groups.category_name.not_in(list(cursors)), *after_cursor))
+    ranked = ranked.subquery()
+
+    # Берем на одну группу больше, чтобы знать, есть ли следующая страница
+    stmt = (
+        select(ranked)
+        .where(ranked.c.position <= limit_per_category + 1)
+        .order_by(ranked.c.category_name, ranked.c.position)
+    )
+
+    async with read_session() as session:
         result = await session.execute(stmt)
-        return result.all()
+        rows = result.all()
+
+    events_by_category = {}
+    for row in rows:
+        events_by_category.setdefault(row.category_name, []).append(row)
+
+    page, next_cursors = {}, {}
+    for category in categories:
+        category_rows = events_by_category.get(category)
+        if not category_rows:
+            continue
+        page[category] = category_rows[:limit_per_category]
+        if len(category_rows) > limit_per_category:
+            next_cursors[category] = _afisha_cursor(page[category][-1])
+    return page, next_cursors
 
 
 # --- ФУНКЦИИ ДЛЯ УВЕДОМЛЕНИЙ ---
@@ -626,7 +803,7 @@ async def get_subscription_details(user_id: int, event_id: int) -> Subscription
     Получает полную информацию о конкретной подписке пользователя
     по user_id и event_id.
     """
-    async with async_session() as session:
+    async with read_session(user_id) as session:
         stmt = select(Subscription).where(
             and_(
                 Subscription.user_id == user_id,
@@ -640,32 +817,91 @@ async def get_subscription_details(user_id: int, event_id: int) -> Subscription
 async def find_events_by_signatures_bulk(session, signatures: list[tuple]) -> dict[tuple, int]:
     """
     Эффективно находит существующие события по списку "сигнатур" (title, date_start).
+    Сигнатуры передаются двумя массивами и джойнятся через unnest(), поэтому
+    размер SQL и число параметров не зависят от размера батча. Большие списки
+    режутся на чанки по SIGNATURES_CHUNK_SIZE.
     """
-    if not signatures:
+    unique_signatures = list({(title, date_start) for title, date_start in signatures if title and date_start})
+    if not unique_signatures:
         return {}
 
-    conditions = [
-        and_(Event.title == title, Event.date_start == date_start)
-        for title, date_start in signatures if title and date_start
-    ]
-    
-    if not conditions:
+    existing_events_map = {}
+    for i in range(0, len(unique_signatures), SIGNATURES_CHUNK_SIZE):
+        chunk = unique_signatures[i:i + SIGNATURES_CHUNK_SIZE]
+        titles, dates = zip(*chunk)
+
+        sig = func.unnest(
+            literal(list(titles), ARRAY(String)),
+            literal(list(dates), ARRAY(TIMESTAMP))
+        ).table_valued(column('title', String), column('date_start', TIMESTAMP)).render_derived(name='sig')
+
+        stmt = (
+            select(Event.event_id, Event.title, Event.date_start)
+            .join(sig, and_(Event.title == sig.c.title, Event.date_start == sig.c.date_start))
+        )
+        result = await session.execute(stmt)
+        for row in result.all():
+            existing_events_map[(row.title, row.date_start)] = row.event_id
+
+    return existing_events_map
+
+async def find_events_by_external_ids_bulk(session, keys: list[tuple]) -> dict[tuple, int]:
+    """
+    Находит существующие события по идентификатору источника (source, external_id).
+    Поиск идет по уникальному индексу ux_events_source_external_id тем же unnest-джойном,
+    что и find_events_by_signatures_bulk.
+    """
+    unique_keys = list({(source, external_id) for source, external_id in keys if source and external_id})
+    if not unique_keys:
         return {}
 
-    stmt = select(Event.event_id, Event.title, Event.date_start).where(or_(*conditions))
-    
-    result = await session.execute(stmt)
-    
-    existing_events_map = {
-        (row.title, row.date_start): row.event_id
-        for row in result.all()
-    }
-    
+    existing_events_map = {}
+    for i in range(0, len(unique_keys), SIGNATURES_CHUNK_SIZE):
+        chunk = unique_keys[i:i + SIGNATURES_CHUNK_SIZE]
+        sources, external_ids = zip(*chunk)
+
+        key = func.unnest(
+            literal(list(sources), ARRAY(String)),
+            literal(list(external_ids), ARRAY(String))
+        ).table_valued(column('source', String), column('external_id', String)).render_derived(name='k')
+
+        stmt = (
+            select(Event.event_id, Event.source, Event.external_id)
+            .join(key, and_(Event.source == key.c.source, Event.external_id == key.c.external_id))
+        )
+        result = await session.execute(stmt)
+        for row in result.all():
+            existing_events_map[(row.source, row.external_id)] = row.event_id
+
     return existing_events_map
 
+# Изменяемые поля события из словаря парсера, по которым считается events.content_hash
+CONTENT_HASH_FIELDS = ('price_min', 'price_max', 'tickets_info', 'time_end')
+
+
+def _hash_value(value):
+    # 10, 10.0 и Decimal('10.00') — одна и та же цена
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return str(Decimal(str(value)).quantize(Decimal('0.01')))
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def event_content_hash(event_data: dict) -> str:
+    """
+    Компактный хэш изменяемых полей события (16 hex-символов).
+    Учитываются только поля, которые есть в словаре, — ровно те, что записал бы UPDATE.
+    """
+    payload = [[field, _hash_value(event_data[field])] for field in CONTENT_HASH_FIELDS if field in event_data]
+    return hashlib.blake2b(json.dumps(payload, ensure_ascii=False).encode(), digest_size=8).hexdigest()
+
+
 async def update_event_details(session, event_id: int, event_data: dict):
     """
     Обновляет ключевую информацию для СУЩЕСТВУЮЩЕГО события.
+    Хэш изменяемых полей сравнивается прямо в UPDATE (content_hash IS DISTINCT FROM):
+    если он совпадает с сохраненным, строка не переписывается, лишнего SELECT нет.
     """
     # Собираем словарь только с теми полями, которые нужно обновить
     values_to_update = {}
@@ -678,32 +914,49 @@ async def update_event_details(session, event_id: int, event_data: dict):
     if 'time_end' in event_data: # <-- Новое
         values_to_update['date_end'] = event_data.get('time_end')
 
-    if not values_to_update:
-        return # Если обновлять нечего, выходим
+    if values_to_update:
+        new_hash = event_content_hash(event_data)
+        values_to_update['content_hash'] = new_hash
+        # Выполняем один запрос на обновление; неизменившееся событие он не затронет
+        result = await session.execute(
+            update(Event)
+            .where(Event.event_id == event_id, Event.content_hash.is_distinct_from(new_hash))
+            .values(**values_to_update)
+        )
+        if result.rowcount:
+            logging.info(f"  -> Обновлены данные для существующего события ID {event_id}: {list(values_to_update.keys())}")
 
-    # Выполняем один запрос на обновление
-    await session.execute(
-        update(Event)
-        .where(Event.event_id == event_id)
-        .values(**values_to_update)
-    )
-    logging.info(f"  -> Обновлены данные для существующего события ID {event_id}: {list(values_to_update.keys())}")
-    
-    # Логика обновления ссылки остается той же
-    link_url = event_data.get('link')
-    if link_url:
-        link_stmt = select(EventLink).where(and_(EventLink.event_id == event_id, EventLink.url == link_url))
-        existing_link = (await session.execute(link_stmt)).scalar_one_or_none()
-        if not existing_link:
-            new_link = EventLink(event_id=event_id, url=link_url, type="bilety")
-            session.add(new_link)
+    # Ссылка добавляется без предварительного SELECT: дубль отсекает ux_event_links_event_id_url
+    if event_data.get('link'):
+        if await upsert_event_links(session, [(event_id, event_data['link'])]):
             logging.info(f"  - Добавлена новая ссылка для события ID {event_id}")
 
+async def upsert_event_links(session, links: list[tuple[int, str]], link_type: str = "bilety") -> int:
+    """
+    Добавляет ссылки (event_id, url) одним INSERT ... ON CONFLICT (event_id, url) DO NOTHING.
+    Уже существующие ссылки пропускаются базой, поэтому проверять их заранее не нужно.
+    Возвращает число реально добавленных ссылок.
+    НЕ ДЕЛАЕТ COMMIT.
+    """
+    rows = [
+        {'event_id': event_id, 'url': url, 'type': link_type}
+        for event_id, url in dict.fromkeys((event_id, url) for event_id, url in links if event_id and url)
+    ]
+    if not rows:
+        return 0
+    result = await session.execute(
+        pg_insert(EventLink)
+        .values(rows)
+        .on_conflict_do_nothing(index_elements=['event_id', 'url'])
+        .returning(EventLink.link_id)
+    )
+    return len(result.all())
+
 
     
 async def get_favorite_details(user_id: int, artist_id: int) -> UserFavorite | None:
     """Получает детали одной записи из избранного (включая регионы)."""
-    async with async_session() as session:
+    async with read_session(user_id) as session:
         stmt = select(UserFavorite).where(
             and_(UserFavorite.user_id == user_id, UserFavorite.artist_id == artist_id)
         )
@@ -721,8 +974,9 @@ async def update_favorite_regions(user_id: int, artist_id: int, new_regions: lis
         )
         await session.execute(stmt)
         await session.commit()
+        mark_user_write(user_id)
 
-async def get_future_events_for_artists(artist_ids: list[int]) -> list[Event]:
+async def get_future_events_for_artists(artist_ids: list[int], user_id: int = None) -> list[Event]:
     """
     Находит все предстоящие события для заданного списка ID артистов.
     События, у которых дата не указана (date_start is None), также считаются будущими.
@@ -730,6 +984,8 @@ async def get_future_events_for_artists(artist_ids: list[int]) -> list[Event]:
 
     Args:
         artist_ids: Список ID артистов.
+        user_id: Пользователь, для которого ищем события. Если он только что
+            изменил избранное, запрос пойдет в основную базу, а не в реплику.
 
     Returns:
         Список объектов Event.
@@ -737,7 +993,7 @@ async def get_future_events_for_artists(artist_ids: list[int]) -> list[Event]:
     if not artist_ids:
         return []
 
-    async with async_session() as session:
+    async with read_session(user_id) as session:
         today = datetime.now()
         
         stmt = (
@@ -765,6 +1021,77 @@ async def get_future_events_for_artists(artist_ids: list[int]) -> list[Event]:
         result = await session.execute(stmt)
         return result.scalars().all()
     
+def _event_card_select():
+    """
+    SELECT колонок карточки события: площадка, город и страна — обычными JOIN,
+    первая ссылка и имена артистов — коррелированными подзапросами (одна строка на событие).
+    """
+    first_link = (
+        select(EventLink.url)
+        .where(EventLink.event_id == Event.event_id)
+        .order_by(EventLink.link_id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    artist_names = (
+        select(array_agg(aggregate_order_by(Artist.name, Artist.name)))
+        .join(EventArtist, EventArtist.artist_id == Artist.artist_id)
+        .where(EventArtist.event_id == Event.event_id)
+        .scalar_subquery()
+    )
+    return (
+        select(
+            Event.event_id, Event.title, Event.date_start,
+            Venue.name.label("venue_name"), City.name.label("city_name"), Country.name.label("country_name"),
+            Event.tickets_info, first_link.label("url"), artist_names.label("artist_names")
+        )
+        .join(Venue, Venue.venue_id == Event.venue_id)
+        .join(City, City.city_id == Venue.city_id)
+        .join(Country, Country.country_id == City.country_id)
+    )
+
+
+def _to_event_card(row) -> EventCard:
+    return EventCard(
+        event_id=row.event_id,
+        title=row.title,
+        date_start=row.date_start,
+        venue_name=row.venue_name,
+        city_name=row.city_name,
+        country_name=row.country_name,
+        tickets_info=row.tickets_info,
+        url=row.url,
+        artist_names=tuple(row.artist_names or ()),
+    )
+
+
+async def get_future_event_cards_for_artists(artist_ids: list[int], user_id: int = None) -> list[EventCard]:
+    """
+    То же, что get_future_events_for_artists, но возвращает EventCard вместо ORM-событий:
+    один запрос, только колонки, которые показывают форматеры.
+    """
+    if not artist_ids:
+        return []
+
+    async with read_session(user_id) as session:
+        today = datetime.now()
+        has_artist = (
+            select(EventArtist.event_id)
+            .where(EventArtist.event_id == Event.event_id, EventArtist.artist_id.in_(artist_ids))
+            .exists()
+        )
+        stmt = (
+            _event_card_select()
+            .where(
+                has_artist,
+                or_(Event.date_start >= today, Event.date_start.is_(None))
+            )
+            .order_by(Event.date_start.asc().nulls_last(), Event.event_id)
+        )
+        result = await session.execute(stmt)
+        return [_to_event_card(row) for row in result.all()]
+
+
 async def create_event_with_artists(session, event_data: dict, artists_map: dict[str, Artist]) -> Event | None:
     """
     Создает новое событие и все его связи (место, артисты, ссылка).
@@ -807,7 +1134,7 @@ async def create_event_with_artists(session, event_data: dict, artists_map: dict
 
         # --- 3. Создаем ссылку на событие ---
         if event_data.get('link'):
-            session.add(EventLink(event_id=new_event.event_id, url=event_data['link'], type="bilety"))
+            await upsert_event_links(session, [(new_event.event_id, event_data['link'])])
 
         # --- 4. Привязываем артистов к событию (ИСПРАВЛЕННАЯ ЛОГИКА) ---
         raw_artist_names = event_data.get('artists', [])
@@ -834,9 +1161,17 @@ async def create_event_with_artists(session, event_data: dict, artists_map: dict
     
 async def get_or_create_artists_by_name(session, names: list[str]) -> dict[str, Artist]:
     """
-    Находит артистов по списку имен. Если артист не найден, добавляет его в СЕССИЮ.
+    Находит артистов по списку имен. Недостающих создает одним
+    INSERT ... ON CONFLICT (name) DO NOTHING RETURNING: параллельные конфиги парсинга
+    могут одновременно создавать одного и того же артиста, и вставка второго не падает
+    на уникальном artists.name, а ждет первого. Имена, которые RETURNING не вернул
+    (их вставил кто-то другой), дочитываются отдельным SELECT.
     Возвращает СЛОВАРЬ { 'имя': <Объект Artist> }.
     НЕ ДЕЛАЕТ COMMIT.
+    Индекс нечеткого поиска (artist_index) живет в процессе бота, а эта функция
+    вызывается из парсеров: новый артист попадает в индекс бота через LISTEN/NOTIFY
+    (триггер new_event_trigger на event_artists присылает артиста, listener.py
+    вызывает artist_index.add) или при периодическом artist_index.refresh().
     """
     if not names:
         return {}
@@ -848,24 +1183,28 @@ async def get_or_create_artists_by_name(session, names: list[str]) -> dict[str,
     existing_artists = (await session.execute(stmt)).scalars().all()
     existing_map = {artist.name: artist for artist in existing_artists}
 
-    new_artists_to_add = []
-    for name in unique_lower_names:
-        if name not in existing_map:
-            new_artists_to_add.append(Artist(name=name))
+    missing_names = [name for name in unique_lower_names if name not in existing_map]
+    if missing_names:
+        logging.info(f"Подготовлено к добавлению в БД {len(missing_names)} новых артистов.")
+        stmt = (
+            pg_insert(Artist)
+            .values([{'name': name} for name in missing_names])
+            .on_conflict_do_nothing(index_elements=[Artist.name])
+            .returning(Artist)
+        )
+        created = (await session.execute(stmt)).scalars().all()
+        existing_map.update({artist.name: artist for artist in created})
 
-    if new_artists_to_add:
-        logging.info(f"Подготовлено к добавлению в БД {len(new_artists_to_add)} новых артистов.")
-        session.add_all(new_artists_to_add)
-        await session.flush()
-        # Добавляем только что созданных артистов в наш словарь
-        for artist in new_artists_to_add:
-            existing_map[artist.name] = artist
+        still_missing = [name for name in missing_names if name not in existing_map]
+        if still_missing:
+            stmt = select(Artist).where(Artist.name.in_(still_missing))
+            existing_map.update({artist.name: artist for artist in (await session.execute(stmt)).scalars().all()})
     
     return existing_map
 
 async def get_country_by_city_name(city_name: str) -> str | None:
     """Находит страну по названию города."""
-    async with async_session() as session:
+    async with read_session() as session:
         stmt = (
             select(Country.name)
             .join(City)
@@ -876,14 +1215,10 @@ async def get_country_by_city_name(city_name: str) -> str | None:
     
 async def count_user_favorites(user_id: int) -> int:
     """Считает количество избранных артистов у пользователя."""
-    async with async_session() as session:
-        stmt = select(func.count(UserFavorite.artist_id)).where(UserFavorite.user_id == user_id)
-        result = await session.execute(stmt)
-        return result.scalar() or 0
+    profile = await _get_user_profile(user_id)
+    return profile["favorites_count"] if profile else 0
     
 async def count_user_subscriptions(user_id: int) -> int:
     """Считает количество подписок на события у пользователя."""
-    async with async_session() as session:
-        stmt = select(func.count(Subscription.id)).where(Subscription.user_id == user_id)
-        result = await session.execute(stmt)
-        return result.scalar() or 0
+    profile = await _get_user_profile(user_id)
+    return profile["subscriptions_count"] if profile else 0
@@ -0,0 +1,108 @@
+# app/database/requests/requests_archive.py
+#
+# Перенос прошедших событий в архивные таблицы (events_archive, event_links_archive,
+# event_artists_archive). Запросы бота фильтруют date_start >= now(), поэтому
+# старые строки в events только раздувают таблицу и индексы.
+
+import logging
+import os
+
+from sqlalchemy import text
+
+from ..models import (
+    Event, EventArtist, EventLink, events_archive, event_links_archive, event_artists_archive,
+    parser_engine
+)
+from app.services import profile_cache
+from .requests_ingest import refresh_afisha_groups
+
+# Событие уходит в архив, когда с его окончания (или начала, если конца нет) прошло столько дней
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 1))
+# Событий за одну транзакцию: короткие транзакции не держат блокировки на events подолгу
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 1000))
+
+
+def _copy_columns(source) -> str:
+    return ", ".join(c.name for c in source.columns)
+
+
+# Один батч одним запросом: выбрать события, скопировать их ссылки, артистов
+# и сами события в архив, удалить подписки и события (ссылки, связи с артистами
+# и поисковые документы удалятся каскадно). События без даты не трогаем.
+SQL_ARCHIVE_BATCH = f"""
+WITH batch AS (
+    SELECT event_id
+    FROM events
+    WHERE date_start < now() - make_interval(days => :after_days)
+      AND (date_end IS NULL OR date_end < now() - make_interval(days => :after_days))
+    LIMIT :batch_size
+    FOR UPDATE SKIP LOCKED
+),
+archived_links AS (
+    INSERT INTO {event_links_archive.name} ({_copy_columns(EventLink.__table__)})
+    SELECT {_copy_columns(EventLink.__table__)} FROM event_links
+    WHERE event_id IN (SELECT event_id FROM batch)
+    ON CONFLICT DO NOTHING
+),
+archived_artists AS (
+    INSERT INTO {event_artists_archive.name} ({_copy_columns(EventArtist.__table__)})
+    SELECT {_copy_columns(EventArtist.__table__)} FROM event_artists
+    WHERE event_id IN (SELECT event_id FROM batch)
+    ON CONFLICT DO NOTHING
+),
+archived_events AS (
+    INSERT INTO {events_archive.name} ({_copy_columns(Event.__table__)})
+    SELECT {_copy_columns(Event.__table__)} FROM events
+    WHERE event_id IN (SELECT event_id FROM batch)
+    ON CONFLICT DO NOTHING
+),
+deleted_subscriptions AS (
+    DELETE FROM subscriptions
+    WHERE event_id IN (SELECT event_id FROM batch)
+    RETURNING user_id
+),
+deleted_events AS (
+    DELETE FROM events
+    WHERE event_id IN (SELECT event_id FROM batch)
+    RETURNING event_id
+)
+SELECT
+    (SELECT count(*) FROM deleted_events) AS events_count,
+    ARRAY(SELECT DISTINCT user_id FROM deleted_subscriptions) AS user_ids;
+"""
+
+
+async def archive_past_events(after_days: int = ARCHIVE_AFTER_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE,
+                              refresh_afisha: bool = True) -> int:
+    """
+    Переносит прошедшие события в архив пачками по batch_size, каждая пачка — отдельная транзакция.
+    Подписки на эти события удаляются (счетчики в users поправят триггеры),
+    кэш профилей затронутых пользователей сбрасывается.
+    Если что-то перенесено, пересчитывает витрину афиши, чтобы в ней не остались
+    ID удаленных событий; refresh_afisha=False — вызывающий обновит ее сам.
+    Возвращает количество перенесенных событий.
+    """
+    archived_count = 0
+    affected_users = set()
+    try:
+        while True:
+            async with parser_engine.begin() as conn:
+                result = await conn.execute(
+                    text(SQL_ARCHIVE_BATCH),
+                    {"after_days": after_days, "batch_size": batch_size}
+                )
+                events_count, user_ids = result.one()
+            archived_count += events_count
+            affected_users.update(user_ids)
+            if events_count < batch_size:
+                break
+    except Exception as e:
+        logging.error(f"Ошибка при архивации прошедших событий: {e}", exc_info=True)
+
+    for user_id in affected_users:
+        await profile_cache.invalidate(user_id)
+
+    logging.info(f"В архив перенесено событий: {archived_count}, затронуто подписчиков: {len(affected_users)}")
+    if archived_count and refresh_afisha:
+        await refresh_afisha_groups()
+    return archived_count
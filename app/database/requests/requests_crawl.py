@@ -0,0 +1,215 @@
+# app/database/requests/requests_crawl.py
+#
+# Состояние обхода страниц парсерами (таблица crawl_state) для инкрементальных запусков.
+# Для каждой страницы источника хранится хэш значимого содержимого, ETag/Last-Modified
+# и время последней проверки/изменения. По ним парсеры:
+#   - останавливают пагинацию, когда подряд идут неизменившиеся страницы списка;
+#   - не открывают детальные страницы, которые проверялись недавно или отвечают 304.
+# Раз в CRAWL_FULL_EVERY_HOURS список все равно обходится целиком.
+#
+# Состояние страницы можно сохранять только после коммита событий с нее: иначе
+# откаченное событие следующий запуск сочтет известным и больше не перепарсит.
+# Поэтому потоковые парсеры не сохраняют его сами, а забирают (take) и кладут в
+# событие: состояние его детальной страницы — в DETAIL_STATES_KEY, страниц списка —
+# в LIST_STATES_KEY. Писатель сохраняет их (save_crawl_states) после коммита пачки.
+
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Iterable
+
+from sqlalchemy import case, func, or_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from ..models import CrawlState, EventLink, parser_session
+
+CRAWL_STATE_ENABLED = os.getenv("CRAWL_STATE_ENABLED", "1").strip().lower() in ("1", "true", "yes", "on")
+# Сколько неизменившихся страниц списка подряд считаются "известной территорией"; 0 — не останавливаться
+CRAWL_KNOWN_PAGES_TO_STOP = int(os.getenv("CRAWL_KNOWN_PAGES_TO_STOP", 2))
+# Раз в столько часов список обходится полностью, без ранней остановки
+CRAWL_FULL_EVERY_HOURS = float(os.getenv("CRAWL_FULL_EVERY_HOURS", 24))
+# Детальная страница, проверенная меньше стольких часов назад, повторно не открывается
+CRAWL_DETAIL_RECHECK_HOURS = float(os.getenv("CRAWL_DETAIL_RECHECK_HOURS", 6))
+
+# Строк в одном upsert (по 6 параметров на строку, лимит asyncpg — 32767)
+FLUSH_CHUNK_SIZE = 2000
+
+DETAIL_STATES_KEY = 'crawl_states'
+LIST_STATES_KEY = 'crawl_list_states'
+
+
+def content_hash(value) -> str:
+    """Хэш значимого содержимого страницы: список карточек, поля события и т.п."""
+    payload = json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+class CrawlTracker:
+    """
+    Состояние обхода одного источника на время запуска парсера.
+    load() читает состояние нужных страниц одним запросом, дальше все проверки
+    и observe() работают в памяти (их можно вызывать из потока Selenium).
+    take() забирает наблюдения, чтобы сохранить их после коммита событий,
+    flush() сохраняет оставшиеся одним upsert в конце обхода.
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        self.states: dict[str, dict] = {}
+        self._observed: dict[str, dict] = {}
+
+    async def load(self, urls: Iterable[str] = (), prefix: str | None = None):
+        """Загружает состояние перечисленных URL и/или всех URL, начинающихся с prefix."""
+        urls = list(urls)
+        if not CRAWL_STATE_ENABLED or not (urls or prefix):
+            return
+        conditions = []
+        if urls:
+            conditions.append(CrawlState.url.in_(urls))
+        if prefix:
+            conditions.append(CrawlState.url.startswith(prefix, autoescape=True))
+        stmt = select(
+            CrawlState.url, CrawlState.content_hash, CrawlState.etag, CrawlState.last_modified,
+            CrawlState.last_checked_at, CrawlState.last_changed_at,
+        ).where(CrawlState.source == self.source, or_(*conditions))
+        try:
+            async with parser_session() as session:
+                rows = (await session.execute(stmt)).mappings().all()
+        except Exception as e:
+            # Без состояния парсер просто обходит все заново
+            logging.warning(f"Не удалось загрузить состояние обхода '{self.source}': {e}")
+            return
+        self.states.update({row["url"]: dict(row) for row in rows})
+
+    async def forget_unsaved(self, urls: Iterable[str]):
+        """
+        Забывает состояние детальных страниц, чьих событий нет в БД (ни одной ссылки
+        в event_links): такие страницы нужно распарсить заново, даже если они
+        проверялись недавно или ответят 304.
+        """
+        urls = [url for url in urls if url in self.states]
+        if not urls:
+            return
+        try:
+            async with parser_session() as session:
+                saved = set((await session.scalars(
+                    select(EventLink.url).where(EventLink.url.in_(urls)).distinct()
+                )).all())
+        except Exception as e:
+            logging.warning(f"Не удалось проверить ссылки событий '{self.source}': {e}")
+            return
+        for url in urls:
+            if url not in saved:
+                del self.states[url]
+
+    def get(self, url: str) -> dict | None:
+        return self.states.get(url)
+
+    def is_unchanged(self, url: str, page_hash: str) -> bool:
+        state = self.states.get(url)
+        return state is not None and state["content_hash"] == page_hash
+
+    def checked_within(self, url: str, hours: float) -> bool:
+        state = self.states.get(url)
+        return (
+            state is not None and hours > 0
+            and state["last_checked_at"] >= datetime.now() - timedelta(hours=hours)
+        )
+
+    def needs_full_crawl(self, list_key: str) -> bool:
+        """Полный обход списка нужен, если его давно не было (см. mark_full_crawl)."""
+        return not self.checked_within(list_key, CRAWL_FULL_EVERY_HOURS)
+
+    def mark_full_crawl(self, list_key: str):
+        self.observe(list_key)
+
+    def observe(self, url: str, page_hash: str | None = None, etag: str | None = None,
+                last_modified: str | None = None) -> bool:
+        """Запоминает проверку страницы. Возвращает True, если страница новая или изменилась."""
+        previous = self.states.get(url)
+        changed = previous is None or previous["content_hash"] != page_hash
+        now = datetime.now()
+        state = {
+            "url": url,
+            "content_hash": page_hash,
+            "etag": etag,
+            "last_modified": last_modified,
+            "last_checked_at": now,
+            "last_changed_at": now if changed else previous["last_changed_at"],
+        }
+        self.states[url] = state
+        self._observed[url] = state
+        return changed
+
+    def touch(self, url: str):
+        """Страница проверена и не изменилась (например, ответ 304)."""
+        state = self.states.get(url)
+        if state is None:
+            return
+        self.observe(url, state["content_hash"], state["etag"], state["last_modified"])
+
+    def take(self, urls: Iterable[str] | None = None) -> list[dict]:
+        """
+        Забирает несохраненные наблюдения (все или по перечисленным URL) строками
+        для save_crawl_states: flush() их больше не сохранит.
+        """
+        urls = list(self._observed) if urls is None else [url for url in urls if url in self._observed]
+        return [
+            {
+                "source": self.source,
+                "url": state["url"][:1024],
+                "content_hash": state["content_hash"],
+                "etag": (state["etag"] or None) and state["etag"][:255],
+                "last_modified": (state["last_modified"] or None) and state["last_modified"][:64],
+                "last_checked_at": state["last_checked_at"],
+            }
+            for state in (self._observed.pop(url) for url in urls)
+        ]
+
+    async def flush(self):
+        await save_crawl_states(self.take())
+
+
+def event_crawl_states(events: Iterable[dict]) -> list[dict]:
+    """Все состояния обхода, которые парсеры положили в события (см. DETAIL_STATES_KEY)."""
+    return [
+        row for event in events
+        for key in (DETAIL_STATES_KEY, LIST_STATES_KEY) for row in event.get(key) or ()
+    ]
+
+
+async def save_crawl_states(rows: list[dict]):
+    """Сохраняет строки состояния обхода (из CrawlTracker.take) одним upsert на чанк."""
+    if not CRAWL_STATE_ENABLED or not rows:
+        return
+    # Одна страница может прийти от нескольких конфигов: upsert не обновляет строку дважды
+    rows = list({(row["source"], row["url"]): row for row in rows}.values())
+    try:
+        async with parser_session() as session:
+            for start in range(0, len(rows), FLUSH_CHUNK_SIZE):
+                stmt = pg_insert(CrawlState).values(rows[start:start + FLUSH_CHUNK_SIZE])
+                excluded = stmt.excluded
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[CrawlState.source, CrawlState.url],
+                    set_={
+                        "content_hash": excluded.content_hash,
+                        # Сервер мог перестать присылать валидаторы — тогда держим старые
+                        "etag": func.coalesce(excluded.etag, CrawlState.etag),
+                        "last_modified": func.coalesce(excluded.last_modified, CrawlState.last_modified),
+                        "last_checked_at": excluded.last_checked_at,
+                        "last_changed_at": case(
+                            (CrawlState.content_hash.is_distinct_from(excluded.content_hash),
+                             excluded.last_checked_at),
+                            else_=CrawlState.last_changed_at,
+                        ),
+                    },
+                )
+                await session.execute(stmt)
+            await session.commit()
+    except Exception as e:
+        sources = sorted({row["source"] for row in rows})
+        logging.warning(f"Не удалось сохранить состояние обхода {sources}: {e}")
+        return
+    logging.info(f"Состояние обхода сохранено: {len(rows)} страниц.")
@@ -0,0 +1,452 @@
+# app/database/requests/requests_ingest.py
+#
+# Пакетная запись результатов парсинга в БД.
+# Вместо get_or_create и flush на каждое событие справочники (типы, страны,
+# города, площадки) разрешаются пачкой, а события, ссылки и связи с артистами
+# вставляются многострочными INSERT. Весь батч укладывается в несколько запросов.
+
+import logging
+from dataclasses import dataclass, field
+
+from sqlalchemy import select, tuple_, update, func, literal, column, text, case, Integer, String, TIMESTAMP, Numeric
+from sqlalchemy.dialects.postgresql import insert, ARRAY
+
+from ..models import (
+    Artist, City, Country, Event, EventArtist, EventType, Venue,
+    parser_engine, SQL_REFRESH_AFISHA_EVENT_GROUPS
+)
+from .requests import (
+    find_events_by_external_ids_bulk, find_events_by_signatures_bulk, upsert_event_links, event_content_hash
+)
+
+DEFAULT_CITY_NAME = 'Не указан'
+DEFAULT_COUNTRY_NAME = 'Не указана'
+
+# Поля парсера, которые обновляются у уже существующих событий:
+# {ключ в словаре события: (колонка events, SQL-тип)}
+UPDATABLE_FIELDS = {
+    'price_min': ('price_min', Numeric(10, 2)),
+    'price_max': ('price_max', Numeric(10, 2)),
+    'tickets_info': ('tickets_info', String(255)),
+    'time_end': ('date_end', TIMESTAMP),
+    # Проставляются только событиям без ID источника (созданным до его появления),
+    # уже записанный ID другого источника не перезаписывается (см. split_existing_events)
+    'source': ('source', String(50)),
+    'external_id': ('external_id', String(255)),
+}
+
+
+@dataclass
+class RunChanges:
+    """
+    Что реально изменилось за запуск парсинга: ID созданных событий и событий,
+    у которых поменялись цены/билеты/дата окончания или ID источника.
+    Заполняется create_events_bulk / update_events_bulk, если их передать.
+    """
+    created: list[int] = field(default_factory=list)
+    updated: list[int] = field(default_factory=list)
+    # Совпавших с БД событий, для которых UPDATE не понадобился
+    unchanged: int = 0
+
+    @property
+    def changed_event_ids(self) -> list[int]:
+        return self.created + self.updated
+
+    def merge(self, other: "RunChanges"):
+        self.created.extend(other.created)
+        self.updated.extend(other.updated)
+        self.unchanged += other.unchanged
+
+    def summary(self) -> str:
+        return f"создано {len(self.created)}, изменено {len(self.updated)}, без изменений {self.unchanged}"
+
+
+def source_key(event_data: dict) -> tuple | None:
+    """(source, external_id) события или None, если парсер не отдал стабильный ID."""
+    if event_data.get('source') and event_data.get('external_id'):
+        return event_data['source'], str(event_data['external_id'])
+    return None
+
+
+async def split_existing_events(session, events: list[dict]) -> tuple[list[dict], list[dict]]:
+    """
+    Делит события парсера на новые и уже существующие, проставляя event_id существующим.
+    Сначала сопоставляет по (source, external_id) — одним запросом по уникальному индексу.
+    Оставшиеся (старые события без ID источника) — по сигнатуре (title, date_start);
+    найденным так событиям ID источника дописывается при обновлении, чтобы в
+    следующий раз они нашлись по нему. Если на одно событие в пачке сигнатурой
+    попали несколько источников, ID получает первый, у остальных он убирается;
+    событиям, у которых ID уже есть в БД, его не меняет update_events_bulk.
+    Возвращает (events_to_create, events_to_update).
+    """
+    by_source = await find_events_by_external_ids_bulk(
+        session, [key for e in events if (key := source_key(e))]
+    )
+    unmatched = [e for e in events if source_key(e) not in by_source]
+    signatures = [(e.get('title'), e.get('time_start')) for e in unmatched if e.get('title') and e.get('time_start')]
+    by_signature = await find_events_by_signatures_bulk(session, signatures)
+
+    # ID источника, уже закрепленные за событиями, и события, которым ID уже достался:
+    # ни ключ, ни событие второй раз не закрепляются
+    claimed_keys = set(by_source)
+    claimed_events = set(by_source.values())
+    events_to_create, events_to_update = [], []
+    for event_data in events:
+        key = source_key(event_data)
+        if key in by_source:
+            event_data['event_id'] = by_source[key]
+            events_to_update.append(event_data)
+            continue
+
+        signature = (event_data.get('title'), event_data.get('time_start'))
+        if signature in by_signature:
+            event_data['event_id'] = by_signature[signature]
+            if key is not None:
+                if key in claimed_keys or event_data['event_id'] in claimed_events:
+                    event_data.pop('source', None)
+                    event_data.pop('external_id', None)
+                else:
+                    claimed_keys.add(key)
+                    claimed_events.add(event_data['event_id'])
+            events_to_update.append(event_data)
+        else:
+            events_to_create.append(event_data)
+
+    return events_to_create, events_to_update
+
+
+async def _insert_missing(session, model, key_columns: list, id_column, keys: set[tuple]) -> dict[tuple, int]:
+    """
+    Создает строки для ключей одним многострочным INSERT ... ON CONFLICT (key_columns) DO NOTHING
+    RETURNING и возвращает {ключ: id}. На key_columns должен быть уникальный индекс
+    (у cities и venues — ux_cities_name_country_id и ux_venues_name_city_id_country_id).
+    Если строку параллельно вставил кто-то другой, RETURNING ее не вернет —
+    такие ключи дочитываются отдельным SELECT.
+    """
+    if not keys:
+        return {}
+
+    names = [column.key for column in key_columns]
+    stmt = (
+        insert(model)
+        .values([dict(zip(names, key)) for key in keys])
+        .on_conflict_do_nothing(index_elements=key_columns)
+        .returning(id_column, *key_columns)
+    )
+    created = {tuple(row[1:]): row[0] for row in (await session.execute(stmt)).all()}
+    logging.info(f"  - Добавлено в '{model.__tablename__}': {len(created)}")
+
+    still_missing = keys - created.keys()
+    if still_missing:
+        stmt = select(id_column, *key_columns).where(tuple_(*key_columns).in_(list(still_missing)))
+        created.update({tuple(row[1:]): row[0] for row in (await session.execute(stmt)).all()})
+    return created
+
+
+class ReferenceResolver:
+    """
+    Справочники одного запуска парсинга: типы событий, страны, города и площадки.
+    Таблицы маленькие и меняются редко, поэтому читаются целиком один раз в load(),
+    дальше ID выдаются из памяти, а недостающие записи создаются пачкой на батч.
+    Ключи натуральные: тип и страна — по имени, город — (имя, country_id),
+    площадка — (имя, city_id, country_id); на каждом есть уникальный индекс, поэтому
+    параллельные резолверы (конфиги, пачки писателя) не создают дублей: вставка второго
+    ждет коммита первого и получает тот же ID (см. _insert_missing).
+    Созданные ID валидны только после commit: после rollback резолвер нужно выбросить.
+    """
+
+    def __init__(self):
+        self.event_types: dict[tuple, int] = {}
+        self.countries: dict[tuple, int] = {}
+        self.cities: dict[tuple, int] = {}
+        self.venues: dict[tuple, int] = {}
+        self.is_loaded = False
+
+    async def load(self, session):
+        self.event_types = {(name,): type_id for type_id, name in
+                            (await session.execute(select(EventType.type_id, EventType.name))).all()}
+        self.countries = {(name,): country_id for country_id, name in
+                          (await session.execute(select(Country.country_id, Country.name))).all()}
+        self.cities = {(name, country_id): city_id for city_id, name, country_id in
+                       (await session.execute(select(City.city_id, City.name, City.country_id))).all()}
+        self.venues = {(name, city_id, country_id): venue_id for venue_id, name, city_id, country_id in
+                       (await session.execute(select(Venue.venue_id, Venue.name, Venue.city_id, Venue.country_id))).all()}
+        self.is_loaded = True
+        logging.info(f"Справочники загружены: {len(self.event_types)} типов, {len(self.countries)} стран, "
+                     f"{len(self.cities)} городов, {len(self.venues)} площадок.")
+
+    async def _ensure(self, session, cache: dict, model, key_columns: list, id_column, keys: set[tuple]):
+        missing = keys - cache.keys()
+        if missing:
+            cache.update(await _insert_missing(session, model, key_columns, id_column, missing))
+
+    def type_id(self, event_data: dict) -> int:
+        return self.event_types[(event_data['event_type'],)]
+
+    def country_id(self, event_data: dict) -> int:
+        return self.countries[(event_data['country_name'],)]
+
+    def city_id(self, event_data: dict) -> int:
+        return self.cities[(event_data['city_name'], self.country_id(event_data))]
+
+    def venue_key(self, event_data: dict) -> tuple:
+        return event_data['place'], self.city_id(event_data), self.country_id(event_data)
+
+    def venue_id(self, event_data: dict) -> int:
+        return self.venues[self.venue_key(event_data)]
+
+    async def resolve(self, session, events: list[dict]):
+        """
+        Гарантирует, что для всех событий батча есть ID типа, страны, города и площадки.
+        Событиям нужны заполненные event_type, country_name, city_name и place.
+        """
+        if not self.is_loaded:
+            await self.load(session)
+
+        await self._ensure(session, self.event_types, EventType, [EventType.name], EventType.type_id,
+                           {(e['event_type'],) for e in events})
+        await self._ensure(session, self.countries, Country, [Country.name], Country.country_id,
+                           {(e['country_name'],) for e in events})
+        await self._ensure(session, self.cities, City, [City.name, City.country_id], City.city_id,
+                           {(e['city_name'], self.country_id(e)) for e in events})
+        await self._ensure(session, self.venues, Venue, [Venue.name, Venue.city_id, Venue.country_id], Venue.venue_id,
+                           {self.venue_key(e) for e in events})
+
+
+async def create_events_bulk(session, events: list[dict], artists_map: dict[str, Artist],
+                             resolver: ReferenceResolver | None = None,
+                             changes: RunChanges | None = None) -> list[int]:
+    """
+    Создает пачку новых событий вместе с площадками, ссылками и артистами.
+    Принимает нормализованные словари парсеров (title, event_type, place,
+    city_name, country_name, time_start, ...) и карту артистов из
+    get_or_create_artists_by_name. resolver — справочники запуска; если не передан,
+    загружается заново. Проставляет event_id в каждый созданный словарь
+    и возвращает список ID новых событий.
+    Дубликаты внутри батча (одно и то же событие в одной площадке или с одним
+    ID источника) создаются один раз,
+    уже существующие в БД события пропускаются.
+    НЕ ДЕЛАЕТ COMMIT.
+    """
+    if not events:
+        return []
+
+    # --- 1. Нормализация и дедупликация ---
+    prepared = {}
+    # (source, external_id) -> ключ группы в prepared: одно событие источника создается один раз
+    keys_by_source = {}
+    for event_data in events:
+        if not event_data.get('title') or not event_data.get('event_type'):
+            logging.warning(f"Событие без названия или типа пропущено: {event_data.get('link')}")
+            continue
+        if not event_data.get('city_name'):
+            logging.warning(f"Для события '{event_data['title']}' не указан город, используется '{DEFAULT_CITY_NAME}'.")
+            event_data['city_name'] = DEFAULT_CITY_NAME
+        if not event_data.get('country_name'):
+            logging.warning(f"Для события '{event_data['title']}' не указана страна, используется '{DEFAULT_COUNTRY_NAME}'.")
+            event_data['country_name'] = DEFAULT_COUNTRY_NAME
+        event_data['place'] = event_data.get('place') or DEFAULT_CITY_NAME
+
+        key = (event_data['title'], event_data.get('time_start'), event_data['place'],
+               event_data['city_name'], event_data['country_name'])
+        if source_key(event_data):
+            key = keys_by_source.setdefault(source_key(event_data), key)
+        prepared.setdefault(key, []).append(event_data)
+
+    if not prepared:
+        return []
+
+    batch = [group[0] for group in prepared.values()]
+
+    # --- 2. Справочники: из памяти, недостающие создаются пачкой ---
+    if resolver is None:
+        resolver = ReferenceResolver()
+    await resolver.resolve(session, batch)
+
+    # --- 3. События: многострочный INSERT ... ON CONFLICT DO NOTHING RETURNING ---
+    # Уже существующие (по ux_events_identity) события пропускаются, остальные
+    # сопоставляются с батчем по идентичности (title, date_start, venue_id).
+    def identity(e: dict) -> tuple:
+        return e['title'], e.get('time_start'), resolver.venue_id(e)
+
+    rows = [
+        {
+            'title': e['title'],
+            'description': e.get('time_string'),
+            'venue_id': resolver.venue_id(e),
+            'type_id': resolver.type_id(e),
+            'date_start': e.get('time_start'),
+            'date_end': e.get('time_end'),
+            'price_min': e.get('price_min'),
+            'price_max': e.get('price_max'),
+            'tickets_info': e.get('tickets_info'),
+            'source': (source_key(e) or (None, None))[0],
+            'external_id': (source_key(e) or (None, None))[1],
+            'content_hash': event_content_hash(e),
+        }
+        for e in batch
+    ]
+    result = await session.execute(
+        insert(Event)
+        .on_conflict_do_nothing()
+        .returning(Event.event_id, Event.title, Event.date_start, Event.venue_id),
+        rows
+    )
+    created = {(row.title, row.date_start, row.venue_id): row.event_id for row in result.all()}
+    if len(created) < len(batch):
+        logging.info(f"  - {len(batch) - len(created)} событий уже есть в БД, пропущены.")
+
+    # Группы батча с разными ID источника, но одной идентичностью, получают один
+    # event_id: {event_id: [ключи групп]}, порядок — по первой группе
+    keys_by_event_id: dict[int, list[tuple]] = {}
+    for key, event_data in zip(prepared, batch):
+        event_id = created.get(identity(event_data))
+        if event_id is None:
+            continue
+        for same_event in prepared[key]:
+            same_event['event_id'] = event_id
+        keys_by_event_id.setdefault(event_id, []).append(key)
+    event_ids = list(keys_by_event_id)
+
+    # --- 4. Ссылки и связи с артистами ---
+    links, artist_pairs = [], set()
+    for event_id, keys in keys_by_event_id.items():
+        for key in keys:
+            event_data = prepared[key][0]
+            # Ссылки со всех дублей батча: одно событие могло прийти с разных страниц
+            links.extend((event_id, same_event['link']) for same_event in prepared[key] if same_event.get('link'))
+
+            unique_artist_names = {name.lower().strip() for name in event_data.get('artists', []) if name and name.strip()}
+            for name in unique_artist_names:
+                artist_obj = artists_map.get(name)
+                if artist_obj:
+                    artist_pairs.add((event_id, artist_obj.artist_id))
+                else:
+                    logging.warning(f"Артист '{name}' не найден в pre-loaded map. Связь для события '{event_data['title']}' не будет создана.")
+    artist_rows = [{'event_id': event_id, 'artist_id': artist_id} for event_id, artist_id in artist_pairs]
+
+    links_count = await upsert_event_links(session, links)
+    if artist_rows:
+        await session.execute(insert(EventArtist).on_conflict_do_nothing(), artist_rows)
+
+    logging.info(f"  -> Подготовлено к созданию в БД: {len(event_ids)} событий, "
+                 f"{links_count} ссылок, {len(artist_rows)} связей с артистами.")
+    if changes is not None:
+        changes.created.extend(event_ids)
+    return event_ids
+
+
+def _new_value(new_values, field_name: str):
+    """Значение колонки из unnest; ID источника — только если у строки его еще нет (на случай гонки)."""
+    column_name = UPDATABLE_FIELDS[field_name][0]
+    if field_name in ('source', 'external_id'):
+        return case((Event.source.is_(None), new_values.c[column_name]), else_=getattr(Event, column_name))
+    return new_values.c[column_name]
+
+
+async def update_events_bulk(session, events: list[dict], changes: RunChanges | None = None) -> int:
+    """
+    Пакетный вариант update_event_details для событий с уже проставленным event_id.
+    Как и одиночная версия, обновляет только те поля, которые есть в словаре.
+    Сохраненные хэши изменяемых полей (events.content_hash) и ID источника читаются
+    одним запросом и сравниваются в памяти: события без изменений не обновляются
+    вовсе (нет лишних мертвых версий строк и WAL).
+    Измененные события группируются по набору полей, каждая группа — один
+    UPDATE events ... FROM unnest(...); недостающие ссылки добавляются одним
+    INSERT ... ON CONFLICT (event_id, url) DO NOTHING.
+    Возвращает число обновленных событий.
+    НЕ ДЕЛАЕТ COMMIT.
+    """
+    # Последнее значение для event_id побеждает, как при последовательных UPDATE,
+    # кроме ID источника: его сохраняет первое событие, которое его принесло
+    latest = {}
+    for event_data in events:
+        event_id = event_data.get('event_id')
+        if not event_id:
+            continue
+        previous = latest.get(event_id)
+        if previous is not None and 'source' in previous:
+            event_data = {**event_data, 'source': previous['source'], 'external_id': previous.get('external_id')}
+        latest[event_id] = event_data
+    if not latest:
+        return 0
+
+    stored = {
+        row.event_id: row
+        for row in (await session.execute(
+            select(Event.event_id, Event.content_hash, Event.source, Event.external_id)
+            .where(Event.event_id == func.any(literal(list(latest), ARRAY(Integer))))
+        )).all()
+    }
+
+    groups = {}
+    new_hashes = {}
+    unchanged_count = 0
+    for event_id, event_data in latest.items():
+        if event_id not in stored:
+            continue
+        row = stored[event_id]
+        # ID источника пишется только событию, у которого его еще нет
+        fields = tuple(
+            f for f in UPDATABLE_FIELDS
+            if f in event_data and (f not in ('source', 'external_id') or row.source is None)
+        )
+        if not fields:
+            continue
+        new_hashes[event_id] = event_content_hash(event_data)
+        key_changed = 'source' in fields and event_data.get('source') is not None
+        if new_hashes[event_id] == row.content_hash and not key_changed:
+            unchanged_count += 1
+            continue
+        groups.setdefault(fields, []).append(event_id)
+
+    updated_count = 0
+    for fields, event_ids in groups.items():
+        arrays = [literal(event_ids, ARRAY(Integer)), literal([new_hashes[i] for i in event_ids], ARRAY(String(16)))]
+        columns = [column('event_id', Integer), column('content_hash', String(16))]
+        for field_name in fields:
+            column_name, sql_type = UPDATABLE_FIELDS[field_name]
+            arrays.append(literal([latest[i].get(field_name) for i in event_ids], ARRAY(sql_type)))
+            columns.append(column(column_name, sql_type))
+
+        new_values = func.unnest(*arrays).table_valued(*columns).render_derived(name='v')
+        stmt = (
+            update(Event)
+            .where(Event.event_id == new_values.c.event_id)
+            .values({
+                'content_hash': new_values.c.content_hash,
+                **{
+                    UPDATABLE_FIELDS[field_name][0]: _new_value(new_values, field_name)
+                    for field_name in fields
+                },
+            })
+            .execution_options(synchronize_session=False)
+        )
+        result = await session.execute(stmt)
+        updated_count += result.rowcount
+        logging.info(f"  -> Обновлено {result.rowcount} событий, поля: {[UPDATABLE_FIELDS[f][0] for f in fields]}")
+        if changes is not None:
+            changes.updated.extend(event_ids)
+
+    if unchanged_count:
+        logging.info(f"  -> Без изменений, не обновлялись: {unchanged_count} событий.")
+    if changes is not None:
+        changes.unchanged += unchanged_count
+
+    # Ссылки всех событий, а не только последнего значения по event_id
+    await upsert_event_links(session, [(e['event_id'], e['link']) for e in events if e.get('event_id') and e.get('link')])
+
+    return updated_count
+
+
+async def refresh_afisha_groups():
+    """
+    Пересчитывает витрину афиши после записи результатов парсинга или архивации.
+    CONCURRENTLY не блокирует чтение: бот продолжает отдавать старые строки до конца обновления.
+    """
+    try:
+        async with parser_engine.begin() as conn:
+            await conn.execute(text(SQL_REFRESH_AFISHA_EVENT_GROUPS))
+        logging.info("Витрина афиши обновлена.")
+    except Exception as e:
+        logging.error(f"Не удалось обновить витрину афиши: {e}", exc_info=True)
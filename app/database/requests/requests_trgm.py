@@ -0,0 +1,84 @@
+# app/database/requests/requests_trgm.py
+
+from rapidfuzz import process, fuzz, utils
+from sqlalchemy import select, func, or_
+
+from ..models import read_session, Artist, Country, City
+
+# Во сколько раз больше кандидатов, чем нужно в ответе, забираем из Postgres
+# для финального ранжирования в Python
+CANDIDATES_FACTOR = 10
+
+
+def _trgm_match(column, query: str):
+    """
+    Условие, которое использует GIN-индекс gin_trgm_ops:
+    `%` — похожесть всей строки, `%>` — похожесть запроса на часть строки.
+    """
+    return or_(column.op('%')(query), column.op('%>')(query))
+
+
+def _trgm_rank(column, query: str):
+    return func.greatest(func.similarity(column, query), func.word_similarity(query, column))
+
+
+def _rescore(query: str, candidates: list[str], limit: int, threshold: int) -> list[tuple[str, float, int]]:
+    """
+    Финальное ранжирование тем же скорером, что и в Python-бэкенде (WRatio),
+    чтобы SIMILARITY_THRESHOLD и флаг точного совпадения значили то же самое.
+    """
+    if not candidates:
+        return []
+    return process.extract(
+        query,
+        candidates,
+        scorer=fuzz.WRatio,
+        processor=utils.default_process,
+        limit=limit,
+        score_cutoff=threshold,
+    )
+
+
+async def find_artists_trgm(query: str, limit: int, threshold: int) -> list[tuple[Artist, float]]:
+    """Возвращает [(Artist, score)] — top-N кандидатов отбираются в Postgres по триграммам."""
+    async with read_session() as session:
+        stmt = (
+            select(Artist)
+            .where(_trgm_match(Artist.name, query))
+            .order_by(_trgm_rank(Artist.name, query).desc())
+            .limit(limit * CANDIDATES_FACTOR)
+        )
+        candidates = (await session.execute(stmt)).scalars().all()
+
+    found = _rescore(query, [artist.name for artist in candidates], limit, threshold)
+    return [(candidates[index], score) for _, score, index in found]
+
+
+async def find_countries_trgm(query: str, limit: int, threshold: int) -> list[str]:
+    async with read_session() as session:
+        stmt = (
+            select(Country.name)
+            .where(_trgm_match(Country.name, query))
+            .order_by(_trgm_rank(Country.name, query).desc())
+            .limit(limit * CANDIDATES_FACTOR)
+        )
+        candidates = (await session.execute(stmt)).scalars().all()
+
+    return [name for name, _, _ in _rescore(query, candidates, limit, threshold)]
+
+
+async def find_cities_trgm(country_name: str, query: str, limit: int, threshold: int) -> list[str]:
+    async with read_session() as session:
+        stmt = (
+            select(City.name)
+            .join(Country)
+            .where(
+                Country.name == country_name,
+                _trgm_match(City.name, query)
+            )
+            .order_by(_trgm_rank(City.name, query).desc())
+            .limit(limit * CANDIDATES_FACTOR)
+        )
+        candidates = (await session.execute(stmt)).scalars().all()
+
+    return [name for name, _, _ in _rescore(query, candidates, limit, threshold)]
@@ -64,6 +64,15 @@ async def send_long_message(message: Message, text: str, lexicon: Lexicon, **kwa
         
     return sent_message_ids # <-- ВАЖНО: Убедитесь, что эта строка есть
 
+def _afisha_page_state(city_name: str, country_name: str | None, next_cursors: dict, sent_messages_ids: list[int]) -> dict:
+    """Данные FSM, по которым afisha_next_page продолжит выдачу с того же места."""
+    return {
+        'afisha_city': city_name,
+        'afisha_country': country_name,
+        'afisha_cursors': next_cursors or None,
+        'afisha_keyboard_message_id': sent_messages_ids[-1] if sent_messages_ids else None,
+    }
+
 async def show_filter_type_choice(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     date_from_str = data.get("date_from")
@@ -190,13 +199,11 @@ async def afisha_by_my_prefs(callback: CallbackQuery, state: FSMContext):
 
     city_name, event_types = user_prefs["home_city"], user_prefs["preferred_event_types"]
 
-    events_by_category = {}
-    for etype in event_types:
-        # Передаем в функцию БД уже готовые объекты datetime
-        events = await db.get_grouped_events_by_city_and_category(city_name, etype, date_from, date_to)
-        if events: events_by_category[etype] = events
-            
-    response_text, event_ids = await format_events_with_headers(events_by_category, city_name, lexicon)
+    # Все категории и страна города — одним запросом
+    events_by_category, next_cursors = await db.get_grouped_events_by_city_and_categories(city_name, event_types, date_from, date_to)
+    country_name = next((events[0].country_name for events in events_by_category.values()), None)
+
+    response_text, event_ids = await format_events_with_headers(events_by_category, city_name, lexicon, country_name)
     
     header_text = lexicon.get('afisha_results_by_prefs_header').format(city_name=hbold(city_name))
     header_message = await callback.message.edit_text(header_text, parse_mode=ParseMode.HTML)
@@ -209,11 +216,12 @@ async def afisha_by_my_prefs(callback: CallbackQuery, state: FSMContext):
     sent_messages_ids = await send_long_message(
         callback.message, response_text, lexicon,
         parse_mode=ParseMode.HTML, disable_web_page_preview=True,
-        reply_markup=kb.get_afisha_actions_keyboard(lexicon)
+        reply_markup=kb.get_afisha_actions_keyboard(lexicon, show_next_page=bool(next_cursors))
     )
     await state.update_data(
         last_shown_event_ids=event_ids,
-        messages_to_delete_on_expire=[header_message.message_id] + sent_messages_ids
+        messages_to_delete_on_expire=[header_message.message_id] + sent_messages_ids,
+        **_afisha_page_state(city_name, country_name, next_cursors, sent_messages_ids)
     )
 
 @router.callback_query(AfishaFlowFSM.choosing_filter_type, F.data == "filter_type:temporary")
@@ -393,13 +401,11 @@ async def temp_finish_and_display(callback: CallbackQuery, state: FSMContext):
         await callback.answer(lexicon.get('select_at_least_one_event_type_alert'), show_alert=True)
         return
         
-    events_by_category = {}
-    for etype in event_types:
-        # Передаем в функцию БД уже готовые объекты datetime
-        events = await db.get_grouped_events_by_city_and_category(city_name, etype, date_from, date_to)
-        if events: events_by_category[etype] = events
-            
-    response_text, event_ids = await format_events_with_headers(events_by_category, city_name, lexicon) 
+    # Все категории и страна города — одним запросом
+    events_by_category, next_cursors = await db.get_grouped_events_by_city_and_categories(city_name, event_types, date_from, date_to)
+    country_name = next((events[0].country_name for events in events_by_category.values()), None)
+
+    response_text, event_ids = await format_events_with_headers(events_by_category, city_name, lexicon, country_name)
     
     header_text = lexicon.get('afisha_results_for_city_header').format(city_name=hbold(city_name))
     try:
@@ -416,14 +422,81 @@ async def temp_finish_and_display(callback: CallbackQuery, state: FSMContext):
     sent_messages_ids = await send_long_message(
         callback.message, response_text, lexicon,
         parse_mode=ParseMode.HTML, disable_web_page_preview=True,
-        reply_markup=kb.get_afisha_actions_keyboard(lexicon)
+        reply_markup=kb.get_afisha_actions_keyboard(lexicon, show_next_page=bool(next_cursors))
     )
 
     # Правильно сохраняем
     await state.update_data(
         last_shown_event_ids=event_ids,
-        messages_to_delete_on_expire=[header_message.message_id] + sent_messages_ids
+        messages_to_delete_on_expire=[header_message.message_id] + sent_messages_ids,
+        **_afisha_page_state(city_name, country_name, next_cursors, sent_messages_ids)
+    )
+
+
+@router.callback_query(
+    or_f(AfishaFlowFSM.choosing_filter_type, AfishaFlowFSM.temp_choosing_event_types),
+    F.data == "afisha_next_page"
+)
+async def afisha_next_page(callback: CallbackQuery, state: FSMContext):
+    """
+    Следующая страница афиши. Курсоры категорий лежат в FSM, поэтому запрос
+    начинает ровно с места, где закончилась прошлая страница, без OFFSET.
+    Нумерация продолжается, чтобы номера для подписки оставались сквозными.
+    """
+    data = await state.get_data()
+    lexicon = Lexicon(callback.from_user.language_code)
+    cursors = data.get("afisha_cursors")
+    city_name = data.get("afisha_city")
+    if not cursors or not city_name:
+        await callback.answer(lexicon.get('session_expired_alert'), show_alert=True)
+        return
+
+    date_from_str = data.get("date_from")
+    date_to_str = data.get("date_to")
+    date_from = datetime.fromisoformat(date_from_str) if date_from_str else None
+    date_to = datetime.fromisoformat(date_to_str) if date_to_str else None
+
+    events_by_category, next_cursors = await db.get_grouped_events_by_city_and_categories(
+        city_name, list(cursors), date_from, date_to, cursors=cursors
     )
+    shown_ids = data.get("last_shown_event_ids") or []
+    response_text, event_ids = await format_events_with_headers(
+        events_by_category, city_name, lexicon, data.get("afisha_country"), start_number=len(shown_ids) + 1
+    )
+
+    # Кнопка "Показать еще" остается только под последней страницей
+    previous_keyboard_message_id = data.get("afisha_keyboard_message_id")
+    if previous_keyboard_message_id:
+        try:
+            await callback.bot.edit_message_reply_markup(
+                chat_id=callback.message.chat.id, message_id=previous_keyboard_message_id,
+                reply_markup=kb.get_afisha_actions_keyboard(lexicon)
+            )
+        except TelegramBadRequest:
+            pass
+
+    if not event_ids:
+        await state.update_data(afisha_cursors=None)
+        await callback.answer(lexicon.get('afisha_nothing_found_for_query'), show_alert=True)
+        return
+
+    sent_messages_ids = await send_long_message(
+        callback.message, response_text, lexicon,
+        parse_mode=ParseMode.HTML, disable_web_page_preview=True,
+        reply_markup=kb.get_afisha_actions_keyboard(lexicon, show_next_page=bool(next_cursors))
+    )
+    await state.update_data(
+        last_shown_event_ids=shown_ids + event_ids,
+        messages_to_delete_on_expire=(data.get("messages_to_delete_on_expire") or []) + sent_messages_ids,
+        **_afisha_page_state(city_name, data.get("afisha_country"), next_cursors, sent_messages_ids)
+    )
+    await callback.answer()
+
+
+@router.callback_query(F.data == "afisha_next_page")
+async def afisha_next_page_expired_session(callback: CallbackQuery, state: FSMContext):
+    lexicon = Lexicon(callback.from_user.language_code)
+    await callback.answer(lexicon.get('session_expired_alert'), show_alert=True)
 # --- ДОБАВЛЕНИЕ В ПОДПИСКИ (остается без изменений) ---
 
 @router.callback_query(CombinedFlow.active, F.data == "add_events_to_subs")
@@ -127,7 +127,7 @@ async def cq_view_events_for_favorite(callback: CallbackQuery, state: FSMContext
     )
     user_id = callback.from_user.id
     
-    all_future_events = await db.get_future_events_for_artists([artist_id])
+    all_future_events = await db.get_future_event_cards_for_artists([artist_id], user_id=user_id)
     favorite_details = await db.get_favorite_details(user_id, artist_id)
     tracked_regions = favorite_details.regions if favorite_details else []
     
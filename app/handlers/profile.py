@@ -311,7 +311,7 @@ async def show_subscriptions_list(callback_or_message: Message | CallbackQuery,
     user_lang = await db.get_user_lang(callback_or_message.from_user.id)
     lexicon = Lexicon(user_lang)
     
-    subs = await db.get_user_subscriptions(user_id)
+    subs = await db.get_user_subscription_items(user_id)
     
     text = lexicon.get('subs_menu_header_active')
     if not subs:
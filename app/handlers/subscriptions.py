@@ -92,7 +92,7 @@ async def show_events_for_new_favorites(callback: CallbackQuery, state: FSMConte
     """
     user_lang = await db.get_user_lang(callback.from_user.id)
     lexicon = Lexicon(user_lang)
-    found_events = await db.get_future_events_for_artists(artist_ids)
+    found_events = await db.get_future_event_cards_for_artists(artist_ids, user_id=callback.from_user.id)
     
     if not found_events:
         no_events_text = "\n\n" + lexicon.get('no_future_events_for_favorites')
@@ -366,6 +366,7 @@ async def finish_adding_subscriptions(callback: CallbackQuery, state: FSMContext
                 added_artist_ids.append(artist.artist_id)
                 added_artist_names.append(artist.name)
         await session.commit()
+    await db.user_changed(callback.from_user.id)
 
     if not added_artist_ids:
         await callback.message.edit_text(lexicon.get('failed_to_add_artists'))
@@ -761,10 +762,11 @@ async def cq_finish_recommendation_selection(callback: CallbackQuery, state: FSM
         for artist_id in selected_ids:
             await db.add_artist_to_favorites(session, callback.from_user.id, artist_id, general_mobility)
         await session.commit()
+    await db.user_changed(callback.from_user.id)
     
     # 2. Ищем события для новых артистов
     selected_artist_names = [a['name'] for a in all_artists_data if a['artist_id'] in selected_ids]
-    found_events = await db.get_future_events_for_artists(selected_ids)
+    found_events = await db.get_future_event_cards_for_artists(selected_ids, user_id=callback.from_user.id)
     response_text, new_event_ids_to_subscribe = await format_events_by_artist(found_events, selected_artist_names, lexicon) # <-- Переименовал для ясности
 
     # 3. Готовим итоговое сообщение и клавиатуру
@@ -5,7 +5,7 @@ from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 from dateutil.relativedelta import relativedelta
 from app.lexicon import EVENT_TYPE_EMOJI
 
-def get_afisha_actions_keyboard(lexicon, show_back_button: bool = False) -> InlineKeyboardMarkup:
+def get_afisha_actions_keyboard(lexicon, show_back_button: bool = False, show_next_page: bool = False) -> InlineKeyboardMarkup:
     """
     Клавиатура с действиями после показа списка событий (из Афиши или после добавления в избранное).
     """
@@ -14,6 +14,13 @@ def get_afisha_actions_keyboard(lexicon, show_back_button: bool = False) -> Inli
         text=lexicon.get('afisha_add_to_subs_button'), 
         callback_data="add_events_to_subs"
     )
+    if show_next_page:
+        builder.row(
+            InlineKeyboardButton(
+                text=lexicon.get('afisha_next_page_button'),
+                callback_data="afisha_next_page"
+            )
+        )
     # --- НОВОЕ: Условное добавление кнопки "Назад" ---
     if show_back_button:
         builder.row(
@@ -26,11 +26,7 @@ def get_manage_subscriptions_keyboard(subscriptions: list, lexicon) -> InlineKey
     builder = InlineKeyboardBuilder()
     if subscriptions:
         for sub_event in subscriptions:
-            user_subscription = next((sub for sub in sub_event.subscriptions), None)
-            
-            status_emoji = ""
-            if user_subscription:
-                status_emoji = "▶️" if user_subscription.status == 'active' else "⏸️"
+            status_emoji = "▶️" if sub_event.status == 'active' else "⏸️"
 
             # --- ИЗМЕНЕНИЕ: Добавляем дату в текст кнопки ---
             date_str = ""
@@ -172,6 +172,7 @@ class Lexicon:
                 'favorite_edit_regions_prompt': "Измените регионы отслеживания для: {artist_name}",
                 'favorite_regions_updated_alert': "✅ Регионы для избранного обновлены!",
                 'afisha_add_to_subs_button': "➕ Добавить в подписки",
+                'afisha_next_page_button': "➡️ Показать еще",
                 'subs_enter_numbers_prompt': "Введите номера событий, которые хотите отслеживать, через запятую или пробел (например: 1, 3, 5).",
                 'subs_invalid_numbers_error': "⚠️ Ошибка: номера {invalid_list} некорректны. Пожалуйста, вводите только те номера, что видите в списке.",
                 'subs_added_success': "✅ Успешно добавлено в подписки: {count} шт.",
@@ -386,6 +387,7 @@ Enjoy your search! ✨""",
                 'favorite_edit_regions_prompt': "Edit tracking regions for: {artist_name}",
                 'favorite_regions_updated_alert': "✅ Favorite's regions have been updated!",
                 'afisha_add_to_subs_button': "➕ Add to Subscriptions",
+                'afisha_next_page_button': "➡️ Show more",
                 'subs_enter_numbers_prompt': "Enter the numbers of the events you want to track, separated by a comma or space (e.g., 1, 3, 5).",
                 'subs_invalid_numbers_error': "⚠️ Error: The numbers {invalid_list} are invalid. Please enter only the numbers you see in the list.",
                 'subs_added_success': "✅ Successfully added to subscriptions: {count} item(s).",
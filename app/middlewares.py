@@ -0,0 +1,31 @@
+# app/middlewares.py
+
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from app.database.query_stats import tag_queries
+
+
+class QueryTagMiddleware(BaseMiddleware):
+    """
+    Помечает SQL-запросы хендлера его именем (модуль.функция) для статистики
+    app/database/query_stats.py. Регистрируется как inner-middleware: к этому
+    моменту aiogram уже выбрал хендлер и положил его в data["handler"].
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        callback = getattr(handler_object, "callback", None)
+        if callback is None:
+            return await handler(event, data)
+
+        module = callback.__module__.rsplit(".", 1)[-1]
+        with tag_queries(f"{module}.{callback.__name__}"):
+            return await handler(event, data)
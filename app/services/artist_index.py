@@ -0,0 +1,125 @@
+# app/services/artist_index.py
+
+import asyncio
+import logging
+from array import array
+
+from rapidfuzz import process, fuzz, utils
+from sqlalchemy import select
+
+from app.database.models import async_session, Artist
+
+
+class ArtistSearchIndex:
+    """
+    Процессный индекс для нечеткого поиска артистов.
+
+    Хранит только ID и заранее нормализованные имена в компактных массивах,
+    поэтому поиск не ходит в БД и не создает ORM-объекты на каждый запрос.
+    Загружается один раз при старте и дозагружает новых артистов по artist_id.
+    """
+
+    def __init__(self):
+        self._ids = array('q')
+        self._names: list[str] = []
+        # Максимальный ID, до которого таблица уже прочитана через load()/refresh()
+        self._max_loaded_id = 0
+        # ID, добавленные точечно через add() (например, из LISTEN/NOTIFY),
+        # чтобы refresh() не продублировал их
+        self._added_ids: set[int] = set()
+        self._loaded = False
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._loaded
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def _append(self, artist_id: int, name: str):
+        normalized = utils.default_process(name)
+        if not normalized:
+            return
+        self._ids.append(artist_id)
+        self._names.append(normalized)
+
+    async def load(self):
+        """Полная загрузка индекса из таблицы artists (только ID и имя)."""
+        async with self._lock:
+            async with async_session() as session:
+                result = await session.execute(
+                    select(Artist.artist_id, Artist.name).order_by(Artist.artist_id)
+                )
+                rows = result.all()
+
+            self._ids = array('q')
+            self._names = []
+            self._added_ids.clear()
+            for artist_id, name in rows:
+                self._append(artist_id, name)
+            self._max_loaded_id = rows[-1].artist_id if rows else 0
+            self._loaded = True
+        logging.info(f"Индекс артистов загружен: {len(self._ids)} имен.")
+
+    async def refresh(self):
+        """Дозагружает артистов, добавленных в БД после последней загрузки."""
+        if not self._loaded:
+            await self.load()
+            return
+
+        async with self._lock:
+            async with async_session() as session:
+                result = await session.execute(
+                    select(Artist.artist_id, Artist.name)
+                    .where(Artist.artist_id > self._max_loaded_id)
+                    .order_by(Artist.artist_id)
+                )
+                rows = result.all()
+
+            if not rows:
+                return
+            added = 0
+            for artist_id, name in rows:
+                if artist_id in self._added_ids:
+                    continue
+                self._append(artist_id, name)
+                added += 1
+            self._max_loaded_id = rows[-1].artist_id
+            self._added_ids = {i for i in self._added_ids if i > self._max_loaded_id}
+        if added:
+            logging.info(f"Индекс артистов дополнен: +{added} имен.")
+
+    def add(self, artist_id: int, name: str):
+        """
+        Точечно добавляет артиста в уже загруженный индекс.
+        Если индекс еще не загружен, ничего не делает — артист попадет в него при load().
+        """
+        if not self._loaded or not artist_id or not name:
+            return
+        if artist_id <= self._max_loaded_id or artist_id in self._added_ids:
+            return
+        self._added_ids.add(artist_id)
+        self._append(artist_id, name)
+
+    def search(self, query: str, limit: int = 5, score_cutoff: float = 0) -> list[tuple[int, float]]:
+        """
+        Возвращает список (artist_id, score), отсортированный по убыванию схожести.
+        Скоринг совпадает с thefuzz.process.extract (WRatio + default_process).
+        """
+        normalized_query = utils.default_process(query or "")
+        if not normalized_query or not self._names:
+            return []
+
+        found = process.extract(
+            normalized_query,
+            self._names,
+            scorer=fuzz.WRatio,
+            processor=None,
+            limit=limit,
+            score_cutoff=score_cutoff,
+        )
+        return [(self._ids[index], score) for _, score, index in found]
+
+
+artist_index = ArtistSearchIndex()
@@ -6,12 +6,14 @@ from aiogram.utils.markdown import hbold, hitalic
 from aiogram.exceptions import TelegramForbiddenError
 
 from app.database.models import listener_engine
+from app.database.query_stats import query_tag
 from app.database.requests import requests_favorite_notifier as db_notifier
 from app.database.requests.requests import get_user_lang
 from app.keyboards.keyboards_notifier import get_add_to_subscriptions_keyboard
 from app.lexicon import Lexicon
 # Правильный импорт вашей функции
 from app.services.recommendation import get_recommended_artists
+from app.services.artist_index import artist_index
 from app.handlers.subscriptions import RecommendationFlow # Импортируем наш новый FSM
 from aiogram.fsm.storage.redis import RedisStorage # Или ваш FSM Storage
 from app.keyboards import keyboards as kb
@@ -22,6 +24,8 @@ from aiogram.fsm.storage.base import StorageKey
 
 async def notification_handler(bot: Bot, connection, pid, channel, payload):
     """Обрабатывает уведомление о новом событии из БД."""
+    # Каждое уведомление обрабатывается в своей задаче, тег не утекает наружу
+    query_tag.set("listener.notification_handler")
     print(f"\n--- Получено новое событие от PID {pid} по каналу {channel} ---")
     data = json.loads(payload)
     
@@ -42,6 +46,9 @@ async def notification_handler(bot: Bot, connection, pid, channel, payload):
         print("Ошибка в payload: отсутствует artist_id или event_id.")
         return
 
+    # Новый артист сразу становится доступен в поиске, не дожидаясь refresh()
+    artist_index.add(artist_id, artist_name_payload)
+
     subscribers = await db_notifier.get_favorite_subscribers_by_artist(artist_id)
     print(f"Найдено подписчиков на '{artist_name_payload or 'ID:'+str(artist_id)}': {len(subscribers)} чел.")
 
@@ -6,6 +6,7 @@ from aiogram.utils.markdown import hbold
 from aiogram.exceptions import TelegramForbiddenError
 
 from app.database.requests import requests_notifier as db_notifier
+from app.database.query_stats import query_tag
 from app.lexicon import Lexicon
 from app.utils.utils import format_event_date
 
@@ -13,6 +14,8 @@ async def send_reminders(bot: Bot):
     """
     Основная функция уведомителя. Собирает подписки и рассылает напоминания.
     """
+    # Планировщик запускает задачу в отдельном asyncio.Task, тег действует только в ней
+    query_tag.set("notifier.send_reminders")
     # 1. Получаем все активные подписки одним запросом
     active_subscriptions = await db_notifier.get_active_subscriptions_for_notify()
 
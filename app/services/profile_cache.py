@@ -0,0 +1,74 @@
+# app/services/profile_cache.py
+
+import json
+import logging
+import os
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+# Тот же Redis, что и у RedisStorage бота
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Страховка на случай пропущенной инвалидации: профиль все равно перечитается из БД
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", 3600))
+
+# Поля профиля пользователя, которые хранятся в хэше user_profile:<user_id>
+PROFILE_FIELDS = (
+    "language_code",
+    "home_country",
+    "home_city",
+    "preferred_event_types",
+    "main_geo_completed",
+    "general_geo_completed",
+    "general_mobility_regions",
+    "favorites_count",
+    "subscriptions_count",
+)
+
+_redis: Redis | None = None
+
+
+def _get_redis() -> Redis:
+    global _redis
+    if _redis is None:
+        _redis = Redis.from_url(REDIS_URL, decode_responses=True, socket_timeout=0.5, socket_connect_timeout=0.5)
+    return _redis
+
+
+def _key(user_id: int) -> str:
+    return f"user_profile:{user_id}"
+
+
+async def get_profile(user_id: int) -> dict | None:
+    """
+    Возвращает профиль из кэша или None, если его там нет.
+    Ошибки Redis не пробрасываются — вызывающий код просто идет в БД.
+    """
+    try:
+        raw = await _get_redis().hgetall(_key(user_id))
+    except RedisError as e:
+        logging.warning(f"Кэш профилей недоступен, читаю из БД: {e}")
+        return None
+    if not raw or any(field not in raw for field in PROFILE_FIELDS):
+        return None
+    return {field: json.loads(raw[field]) for field in PROFILE_FIELDS}
+
+
+async def set_profile(user_id: int, profile: dict):
+    """Кладет профиль в кэш одним хэшем с TTL."""
+    mapping = {field: json.dumps(profile.get(field), ensure_ascii=False) for field in PROFILE_FIELDS}
+    try:
+        async with _get_redis().pipeline(transaction=True) as pipe:
+            pipe.hset(_key(user_id), mapping=mapping)
+            pipe.expire(_key(user_id), PROFILE_CACHE_TTL)
+            await pipe.execute()
+    except RedisError as e:
+        logging.warning(f"Не удалось сохранить профиль {user_id} в кэш: {e}")
+
+
+async def invalidate(user_id: int):
+    """Сбрасывает профиль после любого изменения пользователя, его избранного или подписок."""
+    try:
+        await _get_redis().delete(_key(user_id))
+    except RedisError as e:
+        logging.warning(f"Не удалось сбросить кэш профиля {user_id}: {e}")
@@ -11,6 +11,7 @@ from aiogram.utils.markdown import hbold,hitalic
 
 from ..database.requests import requests as db
 from ..database.models import async_session
+from ..database.projections import EventCard
 from app import keyboards as kb
 from ..lexicon import Lexicon, LEXICON_COMMANDS_RU, LEXICON_COMMANDS_EN, EVENT_TYPE_EMOJI
 from app.handlers.onboarding import start_onboarding_process
@@ -49,19 +50,22 @@ async def set_main_menu(bot: Bot, lang: str):
     main_menu_commands = [BotCommand(command=cmd, description=desc) for cmd, desc in commands.items()]
     await bot.set_my_commands(main_menu_commands)
 
-async def format_events_with_headers(events_by_category: dict,city_name: str, lexicon) -> tuple[str, list[int]]:
+async def format_events_with_headers(events_by_category: dict, city_name: str, lexicon, country_name: str = None, start_number: int = 1) -> tuple[str, list[int]]:
     """
     Форматирует словарь {категория: [события]} в единый текст с заголовками
     и возвращает сквозной список ID.
+    Страна нужна для валюты цены; если ее не передали, она ищется по городу.
+    start_number — с какого номера продолжать нумерацию (для следующих страниц).
     """
     if not events_by_category:
         return "По вашему запросу ничего не найдено.", []
     
-    country_name = await db.get_country_by_city_name(city_name)
+    if country_name is None:
+        country_name = await db.get_country_by_city_name(city_name)
 
     response_parts = []
     event_ids_in_order = []
-    counter = 1  # Сквозной счетчик для нумерации
+    counter = start_number  # Сквозной счетчик для нумерации
 
     for category_name, events in events_by_category.items():
         # Добавляем заголовок категории
@@ -124,10 +128,17 @@ async def format_events_for_response(events: list,lexicon) -> str:
     separator = "\n\n" + "—" * 15 + "\n\n"
     return separator.join(response_parts)
 
+def _format_place(event: EventCard) -> str:
+    """'Площадка, Город (Страна)' для карточки события."""
+    if not event.venue_name:
+        return "—"
+    return f"{event.venue_name}, {event.city_name or ''} ({event.country_name or ''})"
+
 async def format_events_by_artist(
-    events: list,
+    events: list[EventCard],
     target_artist_names: list[str], # <-- НОВЫЙ АРГУМЕНТ
-    lexicon: Lexicon
+    lexicon: Lexicon,
+    start_number: int = 1
 ) -> tuple[str | None, list[int] | None]:
     # ...
     if not events:
@@ -139,18 +150,18 @@ async def format_events_by_artist(
     # Создаем set для быстрой проверки
     target_artist_set = set(name.lower() for name in target_artist_names)
     for event in events:
-        for event_artist in event.artists:
+        for artist_name in event.artist_names:
             # Проверяем, является ли артист события одним из тех, кого мы искали
-            if event_artist.artist.name.lower() in target_artist_set:
+            if artist_name.lower() in target_artist_set:
                 # Группируем по имени в правильном регистре из БД
-                events_by_artist[event_artist.artist.name].append(event)
+                events_by_artist[artist_name].append(event)
     
     # Сортируем артистов по алфавиту для предсказуемого вывода
     sorted_artist_names = sorted(events_by_artist.keys())
 
     response_parts = []
     event_ids_in_order = []
-    counter = 1  # Сквозной счетчик для нумерации
+    counter = start_number  # Сквозной счетчик для нумерации
 
     # 2. Формируем текстовые блоки для каждого артиста
     for artist_name in sorted_artist_names:
@@ -176,17 +187,13 @@ async def format_events_by_artist(
             date_str = format_event_date(event.date_start, lexicon)
             
             # Место
-            place_info = "—"
-            if event.venue:
-                city_name = event.venue.city.name if event.venue.city else ""
-                country_name = event.venue.city.country.name if event.venue.city and event.venue.city.country else ""
-                place_info = f"{event.venue.name}, {city_name} ({country_name})"
+            place_info = _format_place(event)
 
             # Билеты
             tickets_str = event.tickets_info if event.tickets_info and event.tickets_info != "В наличии" else lexicon.get('no_info') # Добавьте 'no_info': 'Нет информации' в лексикон
             
             # Ссылка
-            url = event.links[0].url if event.links else None
+            url = event.url
             title_text = f"{counter}. {event.title}"
             title_with_link = f'<a href="{url}">{hbold(title_text)}</a>' if url else hbold(title_text)
             
@@ -207,7 +214,7 @@ async def format_events_by_artist(
 
 
 async def format_events_by_artist_with_region_split(
-    events: list,
+    events: list[EventCard],
     tracked_regions: list[str],
     lexicon: Lexicon
 ) -> tuple[str | None, list[int] | None]:
@@ -229,8 +236,8 @@ async def format_events_by_artist_with_region_split(
         if is_already_added:
             continue
             
-        event_country = event.venue.city.country.name.lower() if event.venue and event.venue.city and event.venue.city.country else ""
-        event_city = event.venue.city.name.lower() if event.venue and event.venue.city else ""
+        event_country = (event.country_name or "").lower()
+        event_city = (event.city_name or "").lower()
         
         if event_country in tracked_regions_set or event_city in tracked_regions_set:
             events_in_tracked_regions.append(event)
@@ -279,13 +286,9 @@ async def format_events_by_artist_with_region_split(
 
         # --- Блок форматирования карточки (теперь он здесь один раз) ---
         date_str = format_event_date(event.date_start, lexicon)
-        place_info = "—"
-        if event.venue:
-            city_name = event.venue.city.name if event.venue.city else ""
-            country_name = event.venue.city.country.name if event.venue.city and event.venue.city.country else ""
-            place_info = f"{event.venue.name}, {city_name} ({country_name})"
+        place_info = _format_place(event)
         tickets_str = event.tickets_info if event.tickets_info and event.tickets_info != "В наличии" else lexicon.get('no_info')
-        url = event.links[0].url if event.links else None
+        url = event.url
         title_text = f"{counter}. {event.title}"
         title_with_link = f'<a href="{url}">{hbold(title_text)}</a>' if url else hbold(title_text)
         
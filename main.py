@@ -1,11 +1,15 @@
 import asyncio
 from aiogram import Bot, Dispatcher
-from app.database.models import async_main
+from app.database.models import async_main, FUZZY_SEARCH_BACKEND
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from app.handlers  import main_router as router
 from app.services.listener import listen_for_db_notifications
 from app.services.notifier import send_reminders
+from app.services.artist_index import artist_index
+from app.services.profile_cache import REDIS_URL
+from app.database import query_stats
+from app.middlewares import QueryTagMiddleware
 from aiogram.fsm.storage.redis import RedisStorage
 
 import os
@@ -17,15 +21,25 @@ load_dotenv()
 async def main():
     bot = Bot(token=os.getenv("BOT_TOKEN"))
     await async_main()
-    storage = RedisStorage.from_url('redis://localhost:6379/0')
+    if FUZZY_SEARCH_BACKEND != 'pg_trgm':
+        await artist_index.load()
+    storage = RedisStorage.from_url(REDIS_URL)
     listener_task = asyncio.create_task(listen_for_db_notifications(bot, storage))
     scheduler = AsyncIOScheduler(timezone="Europe/Minsk") # Укажите ваш часовой пояс
     scheduler.add_job(send_reminders, 'interval', seconds=30, args=(bot,))
+    # Дозагрузка артистов, добавленных парсерами (в т.ч. без событий, из artists.txt)
+    if artist_index.is_loaded:
+        scheduler.add_job(artist_index.refresh, 'interval', minutes=5)
+    # Снимок статистики SQL для python -m app.database.query_stats
+    scheduler.add_job(query_stats.publish, 'interval', minutes=1, args=("bot",))
     scheduler.start()
     print("Планировщик уведомлений запущен.")
     print("Слушатель уведомлений от базы данных запущен в фоновом режиме.")
     dp = Dispatcher(storage=storage)
     dp.include_router(router)
+    # Тег хендлера для статистики SQL
+    dp.message.middleware(QueryTagMiddleware())
+    dp.callback_query.middleware(QueryTagMiddleware())
     await dp.start_polling(bot)
     
 
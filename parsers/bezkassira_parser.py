@@ -1,11 +1,13 @@
 # --- START OF FILE parsers/bezkassira_parser.py ---
 
 import requests
-from bs4 import BeautifulSoup
 from datetime import datetime
 import locale
 import time
 
+from parsers.html_extract import extract_bezkassira_cards
+from parsers.html_pool import run_extractor
+
 # Устанавливаем русскую локаль для корректного парсинга названий месяцев
 try:
     locale.setlocale(locale.LC_TIME, 'ru_RU.UTF-8')
@@ -43,11 +45,10 @@ def parse(config: dict) -> list[dict]:
         print(f"  - Ошибка при запросе к сайту {site_name}: {e}")
         return []
 
-    soup = BeautifulSoup(response.text, 'lxml')
     selectors = config['selectors']
 
-    # Теперь мы ищем родительскую карточку
-    event_cards = soup.select(selectors['event_card'])
+    # Разбор карточек — в пуле процессов (parsers/html_pool.py)
+    event_cards = run_extractor(extract_bezkassira_cards, response.text, selectors)
 
     if not event_cards:
         print(f"  - Не найдено карточек событий для {site_name} по селектору '{selectors['event_card']}'.")
@@ -56,34 +57,22 @@ def parse(config: dict) -> list[dict]:
     print(f"  - Найдено {len(event_cards)} событий для {site_name}. Начинаю обработку...")
 
     for i, card in enumerate(event_cards):
-        # Ищем элементы внутри родительской карточки
-        caption_div = card.select_one(selectors['caption'])
-        if not caption_div:
-            continue
-
-        title_element = caption_div.select_one(selectors['title'])
-        link_element = caption_div.select_one(selectors['link'])
-        date_element = card.select_one(selectors['date'])
-        place_element = card.select_one(selectors['place'])
-
-        if not all([title_element, link_element, date_element, place_element]):
-            # print(f"  - Пропускаю карточку {i+1}, не все данные найдены.")
-            continue
-
-        title = title_element.get_text(strip=True)
-        link = link_element['href']
+        title = card['title']
+        link = card['href']
 
         if not link.startswith('http'):
             link = "https://bezkassira.by" + link
 
-        date_str = date_element.get_text(strip=True)
-        place_str = place_element.get_text(separator=" ", strip=True)
+        date_str = card['date_str']
+        place_str = card['place']
 
         dt_object = parse_date(date_str)
         timestamp = int(dt_object.timestamp()) if dt_object else None
 
         # Цены не парсим с главной, оставляем None
         event_info = {
+            'source': 'bezkassira',
+            'external_id': card['href'].split('?', 1)[0].strip('/'),
             'title': title,
             'place': place_str,
             'time': "Время уточняйте на сайте",
@@ -0,0 +1,114 @@
+# --- START OF FILE parsers/html_extract.py ---
+#
+# Чистые функции разбора HTML для пула процессов (parsers/html_pool.py).
+# На вход — сырой HTML страницы, на выход — компактные словари/списки строк,
+# которые дешево передать обратно в основной процесс. Модуль специально не
+# импортирует ни Selenium, ни БД: его загружает каждый процесс пула.
+
+import re
+
+from bs4 import BeautifulSoup
+
+_PRICE_FROM = re.compile(r'от \d+')
+_DIGITS = re.compile(r'\d+')
+
+
+def extract_yandex_cards(html: str) -> dict:
+    """
+    Карточки страницы списка Яндекс.Афиши.
+    Возвращает {'links': ссылки всех карточек, 'cards': [{href, title, date_str, place, price_min}],
+    'card_texts': текст карточек (для хэша страницы в crawl_state), 'errors': [...]}.
+    """
+    soup = BeautifulSoup(html, 'lxml')
+    event_cards = soup.find_all("div", attrs={"data-test-id": "eventCard.root"})
+    result = {'links': [], 'cards': [], 'card_texts': [], 'errors': []}
+    for card in event_cards:
+        result['card_texts'].append(card.get_text(" ", strip=True))
+        link_element = card.find("a", attrs={"data-test-id": "eventCard.link"})
+        href = link_element.get('href') if link_element else None
+        if not href:
+            continue
+        result['links'].append(href)
+        try:
+            title = card.find("h2", attrs={"data-test-id": "eventCard.eventInfoTitle"}).get_text(strip=True)
+
+            place, date_str = "Место не указано", "Дата не указана"
+            if details_list := card.find("ul", attrs={"data-test-id": "eventCard.eventInfoDetails"}):
+                items = details_list.find_all("li")
+                if len(items) > 0: date_str = items[0].get_text(strip=True)
+                if len(items) > 1: place = items[1].find('a').get_text(strip=True) if items[1].find('a') else items[1].get_text(strip=True)
+
+            price_min = None
+            if price_el := card.find("span", string=_PRICE_FROM):
+                if price_match := _DIGITS.search(price_el.get_text(strip=True).replace(' ', '')):
+                    price_min = float(price_match.group(0))
+
+            result['cards'].append({
+                'href': href, 'title': title, 'date_str': date_str, 'place': place, 'price_min': price_min,
+            })
+        except Exception as e:
+            result['errors'].append(f"{href}: {e}")
+    return result
+
+
+def extract_bezkassira_cards(html: str, selectors: dict) -> list[dict]:
+    """Карточки главной страницы bezkassira.by: [{href, title, date_str, place}]."""
+    soup = BeautifulSoup(html, 'lxml')
+    cards = []
+    for card in soup.select(selectors['event_card']):
+        # Ищем элементы внутри родительской карточки
+        caption_div = card.select_one(selectors['caption'])
+        if not caption_div:
+            continue
+
+        title_element = caption_div.select_one(selectors['title'])
+        link_element = caption_div.select_one(selectors['link'])
+        date_element = card.select_one(selectors['date'])
+        place_element = card.select_one(selectors['place'])
+
+        if not all([title_element, link_element, date_element, place_element]):
+            continue
+
+        cards.append({
+            'href': link_element['href'],
+            'title': title_element.get_text(strip=True),
+            'date_str': date_element.get_text(strip=True),
+            'place': place_element.get_text(separator=" ", strip=True),
+        })
+    return cards
+
+
+def extract_liveball_list(html: str, selectors: dict) -> list[str]:
+    """Ссылки на еще не начавшиеся матчи со страницы дня liveball."""
+    soup = BeautifulSoup(html, 'lxml')
+    return [
+        link_tag['href']
+        for link_tag in soup.select(selectors['list_item'])
+        if not link_tag.select_one(selectors['list_score_indicator'])
+    ]
+
+
+def extract_liveball_detail(html: str, selectors: dict) -> dict | None:
+    """Страница матча liveball: {league_tour, left_team, right_team, time_str} или None."""
+    soup = BeautifulSoup(html, 'lxml')
+    main_info_block = soup.select_one(selectors['detail_main_info_block'])
+    if not main_info_block:
+        return None
+
+    league_tour_element = main_info_block.select_one(selectors['detail_league_tour'])
+    left_team_element = main_info_block.select_one(selectors['detail_left_team'])
+    right_team_element = main_info_block.select_one(selectors['detail_right_team'])
+    if not (left_team_element and right_team_element):
+        return None
+
+    time_str = None
+    if info_vs_block := main_info_block.select_one(selectors['detail_vs_block']):
+        if time_element := info_vs_block.select_one(selectors['detail_time']):
+            time_str = time_element.get_text(strip=True)
+
+    return {
+        'league_tour': league_tour_element.get_text(strip=True) if league_tour_element else "Турнир",
+        'left_team': left_team_element.get_text(strip=True),
+        'right_team': right_team_element.get_text(strip=True),
+        'time_str': time_str,
+    }
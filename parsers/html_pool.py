@@ -0,0 +1,85 @@
+# --- START OF FILE parsers/html_pool.py ---
+#
+# Пул процессов для CPU-разбора HTML (BeautifulSoup/lxml, регулярки).
+# Парсеры скачивают страницы сами (Selenium, requests), а разбор отдают сюда:
+# run_extractor(extract_func, html, ...) выполняет чистую функцию из
+# parsers/html_extract.py в отдельном процессе и возвращает компактный результат.
+# Так разбор не держит GIL процесса, где параллельно работают другие конфиги
+# (браузеры, asyncio, запись в БД), и большие обходы используют все ядра.
+#
+# Пул создается лениво, один на процесс. Процессы запускаются через spawn:
+# fork процесса с потоками Selenium и event loop небезопасен. При spawn процесс пула
+# заново импортирует запускающий скрипт (без блока if __name__ == "__main__").
+# HTML_POOL_WORKERS=0 отключает пул — разбор идет в вызывающем потоке.
+
+import asyncio
+import atexit
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+HTML_POOL_WORKERS = int(os.getenv("HTML_POOL_WORKERS", min(os.cpu_count() or 1, 4)))
+
+logger = logging.getLogger()
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+_pool_broken = False
+
+
+def get_pool() -> ProcessPoolExecutor | None:
+    """Общий пул процессов или None, если пул отключен или сломался."""
+    global _pool
+    if HTML_POOL_WORKERS <= 0 or _pool_broken:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=HTML_POOL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            logger.info(f"Запущен пул разбора HTML: {HTML_POOL_WORKERS} процессов.")
+        return _pool
+
+
+def _mark_broken(e: Exception):
+    global _pool_broken
+    if not _pool_broken:
+        logger.error(f"Пул разбора HTML недоступен, разбор продолжится в текущем процессе: {e}")
+    _pool_broken = True
+
+
+def run_extractor(extractor, *args):
+    """Синхронный вызов для потоков Selenium и синхронных парсеров: ждет результат из пула."""
+    pool = get_pool()
+    if pool is None:
+        return extractor(*args)
+    try:
+        return pool.submit(extractor, *args).result()
+    except BrokenProcessPool as e:
+        _mark_broken(e)
+        return extractor(*args)
+
+
+async def run_extractor_async(extractor, *args):
+    """Асинхронный вызов для парсеров на asyncio: event loop не ждет разбора."""
+    pool = get_pool()
+    if pool is None:
+        return await asyncio.to_thread(extractor, *args)
+    try:
+        return await asyncio.wrap_future(pool.submit(extractor, *args))
+    except BrokenProcessPool as e:
+        _mark_broken(e)
+        return await asyncio.to_thread(extractor, *args)
+
+
+@atexit.register
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+            _pool = None
@@ -129,6 +129,8 @@ class KassirScraper:
                     data['title'] = title.text
                     link = card.find_element(By.CSS_SELECTOR, 'a[href]')
                     data['link'] = link.get_attribute("href")
+                    data['source'] = 'kassir'
+                    data['external_id'] = data['link'].split('?', 1)[0].rstrip('/').rsplit('/', 1)[-1]
                 except:
                     data['title'] = None
                     data['link'] = None
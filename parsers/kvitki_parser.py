@@ -83,7 +83,10 @@ def parse_site(config: dict) -> list[dict]:
         start_time_data = event_info.get('startTime', {})
         timestamp = start_time_data.get('stamp') if isinstance(start_time_data, dict) else None
 
+        concert_id = event_info.get('id')
         final_events.append({
+            'source': 'kvitki_by',
+            'external_id': str(concert_id) if concert_id is not None else link.rstrip('/').rsplit('/', 1)[-1],
             'title': event_info.get(keys['title']),
             'place': event_info.get(keys['place']),
             'time': event_info.get(keys['time']),
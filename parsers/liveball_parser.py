@@ -1,11 +1,13 @@
 # --- START OF FILE parsers/liveball_parser.py ---
 
 import requests
-from bs4 import BeautifulSoup
 from datetime import datetime, timedelta
 import locale
 import time
 
+from parsers.html_extract import extract_liveball_list, extract_liveball_detail
+from parsers.html_pool import run_extractor
+
 try:
     locale.setlocale(locale.LC_TIME, 'ru_RU.UTF-8')
 except locale.Error:
@@ -48,53 +50,36 @@ def parse(config: dict) -> list[dict]:
         try:
             response = requests.get(list_url, headers=headers, timeout=10)
             response.raise_for_status()
-            soup = BeautifulSoup(response.text, 'lxml')
         except requests.RequestException:
             continue
 
-        match_links = soup.select(selectors['list_item'])
-
-        upcoming_matches_urls = []
-        for link_tag in match_links:
-            if link_tag.select_one(selectors['list_score_indicator']):
-                continue
-            upcoming_matches_urls.append(base_url + link_tag['href'])
+        # Разбор HTML — в пуле процессов (parsers/html_pool.py)
+        # Путь страницы матча — стабильный ID матча на liveball
+        upcoming_matches = [
+            (base_url + href, href.strip('/'))
+            for href in run_extractor(extract_liveball_list, response.text, selectors)
+        ]
 
-        for detail_url in upcoming_matches_urls:
+        for detail_url, match_id in upcoming_matches:
             try:
                 detail_response = requests.get(detail_url, headers=headers, timeout=10)
                 detail_response.raise_for_status()
-                detail_soup = BeautifulSoup(detail_response.text, 'lxml')
-
-                main_info_block = detail_soup.select_one(selectors['detail_main_info_block'])
-                if not main_info_block:
-                    continue
-
-                league_tour_element = main_info_block.select_one(selectors['detail_league_tour'])
-                left_team_element = main_info_block.select_one(selectors['detail_left_team'])
-                right_team_element = main_info_block.select_one(selectors['detail_right_team'])
-
-                if not (left_team_element and right_team_element):
+                match = run_extractor(extract_liveball_detail, detail_response.text, selectors)
+                if not match:
                     continue
 
-                league_tour = league_tour_element.get_text(strip=True) if league_tour_element else "Турнир"
-                left_team = left_team_element.get_text(strip=True)
-                right_team = right_team_element.get_text(strip=True)
-                title = f"{league_tour}: {left_team} - {right_team}"
+                title = f"{match['league_tour']}: {match['left_team']} - {match['right_team']}"
 
                 time_str_for_user = "Время уточняйте"
                 dt_object = None
                 timestamp = None
 
-                info_vs_block = main_info_block.select_one(selectors['detail_vs_block'])
-                if info_vs_block:
-                    time_element = info_vs_block.select_one(selectors['detail_time'])
-                    if time_element:
-                        time_str = time_element.get_text(strip=True)
-                        time_str_for_user = time_str.split('<')[0].strip()
-                        dt_object = combine_date_and_time_str(date_obj, time_str)
-                        if dt_object:
-                            timestamp = int(dt_object.timestamp())
+                if match['time_str']:
+                    time_str = match['time_str']
+                    time_str_for_user = time_str.split('<')[0].strip()
+                    dt_object = combine_date_and_time_str(date_obj, time_str)
+                    if dt_object:
+                        timestamp = int(dt_object.timestamp())
 
                 if not dt_object:
                     # Если время не найдено, ставим полночь дня, за который парсим
@@ -102,6 +87,8 @@ def parse(config: dict) -> list[dict]:
                     timestamp = int(dt_object.timestamp())
 
                 event_info = {
+                    'source': 'liveball',
+                    'external_id': match_id,
                     'title': title,
                     'place': "Место не указано",  # <- значение по умолчанию
                     'time': time_str_for_user,  # <- чистое время или "Время уточняйте"
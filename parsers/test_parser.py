@@ -3,11 +3,16 @@ import json
 import re
 import sys
 from dataclasses import dataclass, asdict
-from typing import Optional, Dict, List
+from typing import AsyncIterator, Optional, Dict, List
 import logging
 
 from playwright.async_api import async_playwright, Browser, TimeoutError as PlaywrightTimeoutError
 
+from app.database.requests.requests_crawl import (
+    CrawlTracker, CRAWL_DETAIL_RECHECK_HOURS, CRAWL_KNOWN_PAGES_TO_STOP, DETAIL_STATES_KEY, LIST_STATES_KEY,
+    content_hash
+)
+
 # --- ГЛОБАЛЬНЫЕ НАСТРОЙКИ ---
 CONCURRENT_EVENTS = 5
 logger = logging.getLogger()
@@ -16,6 +21,8 @@ logger = logging.getLogger()
 @dataclass
 class EventData:
     link: str
+    source: str = "kvitki_by"
+    external_id: Optional[str] = None # ID концерта из window.concertDetails
     title: Optional[str] = None
     place: Optional[str] = None
     time_string: Optional[str] = None # <-- Переименовано для унификации
@@ -26,12 +33,33 @@ class EventData:
     status: str = "ok"
 
 
-async def parse_single_event(browser: Browser, event_url: str) -> Dict:
+async def _not_modified(page, event_url: str, crawl: Optional[CrawlTracker]) -> bool:
+    """Условный запрос по сохраненным ETag/Last-Modified: True, если сервер ответил 304."""
+    state = crawl.get(event_url) if crawl else None
+    if not state or not (state['etag'] or state['last_modified']):
+        return False
+    headers = {}
+    if state['etag']:
+        headers['If-None-Match'] = state['etag']
+    if state['last_modified']:
+        headers['If-Modified-Since'] = state['last_modified']
+    try:
+        response = await page.request.get(event_url, headers=headers, timeout=30000)
+        return response.status == 304
+    except Exception:
+        return False
+
+
+async def parse_single_event(browser: Browser, event_url: str, crawl: Optional[CrawlTracker] = None) -> Dict:
     """Собирает ВСЕ сырые данные со страницы события, но НЕ вызывает AI."""
     page = None
     try:
         page = await browser.new_page()
-        await page.goto(event_url, timeout=60000)
+        if await _not_modified(page, event_url, crawl):
+            crawl.touch(event_url)
+            logger.info(f"⏭️ [Kvitki] Страница не изменилась (304): {event_url}")
+            return asdict(EventData(link=event_url, status="unchanged"))
+        response = await page.goto(event_url, timeout=60000)
 
         # 1. Извлекаем базовую информацию из JSON на странице
         try:
@@ -42,6 +70,8 @@ async def parse_single_event(browser: Browser, event_url: str) -> Dict:
         if not details_json:
             raise ValueError("Объект 'window.concertDetails' пуст.")
 
+        concert_id = details_json.get('id')
+        external_id = str(concert_id) if concert_id is not None else event_url.rstrip('/').rsplit('/', 1)[-1]
         title = details_json.get('title')
         place = details_json.get('venueDescription')
         time_string = details_json.get('localisedStartDate') # <-- Исходная строка с датой
@@ -95,6 +125,7 @@ async def parse_single_event(browser: Browser, event_url: str) -> Dict:
         
         event = EventData(
             link=event_url, # Сохраняем исходную ссылку, а не ссылку магазина
+            external_id=external_id,
             title=title, 
             place=place, 
             time_string=time_string,
@@ -103,8 +134,20 @@ async def parse_single_event(browser: Browser, event_url: str) -> Dict:
             price_max=price_max, 
             tickets_available=tickets_available
         )
+        if crawl:
+            response_headers = response.headers if response else {}
+            crawl.observe(
+                event_url,
+                content_hash([title, place, time_string, price_min, price_max, tickets_available]),
+                etag=response_headers.get('etag'),
+                last_modified=response_headers.get('last-modified'),
+            )
         logger.info(f"✅ [Kvitki] Сырые данные собраны: {title}")
-        return asdict(event)
+        result = asdict(event)
+        if crawl:
+            # Состояние страницы сохранит писатель после коммита события
+            result[DETAIL_STATES_KEY] = crawl.take([event_url])
+        return result
 
     except Exception as e:
         logger.error(f"❌ [Kvitki] Ошибка при сборе данных для {event_url}: {e}")
@@ -114,8 +157,11 @@ async def parse_single_event(browser: Browser, event_url: str) -> Dict:
             await page.close()
 
 
-async def parse_site(config: Dict) -> List[Dict]:
-    """Основная функция-парсер для сайта Kvitki.by с использованием Playwright."""
+async def iter_site(config: Dict) -> AsyncIterator[Dict]:
+    """
+    Потоковый парсер Kvitki.by: собирает ссылки со страниц списка и отдает события
+    по мере готовности детальных страниц (ошибочные страницы пропускаются).
+    """
     base_url = config.get('url')
     logging.info(f"\n[INFO] Запуск Playwright-парсера для: '{config.get('site_name')}'")
     
@@ -123,65 +169,110 @@ async def parse_site(config: Dict) -> List[Dict]:
     max_events_limit = config.get('max_events_to_process_limit', float('inf'))
     
     event_links = set()
+    # Состояние прошлых обходов: страницы списка под base_url и детальные страницы
+    crawl = CrawlTracker(EventData.source)
+    await crawl.load(prefix=base_url)
+    early_stop = CRAWL_KNOWN_PAGES_TO_STOP > 0 and not crawl.needs_full_crawl(base_url)
+    known_pages_streak, list_completed = 0, False
     async with async_playwright() as p:
         browser = await p.chromium.launch(headless=True)
-        page_for_lists = await browser.new_page()
+        try:
+            page_for_lists = await browser.new_page()
 
-        page_num = 1
-        while page_num <= pages_to_parse_limit:
-            url = f"{base_url}page:{page_num}/"
-            logger.info(f"📄 Сканирую страницу: {url}")
-            try:
-                await page_for_lists.goto(url, timeout=30000)
-                await page_for_lists.wait_for_selector('a.event_short', timeout=10000, state='attached')
-                locators = page_for_lists.locator('a.event_short')
-                
-                new_links_on_page = 0
-                for i in range(await locators.count()):
-                    if len(event_links) >= max_events_limit: break
-                    link = await locators.nth(i).get_attribute('href')
-                    if link and link not in event_links:
-                        event_links.add(link)
-                        new_links_on_page += 1
-
-                if new_links_on_page == 0:
-                    logger.info(f"   - Новые события на странице {page_num} не найдены. Завершаю сбор.")
+            page_num = 1
+            while page_num <= pages_to_parse_limit:
+                url = f"{base_url}page:{page_num}/"
+                logger.info(f"📄 Сканирую страницу: {url}")
+                try:
+                    await page_for_lists.goto(url, timeout=30000)
+                    await page_for_lists.wait_for_selector('a.event_short', timeout=10000, state='attached')
+                    locators = page_for_lists.locator('a.event_short')
+                    
+                    new_links_on_page = 0
+                    page_links = []
+                    for i in range(await locators.count()):
+                        if len(event_links) >= max_events_limit: break
+                        link = await locators.nth(i).get_attribute('href')
+                        page_links.append(link)
+                        if link and link not in event_links:
+                            event_links.add(link)
+                            new_links_on_page += 1
+
+                    if new_links_on_page == 0:
+                        logger.info(f"   - Новые события на странице {page_num} не найдены. Завершаю сбор.")
+                        list_completed = True
+                        break
+
+                    # Страница списка известна, если ее набор ссылок не изменился с прошлого обхода
+                    page_unchanged = not crawl.observe(url, content_hash(sorted(filter(None, page_links))))
+                    known_pages_streak = known_pages_streak + 1 if page_unchanged else 0
+                    if early_stop and known_pages_streak >= CRAWL_KNOWN_PAGES_TO_STOP:
+                        logger.info(f"   - Страниц без изменений подряд: {known_pages_streak}. Дальше известная территория, завершаю сбор.")
+                        break
+                    
+                    logger.info(f"   - Найдено {new_links_on_page} новых ссылок. Всего собрано: {len(event_links)}")
+                    if len(event_links) >= max_events_limit:
+                        logger.info("   - Достигнут лимит событий. Завершаю сбор.")
+                        list_completed = True
+                        break
+                    page_num += 1
+                except PlaywrightTimeoutError:
+                    logger.info(f"   - Карточки событий на странице {page_num} не найдены. Завершаю сбор.")
+                    list_completed = True
                     break
-                
-                logger.info(f"   - Найдено {new_links_on_page} новых ссылок. Всего собрано: {len(event_links)}")
-                if len(event_links) >= max_events_limit:
-                    logger.info("   - Достигнут лимит событий. Завершаю сбор.")
+                except Exception as e:
+                    logger.error(f"   - Произошла непредвиденная ошибка при сборе ссылок: {e}")
                     break
-                page_num += 1
-            except PlaywrightTimeoutError:
-                logger.info(f"   - Карточки событий на странице {page_num} не найдены. Завершаю сбор.")
-                break
-            except Exception as e:
-                logger.error(f"   - Произошла непредвиденная ошибка при сборе ссылок: {e}")
-                break
-        
-        await page_for_lists.close()
-        
-        event_links_list = list(event_links)
-        logger.info(f"\n🔗 Всего собрано {len(event_links_list)} уникальных ссылок для детальной обработки.")
-        
-        if not event_links_list:
-            await browser.close()
-            return []
+            else:
+                # Дошли до pages_to_parse_limit
+                list_completed = True
+            
+            await page_for_lists.close()
+            if list_completed:
+                crawl.mark_full_crawl(base_url)
 
-        semaphore = asyncio.Semaphore(config.get('concurrent_events', CONCURRENT_EVENTS))
-        tasks = []
-        async def run_with_semaphore(link):
-            async with semaphore:
-                return await parse_single_event(browser, link)
+            await crawl.load(urls=event_links)
+            # Страница, событие которой так и не попало в БД, парсится заново
+            await crawl.forget_unsaved(event_links)
+            # Детальные страницы, проверенные недавно, не открываем повторно
+            event_links_list = [link for link in event_links if not crawl.checked_within(link, CRAWL_DETAIL_RECHECK_HOURS)]
+            logger.info(f"\n🔗 Всего собрано {len(event_links)} уникальных ссылок, "
+                        f"на детальную обработку: {len(event_links_list)}.")
 
-        for link in event_links_list:
-            tasks.append(asyncio.create_task(run_with_semaphore(link)))
-        
-        results = await asyncio.gather(*tasks)
-        await browser.close()
+            semaphore = asyncio.Semaphore(config.get('concurrent_events', CONCURRENT_EVENTS))
+            async def run_with_semaphore(link):
+                async with semaphore:
+                    return await parse_single_event(browser, link, crawl)
 
-    final_results = [res for res in results if res.get('status') == 'ok']
+            tasks = [asyncio.create_task(run_with_semaphore(link)) for link in event_links_list]
+            # Последнее событие придерживается: с ним уходит состояние страниц списка,
+            # писатель сохранит его, только если все события обхода записались
+            held = None
+            try:
+                for next_result in asyncio.as_completed(tasks):
+                    res = await next_result
+                    if res.get('status') != 'ok':
+                        continue
+                    if held is not None:
+                        yield held
+                    held = res
+                if held is not None:
+                    held[LIST_STATES_KEY] = crawl.take()
+                    yield held
+                else:
+                    # Записывать нечего — сохранять состояние можно сразу
+                    await crawl.flush()
+            finally:
+                # Потребитель мог остановить генератор раньше: недоделанные страницы не нужны
+                for task in tasks:
+                    task.cancel()
+        finally:
+            await browser.close()
+
+
+async def parse_site(config: Dict) -> List[Dict]:
+    """Основная функция-парсер для сайта Kvitki.by с использованием Playwright."""
+    final_results = [event async for event in iter_site(config)]
     logger.info(f"🎉 Сбор сырых данных для '{config.get('site_name')}' завершен. Собрано: {len(final_results)} событий.")
     return final_results
 
@@ -7,6 +7,7 @@ import re
 import random
 import time
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
 from calendar import monthrange
 import requests
 from PIL import Image
@@ -19,13 +20,18 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException, WebDriverException, NoSuchElementException
 from webdriver_manager.chrome import ChromeDriverManager
-from bs4 import BeautifulSoup
 from selenium.webdriver.common.action_chains import ActionChains
 from app.database.requests import requests as rq
-from app.database.models import async_session
+from app.database.requests import requests_ingest as rq_ingest
+from app.database.requests.requests_crawl import (
+    CrawlTracker, CRAWL_KNOWN_PAGES_TO_STOP, LIST_STATES_KEY, content_hash, event_crawl_states, save_crawl_states
+)
+from app.database.models import parser_session
 
 # Импортируем AI функцию
 from parsers.test_ai import getArtist
+from parsers.html_extract import extract_yandex_cards
+from parsers.html_pool import run_extractor
 
 # --- 1. ИНИЦИАЛИЗАЦИЯ И КОНСТАНТЫ ---
 logger = logging.getLogger()
@@ -385,7 +391,20 @@ def _wait_for_page_load_and_solve_captcha(driver: webdriver.Chrome, rucaptcha_ap
 
 # --- 3. НИЗКОУРОВНЕВЫЕ ПАРСЕРЫ ---
 
-def _parse_list_sync(config: dict) -> list[dict]:
+def _list_key(config: dict) -> str:
+    """Ключ списка в crawl_state: URL без даты, она меняется каждый день."""
+    return f"{config['url']}?period={config['period']}"
+
+
+def _parse_list_sync(config: dict, on_page=None, crawl: CrawlTracker | None = None) -> list[dict]:
+    """
+    Собирает карточки событий со страниц списка.
+    on_page(events) вызывается после каждой страницы с ее новыми событиями — так
+    iter_events отдает события потоком, не дожидаясь конца пагинации.
+    crawl — загруженное состояние обхода: после CRAWL_KNOWN_PAGES_TO_STOP
+    неизменившихся страниц подряд пагинация останавливается. Состояние страницы
+    уходит в ее последнее событие (LIST_STATES_KEY) и сохраняется после его коммита.
+    """
     site_name, base_url = config['site_name'], f"{config['url']}?date={datetime.now().strftime('%Y-%m-%d')}&period={config['period']}"
     rucaptcha_api_key, max_pages = config.get('RUCAPTCHA_API_KEY'), config.get('max_pages', 365)
     
@@ -403,6 +422,10 @@ def _parse_list_sync(config: dict) -> list[dict]:
     # --- КОНЕЦ ИСПРАВЛЕННОГО БЛОКА НАСТРОЕК ДРАЙВЕРА ---
 
     all_events_data, seen_event_links = [], set()
+    list_key = _list_key(config)
+    early_stop = (crawl is not None and CRAWL_KNOWN_PAGES_TO_STOP > 0
+                  and not crawl.needs_full_crawl(list_key))
+    known_pages_streak, list_completed = 0, False
     logger.info(f"Начинаю парсинг списка: {site_name}")
     driver = None
     try:
@@ -436,65 +459,88 @@ def _parse_list_sync(config: dict) -> list[dict]:
                 _wait_for_page_load_and_solve_captcha(driver, rucaptcha_api_key, '[data-test-id="eventCard.root"]')
             except Exception as e:
                 logger.error(f"Не удалось загрузить страницу или пройти капчу: {e}"); break
-            soup = BeautifulSoup(driver.page_source, 'lxml')
-            event_cards = soup.find_all("div", attrs={"data-test-id": "eventCard.root"})
-            if not event_cards: break
-            current_page_links = {link.get('href') for card in event_cards if (link := card.find("a", attrs={"data-test-id": "eventCard.link"}))}
+            # Разбор HTML — в пуле процессов (parsers/html_pool.py), поток Selenium только ждет
+            page = run_extractor(extract_yandex_cards, driver.page_source)
+            if not page['card_texts']:
+                list_completed = True; break
+            current_page_links = set(page['links'])
             if not current_page_links.difference(seen_event_links):
-                logger.info("Новых событий на странице не найдено. Завершаю."); break
-            for card in event_cards:
+                logger.info("Новых событий на странице не найдено. Завершаю.")
+                list_completed = True; break
+            # Текст карточек (название, дата, место, цена) — содержимое страницы для crawl_state
+            page_unchanged = False
+            if crawl is not None:
+                page_key = f"{list_key}&page={page_num}"
+                page_unchanged = not crawl.observe(page_key, content_hash(page['card_texts']))
+            for error in page['errors']:
+                logger.warning(f"Ошибка парсинга карточки: {error}")
+            page_events = []
+            for card in page['cards']:
                 try:
-                    href = (link_element.get('href') if (link_element := card.find("a", attrs={"data-test-id": "eventCard.link"})) else None)
-                    if not href or href in seen_event_links: continue
+                    href, title = card['href'], card['title']
+                    if href in seen_event_links: continue
                     seen_event_links.add(href)
-                    
-                    title = card.find("h2", attrs={"data-test-id": "eventCard.eventInfoTitle"}).get_text(strip=True)
-                    
-                    place, date_str = "Место не указано", "Дата не указана"
-                    if details_list := card.find("ul", attrs={"data-test-id": "eventCard.eventInfoDetails"}):
-                        items = details_list.find_all("li")
-                        if len(items) > 0: date_str = items[0].get_text(strip=True)
-                        if len(items) > 1: place = items[1].find('a').get_text(strip=True) if items[1].find('a') else items[1].get_text(strip=True)
-                    
-                    price_min = None
-                    if price_el := card.find("span", string=re.compile(r'от \d+')):
-                        if price_match := re.search(r'\d+', price_el.get_text(strip=True).replace(' ', '')):
-                            price_min = float(price_match.group(0))
-                    
-                    time_start, time_end = parse_datetime_range(date_str)
+
+                    time_start, time_end = parse_datetime_range(card['date_str'])
                     
                     if time_start is None:
                         logger.info(f"  -> Пропущено постоянное событие (без даты): '{title}'")
                         continue
 
                     event_dict = {
+                        'source': 'yandex_afisha',
+                        # Путь страницы события без query-параметров, например 'minsk/concert/some-event'
+                        'external_id': urlsplit(href).path.strip('/'),
                         'event_type': config.get('event_type', 'Другое'), 
                         'title': title, 
-                        'place': place,
-                        'time_string': date_str,
+                        'place': card['place'],
+                        'time_string': card['date_str'],
                         'link': "https://afisha.yandex.ru" + href, 
-                        'price_min': price_min, 
+                        'price_min': card['price_min'], 
                         'time_start': time_start, 
                         'time_end': time_end,
                         'city_name': config.get('city_name'),
                         'country_name': config.get('country_name')
                     }
                     all_events_data.append(event_dict)
+                    page_events.append(event_dict)
                     
                 except Exception as e: 
                     logger.warning(f"Ошибка парсинга карточки: {e}")    
+            # Карточки с ошибками тоже считаются просмотренными
+            seen_event_links.update(current_page_links)
+            if crawl is not None and page_events:
+                page_events[-1][LIST_STATES_KEY] = crawl.take([page_key])
+            if on_page and page_events:
+                on_page(page_events)
+            known_pages_streak = known_pages_streak + 1 if page_unchanged else 0
+            if early_stop and known_pages_streak >= CRAWL_KNOWN_PAGES_TO_STOP:
+                logger.info(f"Страниц без изменений подряд: {known_pages_streak}. Дальше известная территория, завершаю.")
+                break
             time.sleep(random.uniform(2.0, 4.0))
+        else:
+            # Дошли до max_pages
+            list_completed = True
     except Exception as e: 
         logger.error(f"Критическая ошибка в парсере списка: {e}", exc_info=True)
     finally:
         if driver: 
             driver.quit() # driver.quit() сам удалит временный профиль
+    if crawl is not None and list_completed:
+        crawl.mark_full_crawl(list_key)
     logger.info(f"Парсер списка завершен. Найдено уникальных событий: {len(all_events_data)}")
     return all_events_data
 
 
 async def _enrich_details_async(events_to_process: list[dict], rucaptcha_api_key: str | None) -> list[dict]:
     if not events_to_process: return []
+    # Selenium блокирующий: уводим его в поток, чтобы не останавливать event loop
+    # (параллельно с этим работают парсеры других конфигов)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _enrich_details_sync, events_to_process, rucaptcha_api_key)
+
+
+def _enrich_details_sync(events_to_process: list[dict], rucaptcha_api_key: str | None) -> list[dict]:
     logger.info(f"Начинаю детальный парсинг для {len(events_to_process)} событий...")
     
     # --- НАЧАЛО ИСПРАВЛЕННОГО БЛОКА НАСТРОЕК ДРАЙВЕРА ---
@@ -556,6 +602,71 @@ async def _enrich_details_async(events_to_process: list[dict], rucaptcha_api_key
     logger.info("Детальный парсинг завершен.")
     return events_to_process
 
+async def enrich_new_events(events_to_create: list[dict], config: dict) -> list[dict]:
+    """
+    Определяет артистов для новых событий: спорт — по заголовку через AI, остальное —
+    по чипам исполнителей или описанию со страницы события (детальный парсинг).
+    Используется и в parse(), и в потоковом режиме run_parser.
+    """
+    all_new_events_processed = []
+    new_sport_events = [e for e in events_to_create if e.get('event_type') == 'Спорт']
+    new_other_events = [e for e in events_to_create if e.get('event_type') != 'Спорт']
+
+    for event in new_sport_events:
+        logger.info(f"  -> [Спорт] Анализ заголовка: '{event['title']}'")
+        artists = await getArtist(event['title'])
+        event['artists'] = artists if artists else [event['title']]
+        all_new_events_processed.append(event)
+
+    if new_other_events:
+        enriched_events = await _enrich_details_async(new_other_events, config.get('RUCAPTCHA_API_KEY'))
+        for event in enriched_events:
+            if event.get('artists'):
+                logger.info(f"  -> [Концерт] Найдены чипы: {event['artists']}")
+            elif event.get('full_description'):
+                logger.info(f"  -> [Концерт] Анализ описания для: '{event['title']}'")
+                artists = await getArtist(event['full_description'])
+                event['artists'] = artists if artists else [event['title']]
+            else:
+                logger.warning(f"  -> [Концерт] Нет ни чипов, ни описания. Используется заголовок: '{event['title']}'")
+                event['artists'] = [event['title']]
+            all_new_events_processed.append(event)
+    return all_new_events_processed
+
+
+async def iter_events(config: dict):
+    """
+    Потоковый вариант парсера для run_parser: отдает сырые события со страниц списка
+    по мере их обхода, без записи в БД. Запись и обогащение новых событий
+    (enrich_new_events) делает общий писатель пайплайна.
+    """
+    loop = asyncio.get_running_loop()
+    pages: asyncio.Queue = asyncio.Queue()
+
+    def on_page(page_events: list[dict]):
+        # Вызывается из потока Selenium
+        loop.call_soon_threadsafe(pages.put_nowait, page_events)
+
+    crawl = CrawlTracker('yandex_afisha')
+    await crawl.load(prefix=_list_key(config))
+    list_future = loop.run_in_executor(None, _parse_list_sync, config, on_page, crawl)
+    # Конец пагинации (или ошибка) — пустой маркер в очередь после всех страниц
+    list_future.add_done_callback(lambda _: pages.put_nowait(None))
+    # Последнее событие придерживается до конца списка: с ним уходит отметка полного
+    # обхода и состояние страниц без событий
+    held = None
+    while (page_events := await pages.get()) is not None:
+        for event in page_events:
+            if held is not None:
+                yield held
+            held = event
+    await list_future
+    if held is not None:
+        held[LIST_STATES_KEY] = held.get(LIST_STATES_KEY, []) + crawl.take()
+        yield held
+    else:
+        await crawl.flush()
+
 # --- 4. ГЛАВНАЯ ФУНКЦИЯ-ОРКЕСТРАТОР ---
 
 async def parse(config: dict) -> list[dict]:
@@ -563,71 +674,41 @@ async def parse(config: dict) -> list[dict]:
     loop = asyncio.get_running_loop()
 
     # Этап 1: Получаем сырой список событий с сайта
-    raw_events = await loop.run_in_executor(None, _parse_list_sync, config)
+    crawl = CrawlTracker('yandex_afisha')
+    await crawl.load(prefix=_list_key(config))
+    raw_events = await loop.run_in_executor(None, _parse_list_sync, config, None, crawl)
     if not raw_events:
+        await crawl.flush()
         logger.warning("Парсер списка не вернул событий. Завершаю.")
         return []
     logger.info(f"Этап 1: Успешно собрано {len(raw_events)} сырых событий.")
 
     # Открываем сессию для всех операций с БД в рамках одного запуска
-    async with async_session() as session:
+    async with parser_session() as session:
         try:
-            # Этап 2: Массовая проверка существования событий
-            signatures = [
-                (event['title'], event['time_start'])
-                for event in raw_events if event.get('title') and event.get('time_start')
-            ]
-            existing_events_map = await rq.find_events_by_signatures_bulk(session, signatures)
-            logger.info(f"Этап 2: Проверка в БД. Найдено {len(existing_events_map)} уже существующих событий.")
-
-            # Этап 3: Разделение на новые и существующие
-            events_to_create = []
-            events_to_update = []
-            for event in raw_events:
-                sig = (event.get('title'), event.get('time_start'))
-                if sig in existing_events_map:
-                    event['event_id'] = existing_events_map[sig]
-                    events_to_update.append(event)
-                else:
-                    events_to_create.append(event)
+            # Справочники (типы, страны, города, площадки) читаются один раз на запуск
+            resolver = rq_ingest.ReferenceResolver()
+            await resolver.load(session)
+
+            # Этапы 2-3: Массовая проверка существования событий (по ID источника,
+            # для старых событий — по названию и дате) и разделение на новые и существующие
+            events_to_create, events_to_update = await rq_ingest.split_existing_events(session, raw_events)
+            logger.info(f"Этап 2: Проверка в БД. Найдено {len(events_to_update)} уже существующих событий.")
             
             logger.info(f"Этап 3: Разделение. Новых: {len(events_to_create)}, на обновление: {len(events_to_update)}.")
 
             # Этап 4: Обновление данных для существующих событий
             if events_to_update:
                 logger.info(f"Этап 4: Обновление данных для {len(events_to_update)} существующих событий...")
-                for event_data in events_to_update:
-                    await rq.update_event_details(session, event_data['event_id'], event_data)
+                await rq_ingest.update_events_bulk(session, events_to_update)
 
             # Этап 5: Полная обработка новых событий
             if events_to_create:
                 logger.info(f"Этап 5: Обработка {len(events_to_create)} новых событий...")
                 
                 # 5.1. Определяем артистов для всех новых событий
-                all_new_events_processed = []
-                new_sport_events = [e for e in events_to_create if e.get('event_type') == 'Спорт']
-                new_other_events = [e for e in events_to_create if e.get('event_type') != 'Спорт']
-
-                for event in new_sport_events:
-                    logger.info(f"  -> [Спорт] Анализ заголовка: '{event['title']}'")
-                    artists = await getArtist(event['title'])
-                    event['artists'] = artists if artists else [event['title']]
-                    all_new_events_processed.append(event)
-
-                if new_other_events:
-                    enriched_events = await _enrich_details_async(new_other_events, config.get('RUCAPTCHA_API_KEY'))
-                    for event in enriched_events:
-                        if event.get('artists'):
-                            logger.info(f"  -> [Концерт] Найдены чипы: {event['artists']}")
-                        elif event.get('full_description'):
-                            logger.info(f"  -> [Концерт] Анализ описания для: '{event['title']}'")
-                            artists = await getArtist(event['full_description'])
-                            event['artists'] = artists if artists else [event['title']]
-                        else:
-                            logger.warning(f"  -> [Концерт] Нет ни чипов, ни описания. Используется заголовок: '{event['title']}'")
-                            event['artists'] = [event['title']]
-                        all_new_events_processed.append(event)
-                
+                all_new_events_processed = await enrich_new_events(events_to_create, config)
+
                 # 5.2. Собираем ВСЕХ уникальных артистов и создаем их ОДНИМ запросом
                 all_artist_names = set()
                 for event in all_new_events_processed:
@@ -643,13 +724,14 @@ async def parse(config: dict) -> list[dict]:
 
                 # 5.3. Создаем сами события в БД
                 logger.info(f"Этап 5.3: Сохранение {len(all_new_events_processed)} новых событий в БД...")
-                for event_data in all_new_events_processed:
-                    # Передаем карту артистов в функцию создания
-                    await rq.create_event_with_artists(session, event_data, artists_map)
+                # Передаем карту артистов, все события пишутся пачкой
+                await rq_ingest.create_events_bulk(session, all_new_events_processed, artists_map, resolver)
             
             # Финальный коммит всех изменений (и обновлений, и созданий)
             await session.commit()
             logger.info("--- ПОЛНЫЙ ЦИКЛ ПАРСИНГА ЗАВЕРШЕН. Все изменения сохранены в БД. ---")
+            # Состояние обхода — только по закоммиченным событиям
+            await save_crawl_states(event_crawl_states(raw_events) + crawl.take())
 
         except Exception as e:
             logger.error(f"Произошла ошибка в процессе парсинга и сохранения. Откатываю транзакцию. Ошибка: {e}", exc_info=True)
@@ -1,12 +1,14 @@
 import asyncio
 import logging
+import os
 import re
+import time
 from datetime import datetime, timedelta
 
 from sqlalchemy import func, select
 
 # --- 1. ОБНОВЛЯЕМ ИМПОРТЫ ---
-from app.database.models import async_session,Artist
+from app.database.models import parser_session, Artist
 from parsers.configs import ALL_CONFIGS
 
 # Импортируем наш новый парсер и даем ему понятное имя
@@ -15,10 +17,18 @@ from parsers.test_parser import parse_site as parse_kvitki_playwright
 from parsers.test_ai import getArtist, getArtistkvitki
 # Импортируем НОВЫЕ функции для работы с БД
 from app.database.requests import requests as rq # <-- Импортируем весь модуль requests
+from app.database.requests import requests_ingest as rq_ingest
+from app.database.requests import requests_archive as rq_archive
+from app.database.requests import requests_crawl as rq_crawl
+from app.database import query_stats
+from app.database.query_stats import query_tag, tag_queries
 
 # Импортируем старые парсеры, если они нужны
 from parsers.yandex_parser import parse as parse_yandex_afisha
 from parsers.test_parser import parse_site as parse_kvitki_by # (Пример)
+# Потоковые варианты парсеров (async-генераторы) для PARSER_STREAMING
+from parsers.yandex_parser import iter_events as iter_yandex_afisha, enrich_new_events as enrich_yandex_events
+from parsers.test_parser import iter_site as iter_kvitki_by
 
 
 
@@ -204,91 +214,180 @@ def extract_city_from_place(place_string: str) -> str:
     return "Минск"
 
 # --- 4. ОСНОВНАЯ ЛОГИКА ОРКЕСТРАТОРА (ПОЛНОСТЬЮ ПЕРЕПИСАНА) ---
-async def process_all_sites():
+
+PARSER_MAPPING = {
+    'yandex_afisha': parse_yandex_afisha,
+    'kvitki_by': parse_kvitki_by,
+}
+
+# Сколько конфигов парсится одновременно всего
+PARSER_GLOBAL_CONCURRENCY = int(os.getenv("PARSER_GLOBAL_CONCURRENCY", 4))
+# Сколько конфигов одного источника парсится одновременно: каждый конфиг поднимает
+# свой браузер и ходит на один и тот же сайт, поэтому лимит на источник отдельный.
+# Переопределяется строкой вида "yandex_afisha=2,kvitki_by=1"
+PARSER_KEY_CONCURRENCY = {
+    'yandex_afisha': 2,
+    'kvitki_by': 2,
+}
+DEFAULT_KEY_CONCURRENCY = 1
+
+
+def _load_key_concurrency() -> dict[str, int]:
+    limits = dict(PARSER_KEY_CONCURRENCY)
+    for item in os.getenv("PARSER_KEY_CONCURRENCY", "").split(","):
+        key, _, value = item.partition("=")
+        if key.strip() and value.strip().isdigit():
+            limits[key.strip()] = max(int(value), 1)
+    return limits
+
+
+def normalize_event(site_config: dict, event_data: dict) -> dict:
+    """Дополняет сырое событие парсера данными из конфига и приводит поля к общему виду."""
+    # Обогащаем данными из конфига
+    event_data['event_type'] = site_config.get('event_type', 'Другое')
+    event_data['country_name'] = site_config.get('country_name')
+    event_data['city_name'] = site_config.get('city_name') or extract_city_from_place(event_data.get('place'))
+
+    # Парсим дату, если она еще не распарсена
+    if 'time_start' not in event_data:
+        event_data['time_start'] = parse_datetime_from_str(event_data.get('time_string'))
+        event_data['time_end'] = None
+
+    # Обрабатываем билеты
+    if 'tickets_available' in event_data:
+        count = event_data.pop('tickets_available')
+        event_data['tickets_info'] = f"{count} билетов" if count else "Нет в наличии"
+    return event_data
+
+
+def normalize_site_events(site_config: dict, events_from_site: list[dict]) -> list[dict]:
+    return [normalize_event(site_config, event_data) for event_data in events_from_site]
+
+
+def _config_limits() -> tuple[asyncio.Semaphore, dict[str, asyncio.Semaphore]]:
+    """Общий лимит и лимиты по источникам на один цикл парсинга."""
+    global_limit = asyncio.Semaphore(max(PARSER_GLOBAL_CONCURRENCY, 1))
+    key_limits = {
+        key: asyncio.Semaphore(limit) for key, limit in _load_key_concurrency().items()
+    }
+    return global_limit, key_limits
+
+
+async def assign_artists(events_to_create: list[dict]):
+    """Артисты новых событий: то, что уже определил парсер, иначе AI по описанию, иначе заголовок."""
+    for event in events_to_create:
+        # Яндекс парсер уже сам определил артистов, его не трогаем
+        if event.get('artists'): 
+            continue
+        
+        # Для Kvitki и других вызываем AI
+        if event.get('full_description'):
+            artists = await getArtistkvitki(event['full_description'])
+            event['artists'] = artists if artists else [event['title']]
+        else:
+            event['artists'] = [event['title']]
+
+
+async def finish_cycle():
+    """Переносит прошедшие события в архив, пересчитывает афишу и публикует статистику SQL."""
+    query_tag.set("parser.archive")
+    # Витрина все равно пересчитывается следующим шагом
+    await rq_archive.archive_past_events(refresh_afisha=False)
+    query_tag.set("parser.refresh_afisha")
+    await rq_ingest.refresh_afisha_groups()
+    await query_stats.publish("parser")
+
+
+async def run_site_config(site_config: dict, parser_func, global_limit: asyncio.Semaphore,
+                          key_limit: asyncio.Semaphore) -> list[dict]:
+    """
+    Запускает парсер одного конфига под общим лимитом и лимитом его источника.
+    Ошибка одного конфига логируется и не влияет на остальные: возвращается пустой список.
+    """
+    parser_key = site_config.get('parser_key')
+    site_name = site_config.get('site_name')
+    async with key_limit, global_limit:
+        logging.info(f"\n--- Запуск парсера '{parser_key}' для '{site_name}' ---")
+        started = time.monotonic()
+        try:
+            with tag_queries(f"parser.{parser_key}"):
+                events_from_site = await parser_func(site_config)
+            normalized = normalize_site_events(site_config, events_from_site or [])
+        except Exception as e:
+            logging.error(f"Парсер '{parser_key}' для '{site_name}' завершился с ошибкой: {e}", exc_info=True)
+            return []
+    logging.info(f"--- '{site_name}': {len(normalized)} событий за {time.monotonic() - started:.1f} с ---")
+    return normalized
+
+
+async def process_all_sites() -> rq_ingest.RunChanges:
+    """
+    Полный цикл парсинга. Возвращает изменения запуска (созданные и реально
+    измененные события) — по ним можно запускать дальнейшие этапы.
+    """
     logging.info("==============================================")
     logging.info("=== НАЧАЛО НОВОГО ЦИКЛА ПОЛНОГО ПАРСИНГА ===")
     logging.info("==============================================")
 
-    parser_mapping = {
-        'yandex_afisha': parse_yandex_afisha,
-        'kvitki_by': parse_kvitki_by,
-    }
-
     # --- Этап 1: Сбор и НОРМАЛИЗАЦИЯ данных ---
-    all_normalized_events = []
+    # Конфиги парсятся параллельно, время цикла определяет самый медленный источник,
+    # а не сумма всех. Результаты собираются по мере готовности.
+    global_limit, key_limits = _config_limits()
+
+    tasks = []
     for site_config in ALL_CONFIGS:
         parser_key = site_config.get('parser_key')
-        parser_func = parser_mapping.get(parser_key)
-        
+        parser_func = PARSER_MAPPING.get(parser_key)
+
         if not parser_func:
             logging.warning(f"Пропущен конфиг '{site_config.get('site_name')}' с ключом парсера: '{parser_key}'")
             continue
-            
-        logging.info(f"\n--- Запуск парсера '{parser_key}' для '{site_config.get('site_name')}' ---")
-        try:
-            events_from_site = await parser_func(site_config)
-            
-            for event_data in events_from_site:
-                # Обогащаем данными из конфига
-                event_data['event_type'] = site_config.get('event_type', 'Другое')
-                event_data['country_name'] = site_config.get('country_name')
-                event_data['city_name'] = site_config.get('city_name') or extract_city_from_place(event_data.get('place'))
-
-                # Парсим дату, если она еще не распарсена
-                if 'time_start' not in event_data:
-                    event_data['time_start'] = parse_datetime_from_str(event_data.get('time_string'))
-                    event_data['time_end'] = None
-                
-                # Обрабатываем билеты
-                if 'tickets_available' in event_data:
-                    count = event_data.pop('tickets_available')
-                    event_data['tickets_info'] = f"{count} билетов" if count else "Нет в наличии"
 
-                all_normalized_events.append(event_data)
-        except Exception as e:
-            logging.error(f"Парсер '{parser_key}' завершился с ошибкой: {e}", exc_info=True)
+        key_limit = key_limits.setdefault(parser_key, asyncio.Semaphore(DEFAULT_KEY_CONCURRENCY))
+        tasks.append(asyncio.create_task(run_site_config(site_config, parser_func, global_limit, key_limit)))
 
+    all_normalized_events = []
+    stage_started = time.monotonic()
+    for finished_count, next_result in enumerate(asyncio.as_completed(tasks), start=1):
+        site_events = await next_result
+        all_normalized_events.extend(site_events)
+        logging.info(f"Готово конфигов: {finished_count}/{len(tasks)}, событий собрано: {len(all_normalized_events)}")
+    logging.info(f"Сбор данных завершен за {time.monotonic() - stage_started:.1f} с.")
+
+    changes = rq_ingest.RunChanges()
     if not all_normalized_events:
         logging.info("Ни один парсер не вернул событий. Завершаю работу.")
-        return
+        # Прошедшие события все равно должны уйти из афиши и из events
+        await finish_cycle()
+        return changes
 
     # --- Этап 2: Работа с БД ---
     logging.info(f"\n--- Всего обработано {len(all_normalized_events)} событий. Начинаю синхронизацию с БД. ---")
     
-    async with async_session() as session:
+    # Теги этапов для статистики SQL (python -m app.database.query_stats)
+    query_tag.set("parser.sync")
+    run_changes = rq_ingest.RunChanges()
+    async with parser_session() as session:
         try:
             await populate_artists_if_needed(session)
+            # Справочники (типы, страны, города, площадки) читаются один раз на запуск
+            resolver = rq_ingest.ReferenceResolver()
+            await resolver.load(session)
 
-            # Массовая проверка
-            signatures = [(e.get('title'), e.get('time_start')) for e in all_normalized_events if e.get('title') and e.get('time_start')]
-            existing_events_map = await rq.find_events_by_signatures_bulk(session, signatures)
-            
-            events_to_create, events_updated_count = [], 0
-            for event_data in all_normalized_events:
-                sig = (event_data.get('title'), event_data.get('time_start'))
-                if sig in existing_events_map:
-                    event_data['event_id'] = existing_events_map[sig]
-                    await rq.update_event_details(session, event_data['event_id'], event_data)
-                    events_updated_count += 1
-                else:
-                    events_to_create.append(event_data)
+            # Массовая проверка: по ID источника, для старых событий — по (title, date_start)
+            events_to_create, events_to_update = await rq_ingest.split_existing_events(session, all_normalized_events)
             
-            logging.info(f"Разделение. Новых: {len(events_to_create)}, на обновление: {events_updated_count}.")
+            logging.info(f"Разделение. Новых: {len(events_to_create)}, на обновление: {len(events_to_update)}.")
+
+            # Обновление существующих событий одним пакетом
+            # (события без изменений цен/билетов/дат не трогаются)
+            if events_to_update:
+                await rq_ingest.update_events_bulk(session, events_to_update, run_changes)
 
             # Обработка новых событий
             if events_to_create:
                 # Определяем артистов для всех новых событий
-                for event in events_to_create:
-                    # Яндекс парсер уже сам определил артистов, его не трогаем
-                    if event.get('artists'): 
-                        continue
-                    
-                    # Для Kvitki и других вызываем AI
-                    if event.get('full_description'):
-                        artists = await getArtistkvitki(event['full_description'])
-                        event['artists'] = artists if artists else [event['title']]
-                    else:
-                        event['artists'] = [event['title']]
+                await assign_artists(events_to_create)
                 
                 # Массово создаем всех артистов
                 all_artist_names = {name.lower() for e in events_to_create for name in e.get('artists', []) if name}
@@ -296,24 +395,213 @@ async def process_all_sites():
                 if all_artist_names:
                     artists_map = await rq.get_or_create_artists_by_name(session, list(all_artist_names))
 
-                # Массово создаем все события
-                events_created_count = 0
-                for event_data in events_to_create:
-                    if await rq.create_event_with_artists(session, event_data, artists_map):
-                        events_created_count += 1
+                # Массово создаем все события (несколько запросов на весь батч)
+                await rq_ingest.create_events_bulk(session, events_to_create, artists_map, resolver, run_changes)
             
-                await session.commit()
-                logging.info("Изменения успешно сохранены.")
-                logging.info(f"Новых событий создано: {events_created_count}")
-                logging.info(f"Существующих событий обновлено: {events_updated_count}")
+            # Общий коммит и для обновлений, и для новых событий
+            await session.commit()
+            # Изменения и состояние обхода учитываются только после успешного коммита
+            changes.merge(run_changes)
+            await rq_crawl.save_crawl_states(rq_crawl.event_crawl_states(all_normalized_events))
+            logging.info("Изменения успешно сохранены.")
+            logging.info(f"Изменения запуска: {changes.summary()}")
 
         except Exception as e:
             logging.error(f"Критическая ошибка в процессе обработки. Откатываю транзакцию. Ошибка: {e}", exc_info=True)
             await session.rollback()
 
+    # Переносим прошедшие события в архив и пересчитываем сгруппированную афишу
+    # уже по закоммиченным данным
+    await finish_cycle()
+
     logging.info("\n--- Обработка завершена ---")
-    logging.info(f"Новых событий создано: {events_created_count}")
-    logging.info(f"Существующих событий обновлено: {events_updated_count}")
+    logging.info(f"Новых событий создано: {len(changes.created)}")
+    logging.info(f"Существующих событий изменено: {len(changes.updated)}, без изменений: {changes.unchanged}")
+    return changes
+
+
+# --- 5. ПОТОКОВЫЙ РЕЖИМ (PARSER_STREAMING=1) ---
+# Парсеры отдают события async-генераторами, каждое событие нормализуется сразу
+# и кладется в ограниченную очередь; единственный писатель забирает их пачками по
+# STREAM_BATCH_SIZE и пишет в БД отдельной транзакцией на пачку. Полная очередь
+# притормаживает парсеры (backpressure), память не растет с размером обхода,
+# а первые события попадают в БД, не дожидаясь конца всех источников.
+
+PARSER_STREAMING = os.getenv("PARSER_STREAMING", "0").strip().lower() in ("1", "true", "yes", "on")
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", 500))
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", 200))
+# Неполная пачка пишется, если новых событий не было столько секунд
+STREAM_FLUSH_SECONDS = float(os.getenv("STREAM_FLUSH_SECONDS", 15))
+
+STREAM_MAPPING = {
+    'yandex_afisha': iter_yandex_afisha,
+    'kvitki_by': iter_kvitki_by,
+}
+# Источник сам определяет артистов своих новых событий (детальные страницы и т.п.),
+# для остальных — assign_artists
+NEW_EVENT_ENRICHERS = {
+    'yandex_afisha': enrich_yandex_events,
+}
+
+_STREAM_END = None
+
+
+async def _iter_site_events(site_config: dict, parser_key: str):
+    """Генератор событий конфига: потоковый парсер, если он есть, иначе обычный списком."""
+    if stream_func := STREAM_MAPPING.get(parser_key):
+        async for event_data in stream_func(site_config):
+            yield event_data
+        return
+    for event_data in await PARSER_MAPPING[parser_key](site_config) or []:
+        yield event_data
+
+
+async def stream_site_config(site_config: dict, queue: asyncio.Queue, global_limit: asyncio.Semaphore,
+                             key_limit: asyncio.Semaphore) -> int:
+    """Производитель: парсит один конфиг и кладет нормализованные события в очередь."""
+    parser_key = site_config.get('parser_key')
+    site_name = site_config.get('site_name')
+    produced = 0
+    async with key_limit, global_limit:
+        logging.info(f"\n--- Запуск потокового парсера '{parser_key}' для '{site_name}' ---")
+        started = time.monotonic()
+        try:
+            with tag_queries(f"parser.{parser_key}"):
+                async for event_data in _iter_site_events(site_config, parser_key):
+                    await queue.put((site_config, normalize_event(site_config, event_data)))
+                    produced += 1
+        except Exception as e:
+            # Уже отданные события остаются в очереди и будут записаны
+            logging.error(f"Парсер '{parser_key}' для '{site_name}' завершился с ошибкой после "
+                          f"{produced} событий: {e}", exc_info=True)
+    logging.info(f"--- '{site_name}': {produced} событий за {time.monotonic() - started:.1f} с ---")
+    return produced
+
+
+async def write_events_batch(session, resolver: rq_ingest.ReferenceResolver,
+                             batch: list[tuple[dict, dict]]) -> rq_ingest.RunChanges:
+    """Пишет пачку (конфиг, событие) в БД без коммита. Возвращает изменения пачки."""
+    batch_changes = rq_ingest.RunChanges()
+    events = [event_data for _, event_data in batch]
+    events_to_create, events_to_update = await rq_ingest.split_existing_events(session, events)
+
+    if events_to_update:
+        await rq_ingest.update_events_bulk(session, events_to_update, batch_changes)
+
+    if events_to_create:
+        configs = {id(event_data): site_config for site_config, event_data in batch}
+        by_source: dict[str, list[dict]] = {}
+        for event_data in events_to_create:
+            by_source.setdefault(configs[id(event_data)].get('parser_key'), []).append(event_data)
+
+        ready_events = []
+        for parser_key, source_events in by_source.items():
+            if enricher := NEW_EVENT_ENRICHERS.get(parser_key):
+                # Конфиги одного источника отличаются городом/типом, но не ключами API
+                ready_events.extend(await enricher(source_events, configs[id(source_events[0])]))
+            else:
+                await assign_artists(source_events)
+                ready_events.extend(source_events)
+
+        all_artist_names = {name.lower() for e in ready_events for name in e.get('artists', []) if name}
+        artists_map = {}
+        if all_artist_names:
+            artists_map = await rq.get_or_create_artists_by_name(session, list(all_artist_names))
+        await rq_ingest.create_events_bulk(session, ready_events, artists_map, resolver, batch_changes)
+    return batch_changes
+
+
+async def batch_writer(queue: asyncio.Queue, changes: rq_ingest.RunChanges):
+    """Писатель: собирает пачки из очереди и коммитит каждую отдельно до маркера конца."""
+    query_tag.set("parser.sync")
+    resolver = rq_ingest.ReferenceResolver()
+    async with parser_session() as session:
+        await populate_artists_if_needed(session)
+    # Конфиги, чья пачка откатилась: состояние их страниц списка не сохраняется,
+    # иначе следующий обход остановится раньше потерянных событий
+    failed_configs: set[int] = set()
+
+    async def flush(batch):
+        nonlocal resolver
+        async with parser_session() as session:
+            try:
+                batch_changes = await write_events_batch(session, resolver, batch)
+                await session.commit()
+            except Exception as e:
+                logging.error(f"Ошибка записи пачки из {len(batch)} событий, пачка пропущена: {e}", exc_info=True)
+                await session.rollback()
+                failed_configs.update(id(site_config) for site_config, _ in batch)
+                # ID, созданные в откаченной транзакции, невалидны (см. ReferenceResolver)
+                resolver = rq_ingest.ReferenceResolver()
+                return
+        changes.merge(batch_changes)
+        # Детальные страницы — по своим событиям, страницы списка — если у конфига не было потерь
+        crawl_states = []
+        for site_config, event_data in batch:
+            crawl_states.extend(event_data.get(rq_crawl.DETAIL_STATES_KEY) or ())
+            if id(site_config) not in failed_configs:
+                crawl_states.extend(event_data.get(rq_crawl.LIST_STATES_KEY) or ())
+        await rq_crawl.save_crawl_states(crawl_states)
+        logging.info(f"Пачка записана: {len(batch)} событий, {batch_changes.summary()}. "
+                     f"Всего: {changes.summary()}")
+
+    batch = []
+    while True:
+        try:
+            item = await asyncio.wait_for(queue.get(), timeout=STREAM_FLUSH_SECONDS)
+        except asyncio.TimeoutError:
+            if batch:
+                await flush(batch)
+                batch = []
+            continue
+        if item is _STREAM_END:
+            break
+        batch.append(item)
+        if len(batch) >= STREAM_BATCH_SIZE:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+
+
+async def process_all_sites_streaming() -> rq_ingest.RunChanges:
+    logging.info("==============================================")
+    logging.info("=== НАЧАЛО ПОТОКОВОГО ЦИКЛА ПАРСИНГА ===")
+    logging.info("==============================================")
+
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(STREAM_QUEUE_SIZE, 1))
+    global_limit, key_limits = _config_limits()
+
+    producers = []
+    for site_config in ALL_CONFIGS:
+        parser_key = site_config.get('parser_key')
+        if parser_key not in STREAM_MAPPING and parser_key not in PARSER_MAPPING:
+            logging.warning(f"Пропущен конфиг '{site_config.get('site_name')}' с ключом парсера: '{parser_key}'")
+            continue
+        key_limit = key_limits.setdefault(parser_key, asyncio.Semaphore(DEFAULT_KEY_CONCURRENCY))
+        producers.append(asyncio.create_task(stream_site_config(site_config, queue, global_limit, key_limit)))
+
+    # Пишется писателем по мере коммита пачек: при падении писателя в нем остается записанное
+    changes = rq_ingest.RunChanges()
+    writer = asyncio.create_task(batch_writer(queue, changes))
+    producers_done = asyncio.gather(*producers)
+    # Если писатель упал, производители навсегда встанут на полной очереди — останавливаем их
+    await asyncio.wait({writer, producers_done}, return_when=asyncio.FIRST_COMPLETED)
+    if writer.done():
+        producers_done.cancel()
+        await asyncio.gather(producers_done, return_exceptions=True)
+        logging.error(f"Писатель пайплайна остановился раньше парсеров: {writer.exception()!r}")
+    else:
+        await queue.put(_STREAM_END)
+        await writer
+
+    await finish_cycle()
+
+    logging.info("\n--- Потоковая обработка завершена ---")
+    logging.info(f"Новых событий создано: {len(changes.created)}")
+    logging.info(f"Существующих событий изменено: {len(changes.updated)}, без изменений: {changes.unchanged}")
+    return changes
+
 
 if __name__ == "__main__":
-    asyncio.run(process_all_sites())
\ No newline at end of file
+    asyncio.run(process_all_sites_streaming() if PARSER_STREAMING else process_all_sites())
\ No newline at end of file
@@ -0,0 +1,63 @@
+# Tg_bot/test_reference_resolver.py
+#
+# Проверка ReferenceResolver на живой БД (подключение — из .env, как у бота).
+# Два резолвера в разных сессиях одновременно создают одну и ту же новую площадку
+# и должны получить один venue_id, а не две строки в venues.
+# Созданные город и площадка удаляются в конце.
+
+import asyncio
+import uuid
+
+from sqlalchemy import delete, func, select
+
+from app.database.models import parser_engine, parser_session, City, Venue
+from app.database.requests.requests_ingest import ReferenceResolver
+
+
+async def resolve_same_new_venue() -> tuple[int, int, int]:
+    suffix = uuid.uuid4().hex[:8]
+    event = {
+        'event_type': 'Концерт',
+        'country_name': 'Беларусь',
+        'city_name': f"Тестовый город {suffix}",
+        'place': f"Тестовая площадка {suffix}",
+    }
+    first, second = ReferenceResolver(), ReferenceResolver()
+    try:
+        async with parser_session() as session_a, parser_session() as session_b:
+            # Оба резолвера загружают справочники до вставки: в памяти площадки нет ни у одного
+            await first.load(session_a)
+            await second.load(session_b)
+
+            await first.resolve(session_a, [event])
+            # Транзакция A еще открыта: вставка B ждет ее на уникальном индексе
+            second_task = asyncio.create_task(second.resolve(session_b, [event]))
+            await asyncio.sleep(0.5)
+            assert not second_task.done(), "второй резолвер не дождался коммита первого"
+
+            await session_a.commit()
+            await second_task
+            await session_b.commit()
+
+        async with parser_session() as session:
+            venues_count = await session.scalar(
+                select(func.count()).select_from(Venue).where(Venue.name == event['place'])
+            )
+        return first.venue_id(event), second.venue_id(event), venues_count
+    finally:
+        async with parser_session() as session:
+            await session.execute(delete(Venue).where(Venue.name == event['place']))
+            await session.execute(delete(City).where(City.name == event['city_name']))
+            await session.commit()
+        await parser_engine.dispose()
+
+
+def test_two_resolvers_share_new_venue():
+    first_id, second_id, venues_count = asyncio.run(resolve_same_new_venue())
+    assert first_id == second_id
+    assert venues_count == 1
+
+
+if __name__ == '__main__':
+    test_two_resolvers_share_new_venue()
+    print("✅ Оба резолвера получили одну и ту же площадку.")